@@ -1,5 +1,6 @@
 
 import re
+import json
 
 def extract_selected_channels(log_file_path):
     # 用于存储提取的数字
@@ -20,6 +21,11 @@ def extract_selected_channels(log_file_path):
     
     return selected_channels_list
 
+def load_kept_ratio(stats_path):
+    # 读取 AdaThinKStats.to_json 导出的统计结果 (eval.py --save_stats), 不需要解析日志
+    with open(stats_path, 'r') as file:
+        return json.load(file)["kept_ratio"]
+
 for l in ['128', '512', '1024', '2048']:
   log_file_path = f'logs0/llama3-8b-inst/snap_adathink_{l}_1_channel0.5_t0.0_no0.0_0.99.log' 
   result = extract_selected_channels(log_file_path)
@@ -0,0 +1,85 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+from typing import Optional
+
+import torch
+from datasets import load_dataset
+from fire import Fire
+from tqdm import tqdm
+from transformers import pipeline
+from kvpress import AdaThinKPress
+
+from eval import DATASET_DICT
+
+
+def calibrate(
+    dataset: str,
+    data_dir: Optional[str] = None,
+    model: str = "meta-llama/Meta-Llama-3.1-8B-Instruct",
+    device: Optional[str] = None,
+    n_samples: int = 16,
+    threshold_ratio: float = 0.99,
+    n_groups: int = 4,
+    max_context_length: Optional[int] = None,
+    output: Optional[str] = None,
+):
+    """
+    Run AdaThinK over a sample of contexts and save a calibration profile of per-layer/per-head group boundaries
+    and expected keep ratios, to be used with AdaThinKPress(selection="profile", profile=output)
+
+    Parameters
+    ----------
+    dataset : str
+        Dataset to sample the contexts from
+    data_dir : str, optional
+        Subdirectory of the dataset, by default None
+    model : str, optional
+        Model to calibrate, by default "meta-llama/Meta-Llama-3.1-8B-Instruct"
+    device : str, optional
+        Model device, by default cuda:0 if available else cpu. For multi-GPU use "auto"
+    n_samples : int, optional
+        Number of contexts used for the calibration, by default 16
+    threshold_ratio : float, optional
+        AdaThinK threshold used during the calibration, by default 0.99
+    n_groups : int, optional
+        Number of groups per head in the profile, by default 4
+    max_context_length : int, optional
+        Maximum number of tokens to use in the context, by default the maximum length supported by the model
+    output : str, optional
+        Profile file, by default profiles/<model>.json
+    """
+
+    assert dataset in DATASET_DICT, f"No dataset found for {dataset}"
+    data_dir = str(data_dir) if data_dir else None
+
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+
+    if output is None:
+        os.makedirs("profiles", exist_ok=True)
+        output = f"profiles/{model.split('/')[-1]}.json"
+
+    df = load_dataset(DATASET_DICT[dataset], data_dir, split="test").to_pandas()
+    contexts = df["context"].drop_duplicates()
+    contexts = contexts.sample(n=min(n_samples, len(contexts)), random_state=42).to_list()
+
+    model_kwargs = {"torch_dtype": "auto"}
+    if device == "auto":
+        pipe = pipeline("kv-press-text-generation", model=model, device_map="auto", model_kwargs=model_kwargs)
+    else:
+        pipe = pipeline("kv-press-text-generation", model=model, device=device, model_kwargs=model_kwargs)
+
+    # The threshold positions of every token of every layer are accumulated in press.stats
+    press = AdaThinKPress(threshold_ratio=threshold_ratio, accumulate_stats=True)
+    for context in tqdm(contexts):
+        pipe(context, question="", press=press, max_new_tokens=1, max_context_length=max_context_length)
+        torch.cuda.empty_cache()
+
+    press.stats.to_profile(output, n_groups, model=model, dataset=dataset, data_dir=data_dir, n_samples=len(contexts))
+    print(f"Calibration profile saved to {output}")
+
+
+if __name__ == "__main__":
+    Fire(calibrate)
@@ -38,7 +38,10 @@ from kvpress import (
     QFilterPress,
     PyramidKVPress,
     FinchPress,
+    CompactKeyCache,
+    LowRankKeyPress,
 )
+from kvpress.presses.adathink_press import FILL_STRATEGIES
 
 logger = logging.getLogger(__name__)
 
@@ -82,6 +85,8 @@ PRESS_DICT = {
     "finch": FinchPress(),
     "pyramid_adathink": ComposedPress([PyramidKVPress(), AdaThinKPress()]),
     "pyramid_think": ComposedPress([PyramidKVPress(), ThinKPress()]),
+    "lowrank_key": LowRankKeyPress(),
+    "snap_lowrank_key": ComposedPress([SnapKVPress(), LowRankKeyPress()]),
 }
 
 
@@ -103,6 +108,18 @@ def evaluate(
     temperature: float = 0.0,
     pooling_ratio: float = 0.0,
     mode: Optional[str] = None,
+    compact_keys: bool = False,
+    selection: str = "score",
+    verbose: bool = False,
+    save_stats: bool = False,
+    fill: Optional[str] = None,
+    layout: str = "ragged",
+    low_precision_bits: int = 0,
+    profile: Optional[str] = None,
+    chunk_size: int = 0,
+    dump_format: Optional[str] = None,
+    decode_interval: int = 0,
+    fused: bool = False,
 ):
     """
     Evaluate a model on a dataset using a press and save the results
@@ -129,6 +146,37 @@ def evaluate(
         Maximum number of tokens to use in the context. By default will use the maximum length supported by the model.
     compress_questions : bool, optional
         Whether to compress the questions as well, by default False
+    compact_keys : bool, optional
+        Whether to store AdaThinK pruned keys (or LowRankKeyPress coefficients) in a CompactKeyCache (real memory
+        savings), by default False
+    selection : str, optional
+        AdaThinK channel selection, "score", "cumsum" (token-wise energy threshold), "profile" (per-head group budgets
+        from a calibration profile, see calibrate.py) or "head" (one static channel subset per head, narrower keys
+        with compact_keys), by default "score"
+    verbose : bool, optional
+        Whether to print the AdaThinK channel statistics at each layer (forces a host sync), by default False
+    save_stats : bool, optional
+        Whether to save the AdaThinK per-layer/per-head channel statistics (.stats.json and .stats.npz next to the
+        results), summed over all the samples, by default False
+    fill : str, optional
+        Name of the AdaThinK fill strategy for the pruned channels (see FILL_STRATEGIES), by default None (derived
+        from pooling_ratio)
+    layout : str, optional
+        Compact layout of the AdaThinK keys when compact_keys is set, "ragged" or "bucketed", by default "ragged"
+    low_precision_bits : int, optional
+        If 8 or 4, AdaThinK quantizes the pruned channels to int8 / int4 instead of dropping them, by default 0
+    profile : str, optional
+        Calibration profile used by the "profile" selection, by default None
+    chunk_size : int, optional
+        Number of tokens processed at a time by AdaThinK to bound its peak memory, by default 0 (no chunking)
+    dump_format : str, optional
+        If "safetensors" or "npy", dump the AdaThinK keys, masks and scores of every layer under
+        <results file without .json>/dump (see AdaThinKDump), by default None
+    decode_interval : int, optional
+        If > 0, AdaThinK also prunes the generated keys, decode_interval tokens at a time, by default 0
+    fused : bool, optional
+        Whether composed presses (e.g. snap_adathink) run in a single pass per layer, sharing the window queries
+        and writing the cache once (see ComposedPress), by default False
     """
 
     assert dataset in DATASET_DICT, f"No dataset found for {dataset}"
@@ -193,6 +241,7 @@ def evaluate(
     if isinstance(press, (DuoAttentionPress)):
         press.head_compression_ratio = compression_ratio
     elif isinstance(press, (ComposedPress)):
+        press.fused = fused
         for ps in press.presses:
             if isinstance(ps, (ThinKPress)):
                 ps.key_channel_compression_ratio = key_channel_compression_ratio
@@ -200,6 +249,33 @@ def evaluate(
                     save_filename.stem + f"__channel{key_channel_compression_ratio}" + save_filename.suffix
                 )
             elif isinstance(ps, (AdaThinKPress)):
+                ps.selection = selection
+                ps.profile = profile
+                ps.chunk_size = chunk_size
+                ps.dump_format = dump_format
+                if decode_interval > 0:
+                    ps.decode_interval = decode_interval
+                    save_filename = save_filename.with_name(
+                        save_filename.stem + f"__decode{decode_interval}" + save_filename.suffix
+                    )
+                ps.stats.verbose = verbose
+                ps.accumulate_stats = save_stats
+                ps.layout = layout
+                if low_precision_bits > 0:
+                    ps.low_precision_bits = low_precision_bits
+                    save_filename = save_filename.with_name(
+                        save_filename.stem + f"__int{low_precision_bits}" + save_filename.suffix
+                    )
+                if fill is not None:
+                    assert fill in FILL_STRATEGIES, f"No fill strategy found for {fill}"
+                    ps.fill = fill
+                    save_filename = save_filename.with_name(
+                        save_filename.stem + f"__{fill}" + save_filename.suffix
+                    )
+                if selection != "score":
+                    save_filename = save_filename.with_name(
+                        save_filename.stem + f"__{selection}" + save_filename.suffix
+                    )
                 if threshold_ratio != 0:
                     ps.threshold_ratio = threshold_ratio
                     save_filename = save_filename.with_name(
@@ -213,21 +289,62 @@ def evaluate(
                     )
                 # else:
                 ps.key_channel_compression_ratio = key_channel_compression_ratio
-                ps.outpath = save_dir
                 save_filename = save_filename.with_name(
                     save_filename.stem + f"__channel{key_channel_compression_ratio}" + save_filename.suffix
                 )
                 
+            elif isinstance(ps, (LowRankKeyPress)):
+                if threshold_ratio != 0:
+                    ps.energy_ratio = threshold_ratio
+                save_filename = save_filename.with_name(
+                    save_filename.stem + f"__energy{ps.energy_ratio}" + save_filename.suffix
+                )
             else:
                 ps.compression_ratio = compression_ratio
             ps.max_capacity_prompt = max_capacity_prompt
     elif isinstance(press, (ThinKPress)) or isinstance(press, (AdaThinKPress)):
         press.key_channel_compression_ratio = key_channel_compression_ratio
         press.max_capacity_prompt = max_capacity_prompt
+        if isinstance(press, (AdaThinKPress)):
+            press.selection = selection
+            press.profile = profile
+            press.chunk_size = chunk_size
+            press.dump_format = dump_format
+            press.decode_interval = decode_interval
+            press.stats.verbose = verbose
+            press.accumulate_stats = save_stats
+            press.fill = fill
+            press.layout = layout
+            press.low_precision_bits = low_precision_bits
+            if low_precision_bits > 0:
+                save_filename = save_filename.with_name(
+                    save_filename.stem + f"__int{low_precision_bits}" + save_filename.suffix
+                )
+    elif isinstance(press, (LowRankKeyPress)):
+        if threshold_ratio != 0:
+            press.energy_ratio = threshold_ratio
+        save_filename = save_filename.with_name(
+            save_filename.stem + f"__energy{press.energy_ratio}" + save_filename.suffix
+        )
     else:
         press.compression_ratio = compression_ratio  # type:ignore[attr-defined]
         press.max_capacity_prompt = max_capacity_prompt
 
+    if compact_keys:
+        save_filename = save_filename.with_name(save_filename.stem + "__compact" + save_filename.suffix)
+        if layout != "ragged":
+            save_filename = save_filename.with_name(save_filename.stem + f"__{layout}" + save_filename.suffix)
+    if chunk_size > 0:
+        save_filename = save_filename.with_name(save_filename.stem + f"__chunk{chunk_size}" + save_filename.suffix)
+    if fused and isinstance(press, (ComposedPress)):
+        save_filename = save_filename.with_name(save_filename.stem + "__fused" + save_filename.suffix)
+
+    # AdaThinK dumps are written next to the results file of the run (dump_format and save_stats do not change the
+    # results, so they are not part of its name)
+    for ps in press.presses if isinstance(press, (ComposedPress)) else [press]:
+        if isinstance(ps, (AdaThinKPress)):
+            ps.outpath = str(save_filename.with_suffix(""))
+
     if os.path.exists(save_filename): 
         print(f"{save_filename} exist! exit!")
         sys.exit()  # 退出程序
@@ -286,7 +403,8 @@ def evaluate(
             max_new_tokens=max_new_tokens_,
             max_context_length=max_context_length,
             temperature=temperature,
-            think='qwen3' not in model.split('/')[-1].lower()
+            think='qwen3' not in model.split('/')[-1].lower(),
+            cache=CompactKeyCache() if compact_keys else None,
         )
         df.loc[df_.index, "predicted_answer"] = output["answers"]
         df.loc[df_.index, "compression_ratio"] = press.compression_ratio
@@ -330,6 +448,17 @@ def evaluate(
         f.write('\n')
 
     
+    presses = press.presses if isinstance(press, (ComposedPress)) else [press]
+    for ps in presses:
+        if isinstance(ps, (AdaThinKPress)) and ps.dump is not None:
+            ps.dump.close()
+
+    if save_stats:
+        for ps in presses:
+            if isinstance(ps, (AdaThinKPress)):
+                ps.stats.to_json(str(save_filename.with_suffix(".stats.json")))
+                ps.stats.to_npz(str(save_filename.with_suffix(".stats.npz")))
+
     # print(f"Average compression ratio: {df['compression_ratio'].mean():.2f}")
     print(metrics)
 
@@ -5,4 +5,6 @@ echo $kvpress_path
 cp kvpress0/presses/*.py $kvpress_path/presses
 cp kvpress0/presses/adathink_press.py $kvpress_path/presses
 cp kvpress0/__init__.py $kvpress_path
-cp kvpress0/pipeline.py $kvpress_path
\ No newline at end of file
+cp kvpress0/pipeline.py $kvpress_path
+cp kvpress0/compact_cache.py $kvpress_path
+cp kvpress0/attention_patch.py $kvpress_path
\ No newline at end of file
@@ -3,6 +3,15 @@
 
 
 from kvpress.attention_patch import patch_attention_functions
+from kvpress.compact_cache import (
+    BucketedKeys,
+    CompactKeyCache,
+    ConcatenatedKeys,
+    NarrowKeys,
+    ProjectedKeys,
+    RaggedKeys,
+    TieredKeys,
+)
 from kvpress.pipeline import KVPressTextGenerationPipeline
 from kvpress.presses.adakv_press import AdaKVPress
 from kvpress.presses.base_press import BasePress
@@ -27,6 +36,7 @@ from kvpress.presses.qfilter_press import QFilterPress
 from kvpress.presses.finch_press import FinchPress
 from kvpress.presses.pyramidkv_press import PyramidKVPress
 from kvpress0.presses.adathink_press import AdaThinKPress
+from kvpress0.presses.lowrank_key_press import LowRankKeyPress
 
 # Patch the attention functions to support head-wise compression
 patch_attention_functions()
@@ -57,4 +67,12 @@ __all__ = [
     "PyramidKVPress",
     "QFilterPress",
     "FinchPress",
+    "CompactKeyCache",
+    "RaggedKeys",
+    "BucketedKeys",
+    "TieredKeys",
+    "NarrowKeys",
+    "ProjectedKeys",
+    "ConcatenatedKeys",
+    "LowRankKeyPress",
 ]
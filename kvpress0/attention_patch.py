@@ -1,6 +1,8 @@
 import torch
 from transformers.modeling_utils import ALL_ATTENTION_FUNCTIONS
 
+from kvpress.compact_cache import BucketedKeys
+
 
 def search_hyperplane(X, max_iter: int = 1000):
     """
@@ -17,17 +19,109 @@ def search_hyperplane(X, max_iter: int = 1000):
     raise ValueError("Could not find fake keys such that for every query q, exp(<q, k>) = 0")
 
 
+def compact_attention(module, query, key, value, compact_keys, attention_mask=None, scaling=None):
+    """
+    Attention over a key cache whose prefix is stored in a compact layout (see CompactKeyCache) followed by the
+    dense keys in key. Logits of the prefix are computed from the layout (see attention_logits of RaggedKeys,
+    TieredKeys and BucketedKeys), then merged with the logits of the dense keys in a single softmax. The queries are
+    the last q_len tokens, so only the dense keys need a causal mask. A 4D attention_mask (boolean or additive) is
+    applied to the logits of the whole cache, so padded tokens are masked without reading the mask values on the
+    host. 2D padding masks (flash attention) are not supported.
+    """
+    bsz, num_heads, q_len, head_dim = query.shape
+    assert attention_mask is None or attention_mask.dim() == 4, "compact_attention only supports 4D attention masks"
+    num_key_value_heads = value.shape[1]
+    num_key_value_groups = num_heads // num_key_value_heads
+    scaling = head_dim**-0.5 if scaling is None else scaling
+
+    compact_logits = compact_keys.attention_logits(query)
+    grouped_query = query.reshape(bsz, num_key_value_heads, num_key_value_groups * q_len, head_dim)
+    dense_logits = torch.matmul(grouped_query, key.transpose(2, 3))
+
+    # Causal mask on the dense keys: query i sees the dense keys up to position key_len - q_len + i
+    key_len = key.shape[2]
+    query_positions = torch.arange(q_len, device=query.device).repeat(num_key_value_groups) + key_len - q_len
+    causal_mask = torch.arange(key_len, device=query.device) > query_positions.unsqueeze(-1)
+    dense_logits = dense_logits.masked_fill(causal_mask, float("-inf"))
+
+    logits = torch.cat([compact_logits, dense_logits], dim=-1) * scaling
+    if attention_mask is not None:
+        mask = attention_mask[:, :, -q_len:, : logits.shape[-1]].unsqueeze(2)  # (bsz, 1, 1, q_len, cache_len)
+        logits = logits.view(bsz, num_key_value_heads, num_key_value_groups, q_len, -1)
+        if mask.dtype == torch.bool:
+            logits = logits.masked_fill(~mask, float("-inf"))
+        else:
+            logits = logits + mask
+        logits = logits.view(bsz, num_key_value_heads, num_key_value_groups * q_len, -1)
+    weights = torch.softmax(logits, dim=-1, dtype=torch.float32).to(query.dtype)
+    attn_output = torch.matmul(weights, value).view(bsz, num_heads, q_len, head_dim)
+    return attn_output.transpose(1, 2).contiguous(), None
+
+
+def narrow_query(query, key_channels):
+    """
+    Slice the (bsz, num_heads, q_len, head_dim) query to the (bsz, num_key_value_heads, width) channels kept by
+    the keys of each key-value head (see NarrowKeys), so the attention is a dense matmul over width channels
+    """
+    bsz, num_heads, q_len, head_dim = query.shape
+    num_key_value_heads, width = key_channels.shape[1:]
+    num_key_value_groups = num_heads // num_key_value_heads
+    query = query.reshape(bsz, num_key_value_heads, num_key_value_groups, q_len, head_dim)
+    channels = key_channels[:, :, None, None, :].expand(-1, -1, num_key_value_groups, q_len, -1)
+    return torch.gather(query, -1, channels).view(bsz, num_heads, q_len, width)
+
+
+def project_query(query, key_basis):
+    """
+    Project the (bsz, num_heads, q_len, head_dim) query onto the (bsz, num_key_value_heads, head_dim, rank) basis
+    of the keys of each key-value head (see ProjectedKeys)
+    """
+    bsz, num_heads, q_len, head_dim = query.shape
+    num_key_value_heads, rank = key_basis.shape[1], key_basis.shape[3]
+    query = query.reshape(bsz, num_key_value_heads, num_heads // num_key_value_heads * q_len, head_dim)
+    return torch.matmul(query, key_basis).view(bsz, num_heads, q_len, rank)
+
+
 def attention_patch(func):
     """
     Decorator to udpate the keys before the attention computation at the indices provided in module.masked_key_indices
     The keys are updated with a fake key k such that exp(<q, k>) = 0 to fake head-wise compression
     This solution is not optimal as it does not reduce peak memory and slightly increase runtime
+    If module.compact_keys is set and the cache returned fewer keys than values, the attention is computed by
+    compact_attention instead. For multi-token forwards (e.g. the question), BucketedKeys are rebuilt, as gathering
+    the query channels of each token would read more than the dense keys.
+    At prefill, the last module.query_window_size rotated queries are stored in module.window_queries, so that the
+    presses read them (see get_window_queries in base_press.py) instead of recomputing q_proj and RoPE.
+    If module.key_channels is set and the keys are narrower than the query (NarrowKeys), the query is sliced to the
+    kept channels. The softmax scaling of the full head_dim is kept, and the attention function must support a
+    value head_dim different from the query one (e.g. eager or sdpa). module.key_basis (ProjectedKeys) is handled the
+    same way, projecting the query onto the basis of the keys.
     """
 
     def wrapper(module, query, key, value, attention_mask, dropout, **kwargs):
-        if query.shape[2] == key.shape[2]:
+        if query.shape[2] == value.shape[2]:
             # Prefilling
             module.masked_key_indices = None
+            module.compact_keys = None
+            module.key_channels = None
+            module.key_basis = None
+            window_size = getattr(module, "query_window_size", 0)
+            module.window_queries = query[:, :, -window_size:].clone() if window_size > 0 else None
+        elif getattr(module, "compact_keys", None) is not None and key.shape[2] < value.shape[2]:
+            # Decoding with a compact key prefix that is not part of key
+            if query.shape[2] == 1 or not isinstance(module.compact_keys, BucketedKeys):
+                return compact_attention(
+                    module, query, key, value, module.compact_keys, attention_mask, kwargs.get("scaling")
+                )
+            key = torch.cat([module.compact_keys.to_dense().to(key.dtype), key], dim=-2)
+        elif getattr(module, "key_channels", None) is not None and key.shape[-1] < query.shape[-1]:
+            # Decoding with narrowed keys: keep the matching query channels
+            kwargs["scaling"] = query.shape[-1] ** -0.5 if kwargs.get("scaling") is None else kwargs["scaling"]
+            query = narrow_query(query, module.key_channels)
+        elif getattr(module, "key_basis", None) is not None and key.shape[-1] < query.shape[-1]:
+            # Decoding with low-rank keys: project the query onto the same basis
+            kwargs["scaling"] = query.shape[-1] ** -0.5 if kwargs.get("scaling") is None else kwargs["scaling"]
+            query = project_query(query, module.key_basis)
         elif module.masked_key_indices is not None:
             # Decoding: build fake keys k s.t. exp(<q, k>) = 0
             bsz, num_heads, seq_len, head_dim = query.shape
@@ -0,0 +1,565 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+from transformers import DynamicCache
+
+
+def pack_mask(mask: torch.Tensor) -> torch.Tensor:
+    """
+    Bit-pack a boolean mask along its last dimension (a multiple of 8): (..., n) bool -> (..., n // 8) uint8
+    """
+    bits = 2 ** torch.arange(8, dtype=torch.uint8, device=mask.device)
+    return (mask.reshape(*mask.shape[:-1], -1, 8).to(torch.uint8) * bits).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_mask(packed: torch.Tensor) -> torch.Tensor:
+    """
+    Inverse of pack_mask: (..., n // 8) uint8 -> (..., n) bool
+    """
+    bits = 2 ** torch.arange(8, dtype=torch.uint8, device=packed.device)
+    return (packed.unsqueeze(-1) & bits).bool().view(*packed.shape[:-1], -1)
+
+
+def pack_int4(values: torch.Tensor) -> torch.Tensor:
+    """
+    Pack a flat int8 tensor with values in [-7, 7] two values per byte: (n,) int8 -> (ceil(n / 2),) uint8
+    """
+    values = (values + 8).to(torch.uint8)
+    if values.numel() % 2 == 1:
+        values = torch.cat([values, values.new_full((1,), 8)])
+    return values[0::2] | (values[1::2] << 4)
+
+
+def unpack_int4(packed: torch.Tensor, n: int) -> torch.Tensor:
+    """
+    Inverse of pack_int4: (ceil(n / 2),) uint8 -> (n,) int8
+    """
+    values = torch.stack([packed & 15, packed >> 4], dim=-1).view(-1)[:n]
+    return values.to(torch.int8) - 8
+
+
+def chunked_attention_logits(compact_keys, query: torch.Tensor, chunk_size: int = 4096) -> torch.Tensor:
+    """
+    Compute the (bsz, num_key_value_heads, num_key_value_groups * q_len, seq_len) attention logits of the
+    (bsz, num_heads, q_len, head_dim) query against compact keys that can rebuild chunks of tokens (see
+    RaggedKeys.dense_chunk), so that at most chunk_size dense keys per head are alive at a time
+    """
+    bsz, num_heads, q_len, head_dim = query.shape
+    num_key_value_heads = compact_keys.packed_shape[1]
+    query = query.reshape(bsz, num_key_value_heads, num_heads // num_key_value_heads * q_len, head_dim)
+    logits = []
+    for start in range(0, compact_keys.seq_len, chunk_size):
+        keys = compact_keys.dense_chunk(start, chunk_size).to(query.dtype)
+        logits.append(torch.matmul(query, keys.transpose(2, 3)))
+    return torch.cat(logits, dim=-1)
+
+
+@dataclass
+class RaggedKeys:
+    """
+    Ragged key layout where each token only stores the channels it kept.
+    Kept values are flattened in (bsz, num_key_value_heads, seq_len, head_dim) order, and the kept channels of each
+    token are recorded in a bit-packed mask (head_dim / 8 bytes per token).
+    During decoding, keys are rebuilt chunk by chunk for the attention logits (see attention_logits), using the
+    offset in values of the first kept value of each chunk.
+    """
+
+    values: torch.Tensor  # (n_kept,) kept channel values
+    packed_mask: torch.Tensor  # (bsz, num_key_value_heads, seq_len, head_dim // 8) uint8 bit-packed kept channels
+    _chunk_offsets: Optional[tuple] = field(default=None, init=False, repr=False)
+
+    @classmethod
+    def from_mask(cls, keys: torch.Tensor, mask: torch.Tensor) -> "RaggedKeys":
+        """
+        Build the layout from dense keys and a boolean mask of kept channels
+        """
+        assert keys.shape[-1] % 8 == 0, "RaggedKeys bit-packs the mask of kept channels by groups of 8"
+        return cls(values=keys[mask], packed_mask=pack_mask(mask))
+
+    @property
+    def seq_len(self) -> int:
+        return self.packed_mask.shape[2]
+
+    @property
+    def head_dim(self) -> int:
+        return self.packed_mask.shape[3] * 8
+
+    @property
+    def packed_shape(self) -> tuple:
+        return tuple(self.packed_mask.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in (self.values, self.packed_mask))
+
+    def chunk_offsets(self, chunk_size: int) -> torch.Tensor:
+        """
+        (bsz, num_key_value_heads, ceil(seq_len / chunk_size)) offset in values of the first kept value of each chunk
+        of chunk_size tokens, computed once per chunk_size
+        """
+        if self._chunk_offsets is None or self._chunk_offsets[0] != chunk_size:
+            counts = torch.stack(
+                [
+                    unpack_mask(self.packed_mask[:, :, start : start + chunk_size]).sum(dim=(-2, -1))
+                    for start in range(0, self.seq_len, chunk_size)
+                ],
+                dim=-1,
+            )
+            offsets = counts.flatten().cumsum(dim=0) - counts.flatten()
+            self._chunk_offsets = (chunk_size, offsets.view(counts.shape))
+        return self._chunk_offsets[1]
+
+    def dense_chunk(self, start: int, chunk_size: int) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, n, head_dim) keys of the tokens start, ..., start + chunk_size - 1
+        (start is a multiple of chunk_size), pruned channels are set to 0
+        """
+        mask = unpack_mask(self.packed_mask[:, :, start : start + chunk_size])
+        if self.values.numel() == 0:
+            return self.values.new_zeros(mask.shape)
+        flat_mask = mask.flatten(2)
+        offsets = self.chunk_offsets(chunk_size)[:, :, start // chunk_size]
+        indices = offsets.unsqueeze(-1) + flat_mask.cumsum(dim=-1) - 1
+        dense = self.values[indices.clamp_(0, self.values.numel() - 1)]
+        return dense.masked_fill_(~flat_mask, 0).view(mask.shape)
+
+    def attention_logits(self, query: torch.Tensor, chunk_size: int = 4096) -> torch.Tensor:
+        return chunked_attention_logits(self, query, chunk_size)
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, seq_len, head_dim) keys, pruned channels are set to 0
+        """
+        mask = unpack_mask(self.packed_mask)
+        dense = self.values.new_zeros(mask.shape)
+        dense[mask] = self.values
+        return dense
+
+
+@dataclass
+class TieredKeys:
+    """
+    Mixed-precision key layout with two precision tiers. Channels of the high tier are kept in the keys' dtype (as
+    RaggedKeys), all other channels are quantized to int8 or packed int4 with a symmetric per-token scale.
+    During decoding, quantized channels are dequantized chunk by chunk for the attention logits.
+    """
+
+    high: RaggedKeys  # channels kept in the keys' dtype
+    low_values: torch.Tensor  # (n_low,) int8, or (ceil(n_low / 2),) uint8 with two int4 values per byte
+    scales: torch.Tensor  # (bsz, num_key_value_heads, seq_len, 1) per-token quantization scale
+    bits: int
+
+    @classmethod
+    def from_mask(cls, keys: torch.Tensor, mask: torch.Tensor, bits: int = 8) -> "TieredKeys":
+        """
+        Build the layout from dense keys and a boolean mask of the channels of the high tier
+        """
+        assert bits in [4, 8], f"Invalid number of bits `{bits}`. Must be 4 or 8."
+        qmax = 2 ** (bits - 1) - 1
+        low_mask = ~mask
+        scales = keys.abs().masked_fill(mask, 0).amax(dim=-1, keepdim=True).clamp(min=1e-6) / qmax
+        low_values = torch.round(keys[low_mask] / scales.expand_as(keys)[low_mask]).clamp(-qmax, qmax).to(torch.int8)
+        if bits == 4:
+            low_values = pack_int4(low_values)
+        return cls(high=RaggedKeys.from_mask(keys, mask), low_values=low_values, scales=scales, bits=bits)
+
+    @property
+    def seq_len(self) -> int:
+        return self.high.seq_len
+
+    @property
+    def head_dim(self) -> int:
+        return self.high.head_dim
+
+    @property
+    def packed_shape(self) -> tuple:
+        return self.high.packed_shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.high.nbytes + sum(t.numel() * t.element_size() for t in (self.low_values, self.scales))
+
+    def dense_chunk(self, start: int, chunk_size: int) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, n, head_dim) keys of the tokens start, ..., start + chunk_size - 1
+        (start is a multiple of chunk_size), dequantizing the channels of the low tier
+        """
+        bsz, num_key_value_heads, seq_len, _ = self.packed_shape
+        dense = self.high.dense_chunk(start, chunk_size)
+        low_mask = ~unpack_mask(self.high.packed_mask[:, :, start : start + chunk_size]).flatten(2)
+
+        # Low values are flattened in the same order as the high ones: the offset of a chunk is the number of
+        # channels before it minus the number of high values before it
+        rows = torch.arange(bsz * num_key_value_heads, device=dense.device).view(bsz, num_key_value_heads)
+        high_offsets = self.high.chunk_offsets(chunk_size)[:, :, start // chunk_size]
+        offsets = (rows * seq_len + start) * self.head_dim - high_offsets
+        indices = (offsets.unsqueeze(-1) + low_mask.cumsum(dim=-1) - 1).clamp_(min=0)
+        if self.bits == 4:
+            packed = self.low_values[(indices // 2).clamp_(max=max(self.low_values.numel() - 1, 0))]
+            low_values = ((packed >> (4 * (indices % 2)).to(torch.uint8)) & 15).to(torch.int8) - 8
+        else:
+            low_values = self.low_values[indices.clamp_(max=max(self.low_values.numel() - 1, 0))]
+        low_values = low_values.view(dense.shape).to(dense.dtype) * self.scales[:, :, start : start + chunk_size]
+        return torch.where(low_mask.view(dense.shape), low_values, dense)
+
+    def attention_logits(self, query: torch.Tensor, chunk_size: int = 4096) -> torch.Tensor:
+        return chunked_attention_logits(self, query, chunk_size)
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, seq_len, head_dim) keys, dequantizing the channels of the low tier
+        """
+        low_mask = ~unpack_mask(self.high.packed_mask)
+        dense = self.high.to_dense()
+        low_values = self.low_values
+        if self.bits == 4:
+            low_values = unpack_int4(low_values, dense.numel() - self.high.values.numel())
+        dense[low_mask] = low_values.to(dense.dtype) * self.scales.expand_as(dense)[low_mask]
+        return dense
+
+
+@dataclass
+class BucketedKeys:
+    """
+    Key layout where tokens are bucketed by number of kept channels (e.g. the groups of AdaThinK dynamic_group).
+    Bucket i stores the n_i tokens that kept k_i channels as a dense (n_i, k_i) tensor, with its (n_i, k_i) uint8
+    channel-index table and the flat (bsz * num_key_value_heads * seq_len) position of each token.
+    Keys are not rebuilt during decoding: attention_logits computes q · k per bucket over the kept channels only.
+    """
+
+    values: list[torch.Tensor]  # (n_i, k_i) kept channel values
+    channels: list[torch.Tensor]  # (n_i, k_i) uint8 channel index of each kept value
+    positions: list[torch.Tensor]  # (n_i,) flat position of each token
+    shape: tuple  # (bsz, num_key_value_heads, seq_len, head_dim)
+
+    @classmethod
+    def from_mask(cls, keys: torch.Tensor, mask: torch.Tensor) -> "BucketedKeys":
+        """
+        Build the layout from dense keys and a boolean mask of kept channels
+        """
+        shape = tuple(keys.shape)
+        head_dim = shape[-1]
+        assert head_dim <= 256, "BucketedKeys stores channel indices as uint8"
+        keys, mask = keys.reshape(-1, head_dim), mask.reshape(-1, head_dim)
+        counts = mask.sum(dim=-1)
+        all_channels = torch.arange(head_dim, dtype=torch.uint8, device=keys.device)
+
+        values, channels, positions = [], [], []
+        for k in counts.unique().tolist():
+            bucket_positions = torch.nonzero(counts == k).squeeze(1)
+            bucket_mask = mask[bucket_positions]
+            values.append(keys[bucket_positions][bucket_mask].view(-1, k))
+            channels.append(all_channels.expand_as(bucket_mask)[bucket_mask].view(-1, k))
+            positions.append(bucket_positions)
+        return cls(values=values, channels=channels, positions=positions, shape=shape)
+
+    @property
+    def seq_len(self) -> int:
+        return self.shape[2]
+
+    @property
+    def head_dim(self) -> int:
+        return self.shape[3]
+
+    @property
+    def nbytes(self) -> int:
+        tensors = self.values + self.channels + self.positions
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, seq_len, head_dim) keys, pruned channels are set to 0
+        """
+        bsz, num_key_value_heads, seq_len, head_dim = self.shape
+        dense = self.values[0].new_zeros(bsz * num_key_value_heads * seq_len, head_dim)
+        for values, channels, positions in zip(self.values, self.channels, self.positions):
+            dense.index_put_((positions.unsqueeze(-1), channels.long()), values)
+        return dense.view(self.shape)
+
+    def attention_logits(self, query: torch.Tensor, chunk_size: int = 4096) -> torch.Tensor:
+        """
+        Compute the (bsz, num_key_value_heads, num_key_value_groups * q_len, seq_len) attention logits of the
+        (bsz, num_heads, q_len, head_dim) query against the bucketed keys, reading only the kept channels.
+        The kept query channels are gathered for chunk_size tokens at a time. The gathered query is
+        num_key_value_groups * q_len times larger than the kept keys, so this is only cheaper than dense logits for
+        a single query token (see attention_patch).
+        """
+        bsz, num_key_value_heads, seq_len, head_dim = self.shape
+        num_heads, q_len = query.shape[1], query.shape[2]
+        num_key_value_groups = num_heads // num_key_value_heads
+
+        # (bsz * num_key_value_heads, head_dim, num_key_value_groups * q_len)
+        query = query.reshape(bsz * num_key_value_heads, num_key_value_groups * q_len, head_dim).transpose(1, 2)
+        logits = query.new_empty(bsz * num_key_value_heads * seq_len, num_key_value_groups * q_len)
+        for values, channels, positions in zip(self.values, self.channels, self.positions):
+            for start in range(0, len(positions), chunk_size):
+                chunk_values = values[start : start + chunk_size].unsqueeze(1).to(query.dtype)
+                chunk_channels = channels[start : start + chunk_size].long()
+                chunk_positions = positions[start : start + chunk_size]
+                # Gather the kept channels of the query of each token: (chunk_size, k_i, num_key_value_groups * q_len)
+                chunk_query = query[(chunk_positions // seq_len).unsqueeze(-1), chunk_channels]
+                logits[chunk_positions] = torch.matmul(chunk_values, chunk_query).squeeze(1)
+
+        return logits.view(bsz, num_key_value_heads, seq_len, -1).transpose(2, 3)
+
+
+@dataclass
+class ConcatenatedKeys:
+    """
+    Compact key layouts following each other along the sequence, e.g. the prefilled keys and the keys pruned during
+    decoding (see AdaThinKPress.decoding_hook). The object is shared by the cache and the attention module
+    (module.compact_keys), so parts are appended and truncated in place.
+    """
+
+    parts: list
+
+    @property
+    def seq_len(self) -> int:
+        return sum(part.seq_len for part in self.parts)
+
+    @property
+    def head_dim(self) -> int:
+        return self.parts[0].head_dim
+
+    @property
+    def nbytes(self) -> int:
+        return sum(part.nbytes for part in self.parts)
+
+    def to_dense(self) -> torch.Tensor:
+        return torch.cat([part.to_dense() for part in self.parts], dim=2)
+
+    def attention_logits(self, query: torch.Tensor, chunk_size: int = 4096) -> torch.Tensor:
+        bsz, num_heads, q_len, head_dim = query.shape
+        logits = []
+        for part in self.parts:
+            if isinstance(part, BucketedKeys) and q_len > 1:
+                # Bucketed keys are rebuilt for multi-token forwards (see attention_patch)
+                keys = part.to_dense().to(query.dtype)
+                grouped_query = query.reshape(bsz, keys.shape[1], num_heads // keys.shape[1] * q_len, head_dim)
+                logits.append(torch.matmul(grouped_query, keys.transpose(2, 3)))
+            else:
+                logits.append(part.attention_logits(query, chunk_size))
+        return torch.cat(logits, dim=-1)
+
+    def truncate(self, seq_len: int):
+        """
+        Remove the parts after the first seq_len tokens (the first part is always kept)
+        """
+        while len(self.parts) > 1 and self.seq_len - self.parts[-1].seq_len >= seq_len:
+            self.parts.pop()
+
+
+@dataclass
+class NarrowKeys:
+    """
+    Key layout of a per-head static channel subset: every token of head h keeps the same channels, so the keys of
+    the layer are stored as a dense (bsz, num_key_value_heads, seq_len, width) tensor, where width is the largest
+    number of channels kept by a head (heads keeping fewer channels are padded with zero-valued channels).
+    channels gives the channel of each column. Keys appended during decoding are narrowed to the same channels
+    and the attention patch slices the matching query channels, so attention stays a plain dense matmul.
+    """
+
+    values: torch.Tensor  # (bsz, num_key_value_heads, seq_len, width) kept channel values
+    channels: torch.Tensor  # (bsz, num_key_value_heads, width) channel of each column
+    head_dim: int
+
+    @classmethod
+    def from_mask(cls, keys: torch.Tensor, mask: torch.Tensor) -> "NarrowKeys":
+        """
+        Build the layout from dense keys and a (bsz, num_key_value_heads, 1, head_dim) boolean mask of the channels
+        kept by each head
+        """
+        width = int(mask.sum(dim=-1).max())
+        # Kept channels first (in increasing order), then the padding channels
+        order = torch.argsort((~mask).to(torch.uint8), dim=-1, stable=True)[..., :width]
+        values = torch.gather(keys * mask, -1, order.expand(-1, -1, keys.shape[2], -1))
+        return cls(values=values, channels=order.squeeze(2), head_dim=keys.shape[-1])
+
+    @property
+    def seq_len(self) -> int:
+        return self.values.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in (self.values, self.channels))
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, seq_len, head_dim) keys, pruned channels are set to 0
+        """
+        return scatter_channels(self.values, self.channels, self.head_dim)
+
+
+@dataclass
+class ProjectedKeys:
+    """
+    Low-rank key layout: the keys of each head are projected onto a (head_dim, rank) basis (see LowRankKeyPress)
+    and only the (bsz, num_key_value_heads, seq_len, rank) coefficients are stored. Heads of lower rank have zero
+    columns in their basis. Keys appended during decoding are projected onto the same basis and the attention patch
+    projects the query, so the decoding dot products are over rank dimensions.
+    """
+
+    values: torch.Tensor  # (bsz, num_key_value_heads, seq_len, rank) coefficients
+    basis: torch.Tensor  # (bsz, num_key_value_heads, head_dim, rank) orthonormal basis of each head
+
+    @classmethod
+    def from_basis(cls, keys: torch.Tensor, basis: torch.Tensor) -> "ProjectedKeys":
+        return cls(values=torch.matmul(keys, basis), basis=basis)
+
+    @property
+    def seq_len(self) -> int:
+        return self.values.shape[2]
+
+    @property
+    def head_dim(self) -> int:
+        return self.basis.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in (self.values, self.basis))
+
+    def to_dense(self) -> torch.Tensor:
+        """
+        Rebuild the (bsz, num_key_value_heads, seq_len, head_dim) low-rank approximation of the keys
+        """
+        return torch.matmul(self.values, self.basis.transpose(2, 3))
+
+
+def narrow_channels(states: torch.Tensor, channels: torch.Tensor) -> torch.Tensor:
+    """
+    Select the channels (bsz, num_key_value_heads, width) of the (bsz, num_key_value_heads, seq_len, head_dim)
+    states
+    """
+    return torch.gather(states, -1, channels.unsqueeze(2).expand(-1, -1, states.shape[2], -1))
+
+
+def scatter_channels(states: torch.Tensor, channels: torch.Tensor, head_dim: int) -> torch.Tensor:
+    """
+    Inverse of narrow_channels, other channels are set to 0
+    """
+    dense = states.new_zeros(*states.shape[:-1], head_dim)
+    return dense.scatter_(-1, channels.unsqueeze(2).expand(-1, -1, states.shape[2], -1), states)
+
+
+class CompactKeyCache(DynamicCache):
+    """
+    DynamicCache that can hold the prefilled keys of a layer in a compact layout (RaggedKeys, TieredKeys or
+    BucketedKeys).
+    Keys appended during decoding are kept dense in `key_cache`, while `value_cache` always holds the full sequence.
+    Compact keys are not rebuilt by the cache: `update` only returns the dense keys appended after them, and the
+    attention patch (see compact_attention in attention_patch.py) computes their logits from the compact layout
+    (chunk by chunk for RaggedKeys and TieredKeys, bucket by bucket for BucketedKeys).
+    NarrowKeys are stored directly in `key_cache` with their channels in `key_channels`: keys appended during
+    decoding are narrowed to the same channels and the attention patch slices the matching query channels.
+    ProjectedKeys are stored the same way, with their basis in `key_bases`.
+    Keys appended during decoding can be moved to the compact part with append_compact_keys (ConcatenatedKeys).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compact_key_cache: list[Optional[RaggedKeys]] = []
+        self.key_channels: list[Optional[torch.Tensor]] = []
+        self.key_bases: list[Optional[torch.Tensor]] = []
+
+    def get_compact_keys(self, layer_idx: int):
+        if layer_idx < len(self.compact_key_cache):
+            return self.compact_key_cache[layer_idx]
+        return None
+
+    def get_key_channels(self, layer_idx: int) -> Optional[torch.Tensor]:
+        if layer_idx < len(self.key_channels):
+            return self.key_channels[layer_idx]
+        return None
+
+    def get_key_basis(self, layer_idx: int) -> Optional[torch.Tensor]:
+        if layer_idx < len(self.key_bases):
+            return self.key_bases[layer_idx]
+        return None
+
+    def get_compact_length(self, layer_idx: int = 0) -> int:
+        compact_keys = self.get_compact_keys(layer_idx)
+        return 0 if compact_keys is None else compact_keys.seq_len
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return super().get_seq_length(layer_idx) + self.get_compact_length(layer_idx)
+
+    def get_dense_keys(self, layer_idx: int) -> torch.Tensor:
+        """
+        Return the keys of a layer as a dense tensor (compact part followed by the keys appended after it)
+        """
+        compact_keys = self.get_compact_keys(layer_idx)
+        key_channels = self.get_key_channels(layer_idx)
+        key_basis = self.get_key_basis(layer_idx)
+        if key_channels is not None:
+            return scatter_channels(self.key_cache[layer_idx], key_channels, self.value_cache[layer_idx].shape[-1])
+        if key_basis is not None:
+            return torch.matmul(self.key_cache[layer_idx], key_basis.transpose(2, 3))
+        if compact_keys is None:
+            return self.key_cache[layer_idx]
+        return torch.cat([compact_keys.to_dense(), self.key_cache[layer_idx]], dim=-2)
+
+    def store(self, layer_idx: int, keys, values: torch.Tensor):
+        """
+        Store the compressed keys and values of a layer. keys can either be a dense tensor or a compact layout.
+        """
+        while len(self.compact_key_cache) <= layer_idx:
+            self.compact_key_cache.append(None)
+            self.key_channels.append(None)
+            self.key_bases.append(None)
+
+        self.key_channels[layer_idx] = None
+        self.key_bases[layer_idx] = None
+        if isinstance(keys, torch.Tensor):
+            self.compact_key_cache[layer_idx] = None
+            self.key_cache[layer_idx] = keys
+        elif isinstance(keys, NarrowKeys):
+            self.compact_key_cache[layer_idx] = None
+            self.key_channels[layer_idx] = keys.channels
+            self.key_cache[layer_idx] = keys.values
+        elif isinstance(keys, ProjectedKeys):
+            self.compact_key_cache[layer_idx] = None
+            self.key_bases[layer_idx] = keys.basis
+            self.key_cache[layer_idx] = keys.values
+        else:
+            self.compact_key_cache[layer_idx] = keys
+            self.key_cache[layer_idx] = values.new_zeros(*values.shape[:2], 0, keys.head_dim)
+        self.value_cache[layer_idx] = values
+
+    def append_compact_keys(self, layer_idx: int, compact_keys) -> ConcatenatedKeys:
+        """
+        Replace the first compact_keys.seq_len dense keys of a layer, which directly follow its compact keys, by
+        the compact_keys layout. Returns the compact keys of the layer.
+        """
+        prefix = self.compact_key_cache[layer_idx]
+        if not isinstance(prefix, ConcatenatedKeys):
+            prefix = ConcatenatedKeys(parts=[prefix])
+            self.compact_key_cache[layer_idx] = prefix
+        prefix.parts.append(compact_keys)
+        self.key_cache[layer_idx] = self.key_cache[layer_idx][:, :, compact_keys.seq_len :]
+        return prefix
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        key_channels = self.get_key_channels(layer_idx)
+        if key_channels is not None:
+            key_states = narrow_channels(key_states, key_channels)
+        key_basis = self.get_key_basis(layer_idx)
+        if key_basis is not None:
+            key_states = torch.matmul(key_states, key_basis)
+        return super().update(key_states, value_states, layer_idx, cache_kwargs)
+
+    def truncate(self, seq_lengths: list[int]):
+        """
+        Remove the tokens added after seq_lengths[layer_idx], e.g. the generated tokens after answering a question
+        """
+        for layer_idx, sequence_length in enumerate(seq_lengths):
+            compact_keys = self.get_compact_keys(layer_idx)
+            if isinstance(compact_keys, ConcatenatedKeys):
+                compact_keys.truncate(sequence_length)
+            key_length = sequence_length - self.get_compact_length(layer_idx)
+            self.key_cache[layer_idx] = self.key_cache[layer_idx][:, :, :key_length]
+            self.value_cache[layer_idx] = self.value_cache[layer_idx][:, :, :sequence_length]
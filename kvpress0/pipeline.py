@@ -12,6 +12,7 @@ from transformers import AutoModelForCausalLM, Cache, DynamicCache, Pipeline
 from transformers.pipelines import PIPELINE_REGISTRY
 from transformers.pipelines.base import GenericTensor
 
+from kvpress.compact_cache import CompactKeyCache
 from kvpress.presses.base_press import BasePress
 from kvpress.presses.key_rerotation_press import KeyRerotationPress
 from kvpress.presses.observed_attention_press import ObservedAttentionPress
@@ -189,24 +190,25 @@ class KVPressTextGenerationPipeline(Pipeline):
         logger.debug(f"Context Length: {context_length}")
         logger.debug(f"Compressed Context Length: {cache.get_seq_length()}")
 
-        # Greedy decoding for each question
+        # Greedy decoding for each question, the press can compress the generated keys (see BasePress.decoding)
         answers = []
         for question_ids in input_tensors["questions_ids"]:
-            if temperature == 0.0:
-                answer = self.generate_answer(
-                    question_ids=question_ids.to(self.model.device),
-                    cache=cache,
-                    context_length=(cache.get_seq_length() if isinstance(press, KeyRerotationPress) else context_length),
-                    max_new_tokens=max_new_tokens,
-                )
-            else:
-                answer = self.generate_answer_temperature(
-                    question_ids=question_ids.to(self.model.device),
-                    cache=cache,
-                    context_length=(cache.get_seq_length() if isinstance(press, KeyRerotationPress) else context_length),
-                    max_new_tokens=max_new_tokens,
-                    temperature=temperature
-                )
+            with press.decoding(self.model) if press is not None else contextlib.nullcontext():
+                if temperature == 0.0:
+                    answer = self.generate_answer(
+                        question_ids=question_ids.to(self.model.device),
+                        cache=cache,
+                        context_length=(cache.get_seq_length() if isinstance(press, KeyRerotationPress) else context_length),
+                        max_new_tokens=max_new_tokens,
+                    )
+                else:
+                    answer = self.generate_answer_temperature(
+                        question_ids=question_ids.to(self.model.device),
+                        cache=cache,
+                        context_length=(cache.get_seq_length() if isinstance(press, KeyRerotationPress) else context_length),
+                        max_new_tokens=max_new_tokens,
+                        temperature=temperature
+                    )
             answers.append(answer)
 
         return answers
@@ -281,14 +283,17 @@ class KVPressTextGenerationPipeline(Pipeline):
         answer = self.tokenizer.decode(torch.stack(generated_ids), skip_special_tokens=True)
 
         # Remove the generated tokens from the cache
-        cache.key_cache = [
-            cache.key_cache[layer_idx][:, :, :sequence_length]
-            for layer_idx, sequence_length in enumerate(cache_seq_lengths)
-        ]
-        cache.value_cache = [
-            cache.value_cache[layer_idx][:, :, :sequence_length]
-            for layer_idx, sequence_length in enumerate(cache_seq_lengths)
-        ]
+        if isinstance(cache, CompactKeyCache):
+            cache.truncate(cache_seq_lengths)
+        else:
+            cache.key_cache = [
+                cache.key_cache[layer_idx][:, :, :sequence_length]
+                for layer_idx, sequence_length in enumerate(cache_seq_lengths)
+            ]
+            cache.value_cache = [
+                cache.value_cache[layer_idx][:, :, :sequence_length]
+                for layer_idx, sequence_length in enumerate(cache_seq_lengths)
+            ]
         if hasattr(cache, "_quantized_key_cache"):
             cache._quantized_key_cache = [
                 cache._quantized_key_cache[layer_idx][:, :, :sequence_length]
@@ -369,14 +374,17 @@ class KVPressTextGenerationPipeline(Pipeline):
         answer = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
 
         # Remove the generated tokens from the cache
-        cache.key_cache = [
-            cache.key_cache[layer_idx][:, :, :sequence_length]
-            for layer_idx, sequence_length in enumerate(cache_seq_lengths)
-        ]
-        cache.value_cache = [
-            cache.value_cache[layer_idx][:, :, :sequence_length]
-            for layer_idx, sequence_length in enumerate(cache_seq_lengths)
-        ]
+        if isinstance(cache, CompactKeyCache):
+            cache.truncate(cache_seq_lengths)
+        else:
+            cache.key_cache = [
+                cache.key_cache[layer_idx][:, :, :sequence_length]
+                for layer_idx, sequence_length in enumerate(cache_seq_lengths)
+            ]
+            cache.value_cache = [
+                cache.value_cache[layer_idx][:, :, :sequence_length]
+                for layer_idx, sequence_length in enumerate(cache_seq_lengths)
+            ]
         if hasattr(cache, "_quantized_key_cache"):
             cache._quantized_key_cache = [
                 cache._quantized_key_cache[layer_idx][:, :, :sequence_length]
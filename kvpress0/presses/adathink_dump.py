@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+
+import glob
+import os
+import queue
+import threading
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+class AdaThinKDump:
+    """
+    Stream AdaThinK per-layer tensors (keys, masks of kept channels, group indicators, contribution scores) to binary
+    files for offline analysis, replacing the keys.jsonl dump of the legacy analysis code.
+    Tensors are copied to the host without blocking and written on a writer thread, one shard per call of capture:
+        {path}/sample_{sample:05d}/layer_{layer_idx:03d}_shard_{shard:03d}.safetensors (format="safetensors")
+        {path}/sample_{sample:05d}/layer_{layer_idx:03d}_shard_{shard:03d}.{name}.npy (format="npy")
+    A layer processed by chunks (see AdaThinKPress.chunk_size) is written as several shards along the sequence.
+    npy files cannot hold bfloat16, such tensors are saved as float32. Read the files with AdaThinKDumpReader.
+    """
+
+    def __init__(self, path: str, format: str = "safetensors", max_pending: int = 8):
+        assert format in ["safetensors", "npy"], f"Invalid dump format `{format}`"
+        self.path = path
+        self.format = format
+        self.sample = -1
+        self.shards: dict[int, int] = defaultdict(int)
+        self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.error: Optional[Exception] = None
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def next_sample(self):
+        """
+        Start the shards of a new context
+        """
+        self.sample += 1
+        self.shards.clear()
+        os.makedirs(os.path.join(self.path, f"sample_{self.sample:05d}"), exist_ok=True)
+
+    def capture(self, layer_idx: int, **tensors: Optional[torch.Tensor]):
+        """
+        Queue the given tensors of a layer. Device to host copies are asynchronous, the writer thread waits for them
+        """
+        if self.error is not None:
+            raise self.error
+        if self.sample < 0:
+            self.next_sample()
+        host_tensors = {name: t.detach().to("cpu", non_blocking=True) for name, t in tensors.items() if t is not None}
+        event = None
+        if any(t.is_cuda for t in tensors.values() if t is not None):
+            event = torch.cuda.Event()
+            event.record()
+        prefix = f"sample_{self.sample:05d}/layer_{layer_idx:03d}_shard_{self.shards[layer_idx]:03d}"
+        self.shards[layer_idx] += 1
+        self.pending.put((os.path.join(self.path, prefix), host_tensors, event))
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if item is None:
+                    return
+                prefix, tensors, event = item
+                if event is not None:
+                    event.synchronize()
+                if self.format == "safetensors":
+                    save_file({name: t.contiguous() for name, t in tensors.items()}, f"{prefix}.safetensors")
+                else:
+                    for name, t in tensors.items():
+                        t = t.float() if t.dtype == torch.bfloat16 else t
+                        np.save(f"{prefix}.{name}.npy", t.numpy())
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def flush(self):
+        """
+        Wait until all queued tensors are written
+        """
+        self.pending.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.writer.join()
+
+
+class AdaThinKDumpReader:
+    """
+    Memory-mapped reader of the files written by AdaThinKDump: only the requested tensors of a layer are read
+    from disk. safetensors files are returned as torch tensors and npy files as numpy memmaps.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def samples(self) -> list[int]:
+        return sorted(int(p.split("_")[-1]) for p in glob.glob(os.path.join(self.path, "sample_*")))
+
+    def shards(self, sample: int, layer_idx: int) -> list[str]:
+        """
+        Prefixes of the shards of a layer, in sequence order
+        """
+        pattern = os.path.join(self.path, f"sample_{sample:05d}", f"layer_{layer_idx:03d}_shard_*")
+        # Strip the extensions, the first dot of the file name (directories may contain dots)
+        return sorted({os.path.join(os.path.dirname(p), os.path.basename(p).split(".")[0]) for p in glob.glob(pattern)})
+
+    def names(self, sample: int, layer_idx: int) -> list[str]:
+        prefix = self.shards(sample, layer_idx)[0]
+        if os.path.exists(f"{prefix}.safetensors"):
+            with safe_open(f"{prefix}.safetensors", framework="pt") as f:
+                return list(f.keys())
+        return sorted(p[len(prefix) + 1 : -len(".npy")] for p in glob.glob(f"{prefix}.*.npy"))
+
+    def load(self, sample: int, layer_idx: int, name: str, shard: Optional[int] = None):
+        """
+        Load a tensor of a layer. If shard is None, the shards are concatenated along the sequence (dim 2), which
+        reads them into memory; pass shard to keep the memory-mapped tensor of a single shard.
+        """
+        prefixes = self.shards(sample, layer_idx)
+        assert len(prefixes) > 0, f"No dump found for sample {sample} and layer {layer_idx} in {self.path}"
+        if shard is not None:
+            return self._load_shard(prefixes[shard], name)
+        tensors = [self._load_shard(prefix, name) for prefix in prefixes]
+        if len(tensors) == 1:
+            return tensors[0]
+        if isinstance(tensors[0], torch.Tensor):
+            return torch.cat(tensors, dim=2)
+        return np.concatenate(tensors, axis=2)
+
+    def _load_shard(self, prefix: str, name: str):
+        if os.path.exists(f"{prefix}.safetensors"):
+            with safe_open(f"{prefix}.safetensors", framework="pt") as f:
+                return f.get_tensor(name)
+        return np.load(f"{prefix}.{name}.npy", mmap_mode="r")
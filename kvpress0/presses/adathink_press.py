@@ -3,13 +3,22 @@
 
 
 from dataclasses import dataclass, field
-from sklearn.decomposition import PCA
+from functools import partial
+from typing import Optional
 import torch
 from torch import nn
+from transformers import QuantizedCache
 from transformers.models.llama.modeling_llama import rotate_half
 import torch.nn.functional as F
-from kvpress.presses.base_press import BasePress
+from kvpress.compact_cache import BucketedKeys, CompactKeyCache, NarrowKeys, RaggedKeys, TieredKeys
+from kvpress.presses.adathink_dump import AdaThinKDump
+from kvpress.presses.adathink_stats import AdaThinKStats
+from kvpress.presses.base_press import BasePress, get_window_queries
 import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -24,6 +33,51 @@ class AdaThinKPress(BasePress):
     we might implement them in the future, especially if other similar presses are requested.
 
     This press has been reviewed by Yuhui Xu, first author of the ThinK paper.
+
+    When the pipeline is given a CompactKeyCache, zero-filled keys are stored in a compact layout and
+    compression_ratio reports the bytes actually saved in the cache. layout chooses between:
+    - "ragged": RaggedKeys (kept channels and a bit-packed mask of kept channels), rebuilt densely by the cache
+    - "bucketed": BucketedKeys (one dense tensor per number of kept channels, e.g. per group of dynamic_group),
+      decoding only reads the kept channels (see compact_attention)
+
+    If low_precision_bits is 8 or 4, pruned channels are quantized instead of being dropped: selected channels stay
+    in the keys' dtype and the others are stored in int8 or packed int4 with per-token scales (TieredKeys). Without
+    a CompactKeyCache, the quantized channels are dequantized in place to measure the accuracy of the tiers.
+    This assumes the "zero" fill, as refilled channels cannot be told apart from selected ones.
+
+    selection chooses how channels are selected per token:
+    - "score": dynamic_score_selection_norm (threshold groups, budgets and fill strategies)
+    - "cumsum": token_wise_cumsum_selection, keep the channels carrying threshold_ratio of the energy of each token
+    - "profile": profile_selection, group budgets read from the calibration profile file given in profile (see
+      calibrate.py) instead of the hard-coded GROUP_PRESETS: tokens are assigned to the groups of their layer and
+      head by their threshold position, and keep the channel ratio calibrated for their group. Profiles with a
+      single group keep a per-layer, per-head number of channels, without any threshold search
+    - "head": head_channel_selection, keep one static channel subset per head (variable width per head). With a
+      CompactKeyCache, keys are stored as NarrowKeys, physically narrower tensors read by a dense attention on the
+      sliced query channels, reducing both memory and FLOPs during decoding
+
+    fill names the strategy used to refill the pruned channels (see FILL_STRATEGIES, e.g. "zero", "pca",
+    "exponential_attn"). If None, it is derived from the legacy pooling_ratio values (see POOLING_RATIO_FILLS).
+
+    If chunk_size > 0, channels are selected chunk_size tokens at a time and written into the output keys, so the
+    selection temporaries are O(chunk_size) instead of O(seq_len). Results match the unchunked path, except for
+    the fills in SEQUENCE_FILLS that use statistics over the whole sequence and the "head" selection, which are
+    never chunked.
+
+    Kept channel counts and group histograms are accumulated on device in self.stats (see AdaThinKStats), use
+    press.stats.summary(), to_json() or to_npz() after generation. Set verbose=True to print them at each layer.
+    self.stats is reset at the prefill of each request, unless accumulate_stats is True, in which case it sums the
+    statistics of all the requests (e.g. over a dataset, see calibrate.py and eval.py --save_stats).
+
+    If dump_format is "safetensors" or "npy" and outpath is set, the keys, masks of kept channels, group indicators
+    and contribution scores of every layer are written under outpath/dump on a writer thread (see AdaThinKDump and
+    AdaThinKDumpReader). Call press.dump.close() after generation to wait for the last files.
+
+    If decode_interval > 0, the keys appended while the answers are generated are also pruned, decode_interval
+    tokens at a time, with the window queries of the prefill (see decoding_hook). If the layer holds compact keys,
+    the pruned decoding keys are appended to them in the same layout (ConcatenatedKeys), otherwise they are written
+    in place in the dense cache. Layers whose keys are narrowed (NarrowKeys) or projected (ProjectedKeys) are not
+    pruned during decoding. Decoding keys are not counted in self.stats nor written to the dump.
     """
 
     key_channel_compression_ratio: float = 0.0
@@ -33,6 +87,29 @@ class AdaThinKPress(BasePress):
     pooling_ratio: float = 0.0
     mode: str = field(init=False, default=None)
     outpath: str = field(init=False, default=None)
+    n_components: int = 10
+    selection: str = "score"
+    verbose: bool = False
+    fill: Optional[str] = None
+    layout: str = "ragged"
+    low_precision_bits: int = 0
+    profile: Optional[str] = None
+    chunk_size: int = 0
+    dump_format: Optional[str] = None
+    decode_interval: int = 0
+    accumulate_stats: bool = False
+
+    def __post_init__(self):
+        assert self.low_precision_bits in [0, 4, 8], f"Invalid low_precision_bits `{self.low_precision_bits}`"
+        assert self.layout in ["ragged", "bucketed"], f"Invalid layout `{self.layout}`"
+        assert self.selection in ["score", "cumsum", "profile", "head"], f"Invalid selection `{self.selection}`"
+        assert self.fill is None or self.fill in FILL_STRATEGIES, f"Invalid fill `{self.fill}`"
+        self.profile_layers = None
+        self.compression_ratios = []
+        self.stats = AdaThinKStats(verbose=self.verbose)
+        self.dump = None
+        self.window_queries = {}  # layer_idx -> prefill window queries, used by decoding_hook
+        self.decoded_lengths = {}  # layer_idx -> number of keys of cache.key_cache already pruned
 
     def compute_window_queries(self, module, hidden_states, position_embeddings):
         """
@@ -73,8 +150,23 @@ class AdaThinKPress(BasePress):
         If other similar presses are requested, we might create a generic compress method for dimension pruning
         to avoid code duplication.
         """
-        if self.key_channel_compression_ratio == 0 and self.threshold_ratio == 0 and self.pooling_ratio == 0:
-            print('error !!!!*****')
+        if module.layer_idx == 0:
+            self.compression_ratios = []
+            self.window_queries, self.decoded_lengths = {}, {}
+            if not self.accumulate_stats:
+                self.stats.reset()
+            if self.dump_format is not None and self.outpath is not None:
+                if self.dump is None:
+                    self.dump = AdaThinKDump(os.path.join(self.outpath, "dump"), self.dump_format)
+                self.dump.next_sample()
+
+        no_budget = self.key_channel_compression_ratio == 0 and self.threshold_ratio == 0 and self.pooling_ratio == 0
+        if no_budget and self.selection != "profile":
+            if module.layer_idx == 0:
+                logger.warning(
+                    f"AdaThinKPress(mode={self.mode!r}, selection={self.selection!r}) has no channel budget: set "
+                    "key_channel_compression_ratio, threshold_ratio or pooling_ratio. Keys are not compressed."
+                )
             return keys, values
 
         # Compute scores per dimension
@@ -96,7 +188,10 @@ class AdaThinKPress(BasePress):
         # keys_norm = torch.pow(keys, 2).mean(dim=2)
         # key_scores = queries_norm * keys_norm  # (bsz, num_key_value_heads, head_dim)
         # breakpoint()
-        queries = self.compute_window_queries(module, kwargs["hidden_states"], kwargs["position_embeddings"])
+        # Queries captured by the attention forward, recomputed if unavailable
+        queries = get_window_queries(kwargs, self.window_size)
+        if queries is None:
+            queries = self.compute_window_queries(module, kwargs["hidden_states"], kwargs["position_embeddings"])
         queries_expand = queries.view(bsz, num_key_value_heads, num_key_value_groups, self.window_size,module.head_dim).mean(2)
         # keys_expand = keys.unsqueeze(2).repeat(1, 1, num_key_value_groups, 1, 1).view(bsz, module.config.num_attention_heads, q_len, head_dim)
         # queries_norm = torch.pow(queries, 2).mean(dim=2) # (bsz, num_heads, self.window_size, head_dim)
@@ -139,15 +234,19 @@ class AdaThinKPress(BasePress):
         # module.layer_idx
         # breakpoint()
         # bsz, num_heads, seq_len, head_dim = keys.shape
-        # keys_dict = {f"{module.layer_idx}": {}}
-        # for head_idx in range(num_heads):
-        #     json_obj = {head_idx: keys[0, head_idx, :, :].tolist()}
-        #     keys_dict[f"{module.layer_idx}"].update(json_obj)
-
-        # output_file = f"{self.outpath}/keys.jsonl"
-        # with open(output_file, "a+") as f:
-        #     f.write(json.dumps(keys_dict) + "\n")
-        pruned_keys = dynamic_score_selection_norm(queries_expand, keys, self.threshold_ratio, self.key_channel_compression_ratio, self.pooling_ratio)
+        if self.decode_interval > 0:
+            self.window_queries[module.layer_idx] = queries_expand
+
+        fill = self.fill if self.fill is not None else fill_from_pooling_ratio(self.pooling_ratio, self.threshold_ratio)
+        sequence_selection = self.selection == "head" or (self.selection == "score" and fill in SEQUENCE_FILLS)
+        if self.chunk_size > 0 and not sequence_selection:
+            # Channels are selected token by token, so chunks only bound the size of the temporaries
+            pruned_keys = torch.empty_like(keys)
+            for start in range(0, q_len, self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                pruned_keys[:, :, chunk] = self.select_channels(module, queries_expand, keys[:, :, chunk], fill)
+        else:
+            pruned_keys = self.select_channels(module, queries_expand, keys, fill)
         # pruned_keys = dynamic_score_selection(queries_expand, keys, self.threshold_ratio, self.key_channel_compression_ratio, self.pooling_ratio)
         
         # pruned_keys = prune_keys_to_norm(keys, queries_norm)
@@ -158,116 +257,197 @@ class AdaThinKPress(BasePress):
         # indices = indices.unsqueeze(2).expand(-1, -1, q_len, -1)
         # keys = keys.scatter_(-1, indices, 0)
 
+        if self.low_precision_bits > 0:
+            # Pruned channels form the low precision tier
+            tiered_keys = TieredKeys.from_mask(keys, pruned_keys != 0, self.low_precision_bits)
+            if isinstance(kwargs["past_key_value"], CompactKeyCache):
+                return self.compact(keys, values, tiered_keys), values
+            return tiered_keys.to_dense(), values
+
+        if isinstance(kwargs["past_key_value"], CompactKeyCache):
+            if self.selection == "head":
+                narrow_keys = NarrowKeys.from_mask(pruned_keys, (pruned_keys != 0).any(dim=2, keepdim=True))
+                return self.compact(pruned_keys, values, narrow_keys), values
+            return self.compact(pruned_keys, values), values
+
         return pruned_keys, values
 
+    @property
+    def compresses_decoding(self) -> bool:
+        return self.decode_interval > 0
+
+    def decoding_hook(self, module: nn.Module, input: list[torch.Tensor], kwargs: dict, output: list):
+        """
+        Once decode_interval keys were appended to the cache since the last pruning, prune them in place with the
+        channel selection of the prefill, reusing its window queries (or per-head profile budgets).
+        """
+        cache = kwargs["past_key_value"]
+        layer_idx = module.layer_idx
+        if layer_idx not in self.window_queries or isinstance(cache, QuantizedCache):
+            return output
+        if isinstance(cache, CompactKeyCache) and (
+            cache.get_key_channels(layer_idx) is not None or cache.get_key_basis(layer_idx) is not None
+        ):
+            # Keys appended to NarrowKeys or ProjectedKeys are already narrowed or projected by the cache
+            return output
+
+        keys = cache.key_cache[layer_idx]
+        fill = self.fill if self.fill is not None else fill_from_pooling_ratio(self.pooling_ratio, self.threshold_ratio)
+        if isinstance(cache, CompactKeyCache) and cache.get_compact_keys(layer_idx) is not None:
+            # All the dense keys follow the compact keys: once decode_interval are pending, they are pruned and
+            # moved to the compact part of the cache
+            if keys.shape[2] >= self.decode_interval:
+                pruned_keys = self.select_channels(module, self.window_queries[layer_idx], keys, fill, track=False)
+                if self.low_precision_bits > 0:
+                    compact_keys = TieredKeys.from_mask(keys, pruned_keys != 0, self.low_precision_bits)
+                else:
+                    layout_cls = BucketedKeys if self.layout == "bucketed" else RaggedKeys
+                    compact_keys = layout_cls.from_mask(pruned_keys, pruned_keys != 0)
+                module.compact_keys = cache.append_compact_keys(layer_idx, compact_keys)
+            return output
+
+        key_len, q_len = keys.shape[2], kwargs["hidden_states"].shape[1]
+        # Keys cached before this forward pass are pruned, or were removed when the previous answer was truncated
+        start = min(self.decoded_lengths.get(layer_idx, key_len - q_len), key_len - q_len)
+        if key_len - start >= self.decode_interval:
+            new_keys = keys[:, :, start:]
+            pruned_keys = self.select_channels(module, self.window_queries[layer_idx], new_keys, fill, track=False)
+            if self.low_precision_bits > 0:
+                pruned_keys = TieredKeys.from_mask(new_keys, pruned_keys != 0, self.low_precision_bits).to_dense()
+            keys[:, :, start:] = pruned_keys
+            start = key_len
+        self.decoded_lengths[layer_idx] = start
+        return output
+
+    def select_channels(self, module: nn.Module, queries: torch.Tensor, keys: torch.Tensor, fill: str, track: bool = True) -> torch.Tensor:
+        """
+        Select the channels of keys (all tokens or a chunk of tokens) and return the pruned keys. If track is False
+        (decoding keys), the selection is neither counted in self.stats nor written to the dump.
+        """
+        stats, dump = (self.stats, self.dump) if track else (None, None)
+        if self.selection == "score":
+            return dynamic_score_selection_norm(queries, keys, self.threshold_ratio, self.key_channel_compression_ratio, self.pooling_ratio, self.n_components, stats, module.layer_idx, fill, dump)
+        elif self.selection == "cumsum":
+            pruned_keys = token_wise_cumsum_selection(queries, keys, self.threshold_ratio, stats, module.layer_idx)
+        elif self.selection == "profile":
+            boundaries, keep_channels = self.profile_budgets(module.layer_idx, keys.shape[-1], keys.device)
+            pruned_keys = profile_selection(queries, keys, boundaries, keep_channels, stats, module.layer_idx)
+        elif self.selection == "head":
+            pruned_keys = head_channel_selection(queries, keys, self.threshold_ratio, self.key_channel_compression_ratio, stats, module.layer_idx)
+        else:
+            raise ValueError(f"Invalid selection `{self.selection}`. Must be 'score', 'cumsum', 'profile' or 'head'.")
+        if dump is not None:
+            dump.capture(module.layer_idx, keys=keys, mask=pruned_keys != 0)
+        return pruned_keys
+
+    def profile_budgets(self, layer_idx: int, head_dim: int, device: torch.device) -> tuple:
+        """
+        Group budgets of each head of a layer, from the calibration profile (loaded on first use):
+        - boundaries: (num_heads, n_groups - 1) int64 group boundaries in channels, or None for single-group profiles
+        - keep_channels: (num_heads, n_groups) int16 number of channels kept by the tokens of each group
+        """
+        if self.profile_layers is None:
+            assert self.profile is not None, "selection='profile' requires a calibration profile"
+            with open(self.profile, "r") as f:
+                layers = json.load(f)["layers"]
+            self.profile_layers = {int(layer_idx): layer for layer_idx, layer in layers.items()}
+        layer = self.profile_layers[layer_idx]
+        if len(layer.get("boundaries", [[]])[0]) == 0:
+            keep_ratios = torch.tensor(layer["keep_ratio"], device=device).unsqueeze(-1)
+            return None, torch.ceil(keep_ratios * head_dim).clamp(1, head_dim).to(torch.int16)
+        boundaries = torch.round(torch.tensor(layer["boundaries"], device=device) * head_dim).long()
+        keep_ratios = torch.tensor(layer["group_keep_ratios"], device=device)
+        return boundaries, torch.ceil(keep_ratios * head_dim).clamp(1, head_dim).to(torch.int16)
+
+    def compact(self, keys: torch.Tensor, values: torch.Tensor, compact_keys=None):
+        """
+        Store only the non-zero channels of the pruned keys, or the given compact_keys. If the layout is not smaller
+        than the dense keys (e.g. when pruned channels are refilled), the dense keys are kept.
+        """
+        dense_nbytes = keys.numel() * keys.element_size()
+        values_nbytes = values.numel() * values.element_size()
+        if compact_keys is None:
+            layout_cls = BucketedKeys if self.layout == "bucketed" else RaggedKeys
+            compact_keys = layout_cls.from_mask(keys, keys != 0)
+        if compact_keys.nbytes >= dense_nbytes:
+            self.compression_ratios.append(0.0)
+            return keys
+
+        self.compression_ratios.append(1 - (compact_keys.nbytes + values_nbytes) / (dense_nbytes + values_nbytes))
+        return compact_keys
+
     @property
     def compression_ratio(self):
+        if len(self.compression_ratios) > 0:
+            return sum(self.compression_ratios) / len(self.compression_ratios)
         return self.key_channel_compression_ratio / 2
 
     @compression_ratio.setter
     def compression_ratio(self, value):
         raise AttributeError(f"compression ratio cannot be set for {type(self).__name__}")
 
-def dynamic_score_selection_norm(queries, keys, threshold_ratio=0, key_channel_compression_ratio=0, pooling_ratio=0):
+def dynamic_score_selection_norm(queries, keys, threshold_ratio=0, key_channel_compression_ratio=0, pooling_ratio=0, n_components=10, stats=None, layer_idx=0, fill=None, dump=None):
     bsz, num_heads, seq_len, head_dim = keys.shape
     # queries_norm = torch.nn.functional.normalize(queries, dim=-1)
     # keys_norm = torch.nn.functional.normalize(keys, dim=-1)
     
     q_norm = torch.norm(queries, dim=-2, p=2).unsqueeze(-2)
-    k_norm = torch.pow(keys, 2)
-    sorted_indices = torch.argsort(k_norm * q_norm, dim=-1, descending=True)
-    contributions = torch.pow(keys, 2) * torch.norm(queries, dim=-2, p=2).unsqueeze(-2)
-    group_indicator = torch.zeros(bsz, num_heads, seq_len).to(queries.device)
+    contributions = torch.pow(keys, 2) * q_norm
+    sorted_indices = torch.argsort(contributions, dim=-1, descending=True)
+    ranks = channel_ranks(sorted_indices)  # uint8 ranks are kept instead of the int64 sorted_indices
+    group_indicator = torch.zeros(bsz, num_heads, seq_len, dtype=torch.uint8, device=keys.device)
     topk_ratios = [key_channel_compression_ratio]
     topk = head_dim - int(key_channel_compression_ratio * head_dim)
     if threshold_ratio != 0:
-        sorted_contributions = torch.gather(contributions, dim=-1, index=sorted_indices)
-        cumulative_scores = torch.cumsum(sorted_contributions, dim=-1)
-        is_above_threshold = cumulative_scores > (0.99 * cumulative_scores[..., -1]).unsqueeze(-1)
-        threshold_indices = is_above_threshold.to(torch.float32).argmax(dim=-1)
-        if threshold_ratio == 0.99:
-            mask, topk_ratios, group_indicator = dynamic_group(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.990:
-            mask, topk_ratios, group_indicator = dynamic_group0(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.991:
-            mask, topk_ratios, group_indicator = dynamic_group1(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.992:
-            mask, topk_ratios, group_indicator = dynamic_group2(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.9922:
-            mask, topk_ratios, group_indicator = dynamic_group22(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.993:
-            mask, topk_ratios, group_indicator = dynamic_group3(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.994:
-            mask, topk_ratios, group_indicator = dynamic_group4(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.995:
-            mask, topk_ratios, group_indicator = dynamic_group5(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.996:
-            mask, topk_ratios, group_indicator = dynamic_group6(is_above_threshold, head_dim, keys, sorted_indices)
-        elif threshold_ratio == 0.997:
-            mask, topk_ratios, group_indicator = dynamic_group7(is_above_threshold, head_dim, keys, sorted_indices)
+        cumulative_scores = torch.cumsum(torch.gather(contributions, dim=-1, index=sorted_indices), dim=-1)
+        del sorted_indices
+        # Position of the first channel for which the cumulative score is above 0.99 of the total
+        threshold_indices = torch.searchsorted(cumulative_scores, 0.99 * cumulative_scores[..., -1:], right=True)
+        threshold_indices = threshold_indices.squeeze(-1).clamp(max=head_dim - 1)
+        del cumulative_scores
+        if threshold_ratio in THRESHOLD_GROUP_PRESETS:
+            boundaries, topk_ratios = GROUP_PRESETS[THRESHOLD_GROUP_PRESETS[threshold_ratio]]
+            mask, topk_ratios, group_indicator = dynamic_group(threshold_indices, ranks, boundaries, topk_ratios)
         else:
-            mask = create_mask_by_threshold(sorted_indices, threshold_indices)
+            mask = ranks <= threshold_indices.unsqueeze(-1)  # same as create_mask_by_threshold
 
-        num_selected_channels = torch.sum(mask).item()
-        print(f"Number of selected channels: {num_selected_channels}")
-        selected_channels_per_token = torch.sum(mask, dim=-1)
-        print(f"Selected channels per token shape: {selected_channels_per_token}")
-        print(f"Example: Selected channels for [batch=0, head=0, token=0]: {selected_channels_per_token[0, 0, 0].item()}")
+        if stats is not None:
+            stats.update(layer_idx, mask, group_indicator, len(topk_ratios), threshold_indices)
     else:
         mask = torch.ones_like(keys, dtype=torch.bool)
         mask.scatter_(-1, sorted_indices[..., -int(key_channel_compression_ratio * head_dim):], False)
+        del sorted_indices
+        if stats is not None:
+            stats.update(layer_idx, mask)
 
 
-    if pooling_ratio == 0.5:
-        return generate_pca_fill(keys.to(torch.float32), mask).to(keys.dtype)
-    elif pooling_ratio == 0.3:
-        return generate_interpolated_fill(keys, mask)
-    elif pooling_ratio == 0.9:
-        return gamma(keys, ~mask)
-    elif pooling_ratio == 0.7:
-        return normal(keys, ~mask)
-    elif pooling_ratio == 0.75:
-        return normal_attn(contributions, q_norm, keys, ~mask, sorted_indices, topk)
-    elif pooling_ratio == 0.755 or pooling_ratio == 0.754:
-        return normal_attn(contributions, q_norm, keys, ~mask, sorted_indices, topk, False)
-    elif pooling_ratio == 0.7555 or pooling_ratio == 0.7554:
-        return normal_attn(contributions, q_norm, keys, ~mask, sorted_indices, topk, False, True)
-    elif pooling_ratio == 0.6:
-        return exponential(keys, ~mask)
-    elif pooling_ratio == 0.65:
-        return exponential_attn(contributions, q_norm, keys, ~mask, sorted_indices, topk)
-    elif pooling_ratio == 0.654 or pooling_ratio == 0.6555:
-        return exponential_attn(contributions, q_norm, keys, ~mask, sorted_indices, topk, False)
-    elif pooling_ratio == 0.6556 or pooling_ratio == 0.6554:
-        return exponential_attn(contributions, q_norm, keys, ~mask, sorted_indices, topk, False, True)
-    elif pooling_ratio == threshold_ratio:
-        return exponential_attn_grouped(contributions, q_norm, keys, ~mask, sorted_indices, group_indicator, topk_ratios, True, False)
-    
-    pruned_keys = keys * mask
-    return pruned_keys
+    if dump is not None:
+        dump.capture(layer_idx, keys=keys, mask=mask, group_indicator=group_indicator, contributions=contributions)
+
+    if fill is None:
+        fill = fill_from_pooling_ratio(pooling_ratio, threshold_ratio)
+    ctx = FillContext(keys, mask, q_norm, contributions, ranks, topk, group_indicator, topk_ratios, n_components)
+    return FILL_STRATEGIES[fill](ctx)
 
-def dynamic_score_selection(queries, keys, threshold_ratio=0, key_channel_compression_ratio=0, pooling_ratio=0):
+def dim_contribution_norms(queries, keys):
+    """
+    Norm over the query window of the attention scores restricted to each channel, in closed form:
+    ||queries[..., :, d] * keys[..., t, d]|| = |keys[..., t, d]| * ||queries[..., :, d]||
+    Returns a (bsz, num_heads, key_len, head_dim) tensor, O(key_len * head_dim) instead of head_dim matmuls.
+    """
+    return keys.abs() * torch.norm(queries, dim=-2, p=2).unsqueeze(-2)
+
+def dynamic_score_selection(queries, keys, threshold_ratio=0, key_channel_compression_ratio=0, pooling_ratio=0, stats=None, layer_idx=0):
     bsz, num_heads, seq_len, head_dim = keys.shape
     queries_norm = torch.nn.functional.normalize(queries, dim=-1)
     keys_norm = torch.nn.functional.normalize(keys, dim=-1)
     attention_scores = torch.matmul(queries_norm, keys_norm.transpose(-1, -2))
     original_norm = torch.norm(attention_scores, dim=-2, p=2).unsqueeze(-1)
 
-    dim_contributions = []
-    contributions = []
-    for d in range(queries.size(-1)):
-        keys_masked = torch.zeros_like(keys_norm)
-        keys_masked[..., d] = keys_norm[..., d]
-
-        attention_scores_masked = torch.matmul(queries_norm, keys_masked.transpose(-1, -2))
-        masked_norm = torch.norm(attention_scores_masked, dim=-2, p=2)
-        contribution = masked_norm / original_norm.squeeze(-1)
-        dim_contributions.append(masked_norm)
-        contributions.append(contribution)
-    dim_contributions = torch.stack(dim_contributions, dim=-1)
+    dim_contributions = dim_contribution_norms(queries_norm, keys_norm)
+    contributions = dim_contributions / original_norm
     sorted_indices = torch.argsort(dim_contributions, dim=-1, descending=True)
     if threshold_ratio != 0:
-        contributions = torch.stack(contributions, dim=-1)
         sorted_contributions = torch.gather(contributions, dim=-1, index=sorted_indices)
         cumulative_scores = torch.cumsum(sorted_contributions, dim=-1)
         is_above_threshold = cumulative_scores > (threshold_ratio * cumulative_scores[..., -1]).unsqueeze(-1)
@@ -276,399 +456,109 @@ def dynamic_score_selection(queries, keys, threshold_ratio=0, key_channel_compre
     else:
         mask = torch.ones_like(keys, dtype=torch.bool)
         mask.scatter_(-1, sorted_indices[..., -int(key_channel_compression_ratio * head_dim):], False)
-    if pooling_ratio == 0.5:
-        return generate_pca_fill(keys.to(torch.float32), mask).to(keys.dtype)
-    elif pooling_ratio == 0.3:
-        return generate_interpolated_fill(keys, mask)
-    elif pooling_ratio == 0.9:
-        return gamma(keys, ~mask)
-    elif pooling_ratio == 0.7:
-        return normal(keys, ~mask)
-    elif pooling_ratio == 0.75:
-        return normal_attn(dim_contributions, queries_norm, keys, ~mask, int(key_channel_compression_ratio * head_dim))
-    elif pooling_ratio == 0.6:
-        return exponential(keys, ~mask)
-    elif pooling_ratio == 0.65:
-        return exponential_attn(attention_scores, queries_norm, keys, ~mask)
-    elif pooling_ratio == 0.99:
-        return dynamic_group()
-    num_selected_channels = torch.sum(mask).item()
-    print(f"Number of selected channels: {num_selected_channels}")
-    selected_channels_per_token = torch.sum(mask, dim=-1)
-    print(f"Selected channels per token shape: {selected_channels_per_token}")
-    print(f"Example: Selected channels for [batch=0, head=0, token=0]: {selected_channels_per_token[0, 0, 0].item()}")
-
-    pruned_keys = keys * mask
-    return pruned_keys
+    if stats is not None:
+        stats.update(layer_idx, mask)
+    q_norm = torch.norm(queries_norm, dim=-2, p=2).unsqueeze(-2)
+    topk = head_dim - int(key_channel_compression_ratio * head_dim)
+    ctx = FillContext(keys, mask, q_norm, dim_contributions, channel_ranks(sorted_indices), topk)
+    return FILL_STRATEGIES[POOLING_RATIO_FILLS.get(pooling_ratio, "zero")](ctx)
+
+# Group presets: (group boundaries, keep ratios). A token whose 0.99 cumulative contribution is reached at sorted
+# position p is assigned to group g such that int(boundaries[g - 1] * head_dim) < p <= int(boundaries[g] * head_dim),
+# and keeps its int(keep_ratios[g] * head_dim) most contributing channels.
+GROUP_PRESETS = {
+    "group": ([0.2, 0.4, 0.6, 0.8], [0.1, 0.3, 0.5, 0.7, 0.9]),
+    "group0": ([0.2, 0.4, 0.6, 0.8], [0.2, 0.4, 0.6, 0.8, 1.0]),
+    "group1": ([0.25, 0.5, 0.75], [0.25, 0.5, 0.75, 1.0]),
+    "group2": ([0.25, 0.3, 0.35, 0.4], [0.2, 0.3, 0.35, 0.4, 0.5]),
+    "group22": ([0.2, 0.3, 0.4, 0.5, 0.6, 0.8], [0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0]),
+    "group3": ([0.2, 0.3, 0.4, 0.5], [0.2, 0.3, 0.4, 0.5, 0.6]),
+    "group4": ([0.3, 0.4, 0.5], [0.3, 0.4, 0.5, 0.6]),
+    "group5": ([0.3, 0.4, 0.5, 0.6], [0.3, 0.4, 0.5, 0.6, 0.7]),
+    "group6": ([0.25, 0.3, 0.35, 0.4, 0.6], [0.2, 0.25, 0.3, 0.35, 0.4, 0.5]),
+    "group7": ([0.3, 0.4, 0.5, 0.7], [0.3, 0.35, 0.4, 0.45, 0.5]),
+}
+
+# threshold_ratio values selecting a group preset. Note that 0.990 == 0.99, so "group0" can only be used by name.
+THRESHOLD_GROUP_PRESETS = {
+    0.99: "group",
+    0.991: "group1",
+    0.992: "group2",
+    0.9922: "group22",
+    0.993: "group3",
+    0.994: "group4",
+    0.995: "group5",
+    0.996: "group6",
+    0.997: "group7",
+}
+
+
+def channel_ranks(sorted_indices):
+    """
+    Invert sorted_indices: ranks[..., c] is the position of channel c in the descending contribution order.
+    Ranks are stored as uint8 (int16 if head_dim > 256), 8x smaller than the int64 sorted_indices.
+    """
+    head_dim = sorted_indices.shape[-1]
+    dtype = torch.uint8 if head_dim <= 256 else torch.int16
+    positions = torch.arange(head_dim, dtype=dtype, device=sorted_indices.device).expand_as(sorted_indices)
+    return torch.empty_like(sorted_indices, dtype=dtype).scatter_(-1, sorted_indices, positions)
 
-def dynamic_group(is_above_threshold, head_dim, keys, sorted_indices):
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
 
-    group_indicator[first_above_threshold_idx <= int(0.2 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.2 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.6 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.6 * head_dim)) & (first_above_threshold_idx <= int(0.8 * head_dim))] = 3
-    group_indicator[first_above_threshold_idx > int(0.8 * head_dim)] = 4
+def dynamic_group(first_above_threshold_idx, ranks, boundaries, topk_ratios):
+    """
+    Assign each token to a group with a single bucketize over the group boundaries, then keep the top
+    int(topk_ratios[group] * head_dim) channels of each token with a single comparison against the channel ranks.
+    The group of each token is returned as uint8.
+    """
+    head_dim = ranks.shape[-1]
+    device = ranks.device
 
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.1, 0.3, 0.5, 0.7, 0.9]
-    for group_id, ratio in zip([0, 1, 2, 3, 4], topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
-
-def dynamic_group22(is_above_threshold, head_dim, keys, sorted_indices):
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.2 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.2 * head_dim)) & (first_above_threshold_idx <= int(0.3 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.5 * head_dim))] = 3
-    group_indicator[(first_above_threshold_idx > int(0.5 * head_dim)) & (first_above_threshold_idx <= int(0.6 * head_dim))] = 4
-    group_indicator[(first_above_threshold_idx > int(0.6 * head_dim)) & (first_above_threshold_idx <= int(0.8 * head_dim))] = 5
-    group_indicator[first_above_threshold_idx > int(0.8 * head_dim)] = 6
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
-
-def dynamic_group3(is_above_threshold, head_dim, keys, sorted_indices):
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.2 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.2 * head_dim)) & (first_above_threshold_idx <= int(0.3 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.5 * head_dim))] = 3
-    group_indicator[first_above_threshold_idx > int(0.5 * head_dim)] = 4
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.2, 0.3, 0.4, 0.5, 0.6]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
-
-def dynamic_group4(is_above_threshold, head_dim, keys, sorted_indices):
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.3 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.5 * head_dim))] = 2
-    group_indicator[first_above_threshold_idx > int(0.5 * head_dim)] = 3
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.3, 0.4, 0.5, 0.6]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
-
-def dynamic_group5(is_above_threshold, head_dim, keys, sorted_indices):
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.3 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.5 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.5 * head_dim)) & (first_above_threshold_idx <= int(0.6 * head_dim))] = 3
-    group_indicator[first_above_threshold_idx > int(0.6 * head_dim)] = 4
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.3, 0.4, 0.5, 0.6, 0.7]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
+    boundaries = torch.tensor([int(b * head_dim) for b in boundaries], device=device)
+    keep_channels = torch.tensor([int(r * head_dim) for r in topk_ratios], dtype=torch.int16, device=device)
+    group_indicator = torch.bucketize(first_above_threshold_idx, boundaries)
 
-def dynamic_group0(is_above_threshold, head_dim, keys, sorted_indices):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.2 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.2 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.6 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.6 * head_dim)) & (first_above_threshold_idx <= int(0.8 * head_dim))] = 3
-    group_indicator[first_above_threshold_idx > int(0.8 * head_dim)] = 4
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.2, 0.4, 0.6, 0.8, 1.0]
-    for group_id, ratio in zip([0, 1, 2, 3, 4], topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
+    total_mask = ranks < keep_channels[group_indicator].unsqueeze(-1)
+    return total_mask, topk_ratios, group_indicator.to(torch.uint8)
 
-def dynamic_group1(is_above_threshold, head_dim, keys, sorted_indices):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.25 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.25 * head_dim)) & (first_above_threshold_idx <= int(0.5 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.5 * head_dim)) & (first_above_threshold_idx <= int(0.75 * head_dim))] = 2
-    group_indicator[first_above_threshold_idx > int(0.75 * head_dim)] = 3
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.25, 0.5, 0.75, 1.0]
-    for group_id, ratio in zip([0, 1, 2, 3], topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
 
-def dynamic_group2(is_above_threshold, head_dim, keys, sorted_indices):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.25 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.25 * head_dim)) & (first_above_threshold_idx <= int(0.3 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.35 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.35 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 3
-    group_indicator[first_above_threshold_idx > int(0.4 * head_dim)] = 4
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.2, 0.3, 0.35, 0.4, 0.5]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
+def exponential_attn_grouped(ctx, is_avg=True, is_up=False):
+    """
+    Same as exponential_attn, with the threshold of each token taken at its k-th most contributing channel, where
+    k = max(1, int(topk_ratios[g] * head_dim)) depends on the group g of the token. Thresholds are read through the
+    channel ranks of the selection sort, so all groups are filled in one pass over the keys, whatever their number.
+    """
+    scores, queries = ctx.contributions, ctx.q_norm
+    head_dim = scores.shape[-1]
 
-def dynamic_group6(is_above_threshold, head_dim, keys, sorted_indices):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.25 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.25 * head_dim)) & (first_above_threshold_idx <= int(0.3 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.35 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.35 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 3
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.6 * head_dim))] = 4
-    group_indicator[first_above_threshold_idx > int(0.6 * head_dim)] = 5
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.2, 0.25, 0.3, 0.35, 0.4, 0.5]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
+    keep_channels = [max(1, int(ratio * head_dim)) for ratio in ctx.topk_ratios]
+    # int16 as in dynamic_group: k can be head_dim, which does not fit the uint8 ranks when head_dim is 256
+    keep_channels = torch.tensor(keep_channels, dtype=torch.int16, device=scores.device)
+    k = keep_channels[ctx.group_indicator.long()].unsqueeze(-1)  # (bsz, num_heads, seq_len, 1)
 
-def dynamic_group7(is_above_threshold, head_dim, keys, sorted_indices):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
-    group_indicator = torch.zeros_like(first_above_threshold_idx)
-
-    group_indicator[first_above_threshold_idx <= int(0.3 * head_dim)] = 0
-    group_indicator[(first_above_threshold_idx > int(0.3 * head_dim)) & (first_above_threshold_idx <= int(0.4 * head_dim))] = 1
-    group_indicator[(first_above_threshold_idx > int(0.4 * head_dim)) & (first_above_threshold_idx <= int(0.5 * head_dim))] = 2
-    group_indicator[(first_above_threshold_idx > int(0.5 * head_dim)) & (first_above_threshold_idx <= int(0.7 * head_dim))] = 3
-    group_indicator[first_above_threshold_idx > int(0.7 * head_dim)] = 4
-
-    total_mask = torch.zeros_like(keys, dtype=torch.bool)
-    topk_ratios = [0.3, 0.35, 0.4, 0.45, 0.5]
-    for group_id, ratio in zip(list(range(len(topk_ratios))), topk_ratios):
-        group_mask = (group_indicator == group_id)
-        
-        if not group_mask.any():
-            continue
-        
-        keep_channels = int(ratio * head_dim)
-        
-        top_indices = sorted_indices[..., :keep_channels]
-        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True) 
-        group_mask_expanded = group_mask.unsqueeze(-1).expand_as(total_mask)
-        
-        sub_mask = group_mask_expanded & group_topk_mask
-        
-        total_mask |= sub_mask
-    return total_mask, topk_ratios, group_indicator
+    # Contribution of the channel of rank k - 1 of each token, as topk(scores, k)[..., -1] (ranks are promoted to
+    # int16 by the comparison)
+    threshold = torch.where(ctx.ranks == k - 1, scores, 0).sum(dim=-1, keepdim=True)
+    avg_scores = ctx.low_scores_mean(threshold)
 
-def exponential_attn_grouped(scores, queries, keys, mask, index, group_indicator, topk_ratios=[0.3, 0.5, 0.7], is_avg=True, is_up=False):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    device = keys.device
-    
-    new_values_total = torch.zeros_like(keys)
-    
-    for group_id, ratio in enumerate(topk_ratios):
-        group_mask = (group_indicator == group_id)
-        if not group_mask.any():
-            continue
-        
-        group_mask_expanded = group_mask.unsqueeze(-1).expand(-1, -1, -1, head_dim)
-        
-        group_scores = torch.where(group_mask_expanded, scores, torch.tensor(-float('inf'), device=device))
-        group_queries = torch.where(group_mask_expanded, queries, torch.tensor(1.0, device=device))
-        
-        k = max(1, int(ratio * head_dim))
-        threshold_group = torch.topk(group_scores, k=k, dim=-1)[0][..., -1, None]
-        
-        mask_low_group = group_scores < threshold_group
-        masked_scores_group = torch.where(mask_low_group, group_scores, torch.tensor(0.0, device=device))
-        
-        if is_avg:
-            mask_sum_group = mask_low_group.sum(dim=-1, keepdim=True)
-            mask_sum_group = mask_sum_group + (mask_sum_group == 0) * 1
-            avg_scores_group = masked_scores_group.sum(dim=-1, keepdim=True) / mask_sum_group
-            new_values_group = torch.sqrt(avg_scores_group / group_queries)
+    if is_avg:
+        new_values = torch.sqrt(avg_scores / queries)
+    else:
+        mean = torch.clamp(scores.mean(dim=-1, keepdim=True), min=1e-5)
+        # Samples of an exponential distribution of rate 1 / mean, assigned in decreasing order of contribution
+        sorted_values = torch.sort(torch.empty_like(scores).exponential_(), dim=-1, descending=True)[0] * mean
+        output_values = torch.gather(sorted_values, dim=-1, index=ctx.ranks.long())
+        if is_up:
+            values = torch.minimum(output_values, threshold)
         else:
-            mean_group = group_scores.mean(dim=-1, keepdim=True)
-            mean_group = torch.clamp(mean_group, min=1e-5)
-            rate_group = 1.0 / mean_group
-            
-            exponential_dist = torch.distributions.exponential.Exponential(rate_group)
-            values_group = exponential_dist.sample((head_dim,)).permute(1, 2, 3, 0)
-            
-            sorted_values_group = torch.sort(values_group, dim=-1, descending=True)[0]
-            output_values_group = torch.zeros_like(values_group)
-            output_values_group = output_values_group.scatter(dim=-1, index=index, src=sorted_values_group)
-            
-            threshold_expanded_group = threshold_group.expand_as(output_values_group)
-            if is_up:
-                values_group = torch.where(output_values_group > threshold_expanded_group, threshold_expanded_group, output_values_group)
-            else:
-                values_group = torch.where(output_values_group > threshold_expanded_group, avg_scores_group, output_values_group)
-            
-            new_values_group = torch.sqrt(values_group / group_queries)
-        
-        new_values_total = torch.where(group_mask_expanded, new_values_group, new_values_total)
-    
-    final_mask = torch.where(
-        mask == 1, 
-        torch.where(keys > 0, torch.tensor(1, dtype=keys.dtype), torch.tensor(-1, dtype=keys.dtype)),
-        torch.tensor(0, dtype=keys.dtype)
-    )
-    return torch.where(
-        final_mask == 1, new_values_total.abs(),
-        torch.where(final_mask == -1, -new_values_total.abs(), keys)
-    )
-
-def exponential_attn(scores, queries, keys, mask, index, topk=63, is_avg=True, is_up=False):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    mask = torch.where(
-        mask == 1, 
-        torch.where(keys > 0, torch.tensor(1, dtype=keys.dtype), torch.tensor(-1, dtype=keys.dtype)),
-        torch.tensor(0, dtype=keys.dtype)
-    )
-    threshold = torch.topk(scores, k=topk, dim=-1)[0][..., -1, None]
-    mask_low = scores < threshold 
-    masked_scores = torch.where(mask_low, scores, torch.tensor(0.0, device=scores.device)) 
-    mask_sum = mask_low.sum(dim=-1, keepdim=True)
-    mask_sum = mask_sum + (mask_sum == 0) * 1
-    avg_scores = (masked_scores.sum(dim=-1, keepdim=True) / mask_sum).repeat(1, 1, 1, head_dim)
+            values = torch.where(output_values > threshold, avg_scores, output_values)
+        new_values = torch.sqrt(values / queries)
+
+    return ctx.fill_pruned(new_values)
+
+def exponential_attn(ctx, is_avg=True, is_up=False):
+    scores, queries = ctx.contributions, ctx.q_norm
+    threshold = ctx.threshold(ctx.topk)
+    avg_scores = ctx.low_scores_mean(threshold)
     if is_avg:
         new_values = torch.sqrt(avg_scores / queries)
     else:
@@ -680,50 +570,29 @@ def exponential_attn(scores, queries, keys, mask, index, topk=63, is_avg=True, i
         values = exponential_dist.sample((scores.shape[-1],)).squeeze(-1).permute(1, 2, 3, 0)
         threshold_expanded = threshold.expand_as(values)
         sorted_values = torch.sort(values, dim=-1, descending=True)[0]
-        output_values = torch.zeros_like(values) 
-        output_values = output_values.scatter(dim=-1, index=index, src=sorted_values)
+        output_values = torch.gather(sorted_values, dim=-1, index=ctx.ranks.long())
         if is_up:
             values = torch.where(output_values > threshold_expanded, threshold_expanded, output_values)
         else:
             values = torch.where(output_values > threshold_expanded, avg_scores, output_values)
         new_values = torch.sqrt(values / queries)
 
-    return torch.where(
-        mask == 1, new_values.abs(),                     
-        torch.where(mask == -1, -new_values.abs(), keys)
-    )
-
-def exponential(keys, mask):
-    mask = torch.where(
-        mask == 1, 
-        torch.where(keys > 0, torch.tensor(1, dtype=keys.dtype), torch.tensor(-1, dtype=keys.dtype)),
-        torch.tensor(0, dtype=keys.dtype)
-    )
+    return ctx.fill_pruned(new_values)
+
+def exponential(ctx):
+    keys = ctx.keys
     mean = keys.mean(dim=-1, keepdim=True)
     mean = torch.clamp(mean, min=1e-5)
     rate = 1.0 / mean
     
     exponential_dist = torch.distributions.exponential.Exponential(rate)
     new_values = exponential_dist.sample((keys.shape[-1],)).squeeze(-1).view(keys.shape[0], keys.shape[1], keys.shape[2], -1)
-    return torch.where(
-        mask == 1, new_values.abs(),                     
-        torch.where(mask == -1, -new_values.abs(), keys)
-    )
+    return ctx.fill_pruned(new_values)
 
-def normal_attn(scores, queries, keys, mask, index, topk=63, is_avg=True, is_up=False):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    mask = torch.where(
-        mask == 1, 
-        torch.where(keys > 0, torch.tensor(1, dtype=keys.dtype), torch.tensor(-1, dtype=keys.dtype)),
-        torch.tensor(0, dtype=keys.dtype)
-    )
-
-    threshold = torch.topk(scores, k=topk, dim=-1)[0][..., -1, None]
-    mask_low = scores < threshold 
-    masked_scores = torch.where(mask_low, scores, torch.tensor(0.0, device=scores.device)) 
-    mask_sum = mask_low.sum(dim=-1, keepdim=True)
-    mask_sum = mask_sum + (mask_sum == 0) * 1
-    avg_scores = (masked_scores.sum(dim=-1, keepdim=True) / mask_sum).repeat(1, 1, 1, head_dim)
+def normal_attn(ctx, is_avg=True, is_up=False):
+    scores, queries = ctx.contributions, ctx.q_norm
+    threshold = ctx.threshold(ctx.topk)
+    avg_scores = ctx.low_scores_mean(threshold)
     if is_avg:
         new_values = torch.sqrt(avg_scores / queries)
     else:
@@ -733,35 +602,24 @@ def normal_attn(scores, queries, keys, mask, index, topk=63, is_avg=True, is_up=
         values = norm_dist.sample((scores.shape[-1],)).squeeze(-1).permute(1, 2, 3, 0).abs()
         threshold_expanded = threshold.expand_as(values)
         sorted_values = torch.sort(values, dim=-1, descending=True)[0]
-        output_values = torch.zeros_like(values) 
-        output_values = output_values.scatter(dim=-1, index=index, src=sorted_values)
+        output_values = torch.gather(sorted_values, dim=-1, index=ctx.ranks.long())
         if is_up:
             values = torch.where(output_values > threshold_expanded, threshold_expanded, output_values)
         else:
             values = torch.where(output_values > threshold_expanded, avg_scores, output_values)
         new_values = torch.sqrt(values / queries)
 
-    return torch.where(
-        mask == 1, new_values.abs(),                     
-        torch.where(mask == -1, -new_values.abs(), keys)
-    )
-
-def normal(keys, mask):
-    mask = torch.where(
-        mask == 1, 
-        torch.where(keys > 0, torch.tensor(1, dtype=keys.dtype), torch.tensor(-1, dtype=keys.dtype)),
-        torch.tensor(0, dtype=keys.dtype)
-    )
+    return ctx.fill_pruned(new_values)
+
+def normal(ctx):
+    keys = ctx.keys
     mean = keys.mean(dim=-1, keepdim=True)
     std = keys.std(dim=-1, keepdim=True)
     mean = torch.clamp(mean, min=1e-5)
     std = torch.clamp(std, min=1e-5)
     norm_dist = torch.distributions.normal.Normal(mean, std)
     new_values = norm_dist.sample((keys.shape[-1],)).squeeze(-1).view(keys.shape[0], keys.shape[1], keys.shape[2], -1)
-    return torch.where(
-        mask == 1, new_values.abs(),                     
-        torch.where(mask == -1, -new_values.abs(), keys)
-    )
+    return ctx.fill_pruned(new_values)
 
 def gamma(keys, mask):
     min_val = keys.min(dim=(0, 1, 2), keepdim=True)
@@ -824,252 +682,268 @@ def generate_interpolated_fill(keys, mask):
 def generate_pca_fill(keys, mask, n_components=10):
     """
     使用非零部分数据的主成分重新生成置零数据。
+    All (batch, head) pairs are processed at once on the keys' device: the principal axes of the kept channels are
+    the top eigenvectors of their covariance (as sklearn's PCA with the covariance_eigh solver).
 
     Args:
         keys (torch.Tensor): 原始数据 (bsz, num_heads, seq_len, head_dim)
         mask (torch.BoolTensor): 已经置零的位置 `False` 表示需要填充，`True` 表示保留
+        n_components (int): number of principal components used for the reconstruction
 
     Returns:
         torch.Tensor: 填充后的 keys 数据 (同样维度)
     """
     recovered_keys = keys.clone()  # 克隆原始数据以进行操作
     bsz, num_heads, seq_len, head_dim = keys.shape
-    # keys_2d = keys.view(bsz * num_heads, seq_len, head_dim).permute(0, 2, 1).reshape(bsz * num_heads, head_dim * seq_len)
-    # mask_2d = mask.view(bsz * num_heads, seq_len, head_dim).permute(0, 2, 1).reshape(bsz * num_heads, head_dim * seq_len)
 
-    # # 找到所有有未置零值的 token 位置
-    # nonzero_tokens = torch.nonzero(mask_2d.sum(dim=1), as_tuple=True)[0]
+    # Every token keeps the same number of channels, so the kept data of each head is a (seq_len, n_kept) matrix
+    valid_data = keys[mask].view(bsz * num_heads, seq_len, -1)
+    if seq_len <= 1 or valid_data.size(-1) == 0:  # 如果有效数据不足，PCA 无法应用
+        return recovered_keys
 
-    # if nonzero_tokens.numel() > 0:  # 如果有未置零的 token
-    #     valid_data = keys_2d[mask_2d].view(bsz * num_heads, seq_len, -1)  # 提取所有有效的上下文数据 (N, head_dim * seq_len)
-    #     breakpoint()
-    #     if valid_data.size(0) > 1:  # 如果有效数据不足，PCA 无法应用
-    #         pca_model = PCA(n_components=min(valid_data.size(-1), 10))  # 限制主成分
-    #         pca_model.fit(valid_data.cpu().numpy())  # 仅 fit 有效数据部分
-
-    #         # 对所有有未置零值的 token 进行批量处理
-    #         token_low_dims = pca_model.transform(valid_data[nonzero_tokens].cpu().numpy())
-    #         token_high_dims = pca_model.inverse_transform(token_low_dims)  # 恢复至原始空间
-
-    #         # 将重构的维度值赋回当前 token
-    #         token_reconstructed = torch.tensor(token_high_dims, device=keys.device)
-    #         breakpoint()
-    #         recovered_keys_2d = recovered_keys.view(bsz * num_heads, seq_len, head_dim).permute(0, 2, 1).reshape(bsz * num_heads, head_dim * seq_len)
-    #         recovered_keys_2d[~mask_2d] = token_reconstructed.view(-1).to(recovered_keys.dtype)
-
-    # # 将恢复后的二维矩阵转换回原始的 batch 和 head 维度
-    # recovered_keys = recovered_keys_2d.view(bsz, num_heads, head_dim, seq_len).permute(0, 1, 3, 2)
-    # keys_reshaped = keys.view(-1, seq_len, head_dim)  # (bsz * num_heads, seq_len, head_dim)
-    # mask_reshaped = mask.view(-1, seq_len, head_dim)  # (bsz * num_heads, seq_len, head_dim)
-    
-    for b in range(bsz):  # 遍历每个 batch
-        for h in range(num_heads):  # 遍历每个 attention head
-            sub_keys = keys[b, h]  # (seq_len, head_dim)
-            sub_mask = mask[b, h]  # (seq_len, head_dim)
-            
-            nonzero_tokens = torch.nonzero(sub_mask.sum(dim=1), as_tuple=True)[0]
-            if nonzero_tokens.numel() > 0:  # 如果有未置零的 token
-                valid_data = sub_keys[sub_mask]  # 提取所有有效的上下文数据 (N, head_dim)
-                valid_data = valid_data.view(sub_keys.size(0), -1)  # 确保二维矩阵 (N, head_dim)
-
-                if valid_data.size(0) > 1:  # 如果有效数据不足，PCA 无法应用
-                    pca_model = PCA(n_components=min(valid_data.size(-1), 10))  # 限制主成分
-                    pca_model.fit(valid_data.cpu().numpy())  # 仅 fit 有效数据部分
-
-                    # 对所有有未置零值的 token 进行批量处理
-                    token_low_dims = pca_model.transform(valid_data[nonzero_tokens].cpu().numpy())
-                    token_high_dims = pca_model.inverse_transform(token_low_dims)  # 恢复至原始空间
-                    # 将重构的维度值赋回当前 token
-                    token_reconstructed = torch.tensor(token_high_dims, device=keys.device)
-                    recovered_keys[b, h][~sub_mask] = token_reconstructed.view(-1).to(recovered_keys.dtype)
-    # recovered_keys = keys.clone()  # 克隆原始数据以进行操作
-    # for b in range(keys.size(0)):  # 遍历 batch
-    #     for h in range(keys.size(1)):  # 遍历 attention head
-    #         sub_keys = keys[b, h]  # 当前 batch 和 head 的 keys (seq_len, head_dim)
-    #         sub_mask = mask[b, h]  # 当前对应的有效掩码 (seq_len, head_dim)
-
-    #         for t in range(sub_keys.size(0)):  # 遍历每个 token 的位置
-    #             token_data = sub_keys[t]  # 当前 token 的特征数据 (head_dim,)
-    #             token_mask = sub_mask[t]  # 当前 token 的掩码 (head_dim,)
-
-    #             # 如果当前 token 有未置零的值，进行 PCA 动态重构
-    #             if torch.any(token_mask):  # 检查是否有未置零数据
-    #                 valid_data = sub_keys[sub_mask]  # 提取所有有效的上下文数据 (N, head_dim)
-    #                 valid_data = valid_data.view(sub_keys.size(0), -1)  # 确保二维矩阵 (N, head_dim)
-    #                 if valid_data.size(0) > 1:  # 如果有效数据不足，PCA 无法应用
-    #                     pca_model = PCA(n_components=min(valid_data.size(-1), 10))  # 限制主成分
-    #                     pca_model.fit(valid_data.cpu().numpy())  # 仅 fit 有效数据部分
-
-    #                     # 当前 token 的置零位置动态恢复
-    #                     missing_indices = torch.where(~token_mask)[0]  # 找到置零的位置 (head_dim 的维度索引)
-    #                     if len(missing_indices) > 0:
-    #                         token_low_dim = pca_model.transform(token_data[token_mask].cpu().numpy().reshape(1, -1))
-    #                         token_high_dim = pca_model.inverse_transform(token_low_dim)  # 恢复至原始空间
-
-    #                         # 将重构的维度值赋回当前 token
-    #                         token_reconstructed = torch.tensor(token_high_dim, device=keys.device).squeeze(0)
-    #                         recovered_keys[b, h, t, missing_indices] = token_reconstructed.to(recovered_keys.dtype)
-    # breakpoint()
+    n_components = min(valid_data.size(-1), n_components)  # 限制主成分
+    mean = valid_data.mean(dim=1, keepdim=True)
+    centered = valid_data - mean
+    covariance = torch.matmul(centered.transpose(1, 2), centered)
+    components = torch.linalg.eigh(covariance).eigenvectors[..., -n_components:]  # eigenvalues in ascending order
+
+    # Project on the principal components and map back to the original space
+    token_reconstructed = mean + torch.matmul(torch.matmul(centered, components), components.transpose(1, 2))
+
+    # 将重构的维度值赋回置零的位置
+    recovered_keys[~mask] = token_reconstructed.reshape(-1).to(recovered_keys.dtype)
     return recovered_keys
 
 
-def dynamic_token_wise_dim_selection_norm(queries, keys, threshold_ratio=0.999):
+@dataclass
+class FillContext:
+    """
+    Per-layer quantities shared by the fill strategies of the pruned channels. They are computed once by the channel
+    selection and read by every strategy in FILL_STRATEGIES.
+    """
+
+    keys: torch.Tensor  # (bsz, num_heads, seq_len, head_dim)
+    mask: torch.Tensor  # (bsz, num_heads, seq_len, head_dim), True for kept channels
+    q_norm: torch.Tensor  # (bsz, num_heads, 1, head_dim), norm of the window queries per channel
+    contributions: torch.Tensor  # (bsz, num_heads, seq_len, head_dim), keys ** 2 * q_norm
+    ranks: torch.Tensor  # uint8 rank of each channel in the decreasing contribution order (see channel_ranks)
+    topk: int = 0
+    group_indicator: Optional[torch.Tensor] = None  # (bsz, num_heads, seq_len) group of each token
+    topk_ratios: list = field(default_factory=list)
+    n_components: int = 10
+
+    def threshold(self, k: int) -> torch.Tensor:
+        """
+        Contribution of the k-th most contributing channel of each token, (bsz, num_heads, seq_len, 1)
+        """
+        head_dim = self.contributions.shape[-1]
+        return torch.kthvalue(self.contributions, head_dim - k + 1, dim=-1, keepdim=True).values
+
+    def low_scores_mean(self, threshold: torch.Tensor) -> torch.Tensor:
+        """
+        Mean contribution of the channels below threshold, (bsz, num_heads, seq_len, 1)
+        """
+        mask_low = self.contributions < threshold
+        mask_sum = mask_low.sum(dim=-1, keepdim=True).clamp(min=1)
+        return (self.contributions * mask_low).sum(dim=-1, keepdim=True) / mask_sum
+
+    def fill_pruned(self, new_values: torch.Tensor) -> torch.Tensor:
+        """
+        Write |new_values| at the pruned channels with the sign of the original keys (negative if keys <= 0)
+        """
+        new_values = new_values.abs()
+        return torch.where(self.mask, self.keys, torch.where(self.keys > 0, new_values, -new_values))
+
+
+# Fill strategies of the pruned channels, selected by name (AdaThinKPress.fill)
+FILL_STRATEGIES = {
+    "zero": lambda ctx: ctx.keys * ctx.mask,
+    "pca": lambda ctx: generate_pca_fill(ctx.keys.to(torch.float32), ctx.mask, ctx.n_components).to(ctx.keys.dtype),
+    "interpolated": lambda ctx: generate_interpolated_fill(ctx.keys, ctx.mask),
+    "gamma": lambda ctx: gamma(ctx.keys, ~ctx.mask),
+    "normal": normal,
+    "normal_attn": normal_attn,
+    "normal_attn_sample": partial(normal_attn, is_avg=False),
+    "normal_attn_sample_up": partial(normal_attn, is_avg=False, is_up=True),
+    "exponential": exponential,
+    "exponential_attn": exponential_attn,
+    "exponential_attn_sample": partial(exponential_attn, is_avg=False),
+    "exponential_attn_sample_up": partial(exponential_attn, is_avg=False, is_up=True),
+    "exponential_attn_grouped": exponential_attn_grouped,
+}
+
+# Fill strategies using statistics over the whole sequence, that cannot be computed chunk by chunk
+SEQUENCE_FILLS = ["pca", "gamma"]
+
+# Legacy pooling_ratio values and the fill strategy they select
+POOLING_RATIO_FILLS = {
+    0.5: "pca",
+    0.3: "interpolated",
+    0.9: "gamma",
+    0.7: "normal",
+    0.75: "normal_attn",
+    0.755: "normal_attn_sample",
+    0.754: "normal_attn_sample",
+    0.7555: "normal_attn_sample_up",
+    0.7554: "normal_attn_sample_up",
+    0.6: "exponential",
+    0.65: "exponential_attn",
+    0.654: "exponential_attn_sample",
+    0.6555: "exponential_attn_sample",
+    0.6556: "exponential_attn_sample_up",
+    0.6554: "exponential_attn_sample_up",
+}
+
+
+def fill_from_pooling_ratio(pooling_ratio, threshold_ratio):
+    """
+    Name of the fill strategy selected by the legacy pooling_ratio values
+    """
+    if pooling_ratio in POOLING_RATIO_FILLS:
+        return POOLING_RATIO_FILLS[pooling_ratio]
+    elif pooling_ratio == threshold_ratio:
+        return "exponential_attn_grouped"
+    return "zero"
+
+
+def cumulative_channel_selection(contributions, threshold_ratio=0.99):
+    """
+    For each token, keep the smallest set of channels whose cumulative contribution exceeds threshold_ratio of the
+    token total, using one sort, one cumsum and one threshold search per token (no loop over head_dim).
+
+    Args:
+        contributions: non-negative Tensor of shape (bsz, num_heads, key_len, head_dim)
+        threshold_ratio: float, fraction of the total contribution to keep
+
+    Returns:
+        mask: Boolean Tensor of shape (bsz, num_heads, key_len, head_dim), True for kept channels
+    """
+    head_dim = contributions.shape[-1]
+    sorted_contributions, sorted_indices = torch.sort(contributions, dim=-1, descending=True)
+    cumulative_scores = torch.cumsum(sorted_contributions, dim=-1)
+    del sorted_contributions
+    thresholds = threshold_ratio * cumulative_scores[..., -1:]
+
+    # Position of the first channel for which the cumulative score is above the threshold, included in the mask
+    n_kept = torch.searchsorted(cumulative_scores, thresholds, right=True) + 1
+    del cumulative_scores
+    return channel_ranks(sorted_indices) < n_kept.clamp(max=head_dim)
+
+
+def profile_selection(queries, keys, boundaries, keep_channels, stats=None, layer_idx=0):
+    """
+    Calibrated counterpart of dynamic_group (see calibrate.py and AdaThinKPress.profile_budgets): each token of
+    head h is assigned to a group by bucketizing its threshold position over boundaries[h], then keeps the
+    keep_channels[h, group] most contributing channels. If boundaries is None (single-group profile), the tokens
+    of head h keep keep_channels[h, 0] channels, so neither the cumulative sum nor the threshold search is needed.
+    """
+    bsz, num_heads, seq_len, head_dim = keys.shape
+    contributions = torch.pow(keys, 2) * torch.norm(queries, dim=-2, p=2).unsqueeze(-2)
+    sorted_indices = torch.argsort(contributions, dim=-1, descending=True)
+    ranks = channel_ranks(sorted_indices)
+    if boundaries is None:
+        del contributions, sorted_indices
+        mask = ranks < keep_channels.view(1, -1, 1, 1)
+        if stats is not None:
+            stats.update(layer_idx, mask)
+        return keys * mask
+
+    # Threshold position of each token, as in dynamic_score_selection_norm
+    cumulative_scores = torch.cumsum(torch.gather(contributions, dim=-1, index=sorted_indices), dim=-1)
+    del contributions, sorted_indices
+    threshold_indices = torch.searchsorted(cumulative_scores, 0.99 * cumulative_scores[..., -1:], right=True)
+    threshold_indices = threshold_indices.squeeze(-1).clamp(max=head_dim - 1)
+    del cumulative_scores
+
+    # Per-head bucketize of the threshold positions (number of boundaries below), then per-head, per-group budgets
+    group_indicator = (threshold_indices.unsqueeze(-1) > boundaries.view(1, num_heads, 1, -1)).sum(dim=-1)
+    n_groups = keep_channels.shape[-1]
+    heads = torch.arange(num_heads, device=keys.device).view(1, -1, 1)
+    mask = ranks < keep_channels.flatten()[heads * n_groups + group_indicator].unsqueeze(-1)
+    if stats is not None:
+        stats.update(layer_idx, mask, group_indicator.to(torch.uint8), n_groups, threshold_indices)
+    return keys * mask
+
+
+def head_channel_selection(queries, keys, threshold_ratio=0.99, key_channel_compression_ratio=0, stats=None, layer_idx=0):
+    """
+    Keep one channel subset per head, shared by all its tokens. Channels are scored by their AdaThinK contribution
+    summed over the tokens of the head, ||k[:, d]|| ** 2 * ||q[:, d]||, and each head keeps the smallest set of
+    channels reaching threshold_ratio of its total contribution (variable width per head). If threshold_ratio is 0,
+    every head keeps head_dim - int(key_channel_compression_ratio * head_dim) channels.
+    """
+    head_dim = keys.shape[-1]
+    key_energy = torch.linalg.vector_norm(keys, dim=-2, keepdim=True, dtype=torch.float32).pow_(2)
+    contributions = key_energy * torch.norm(queries.float(), dim=-2, p=2).unsqueeze(-2)  # (bsz, num_heads, 1, head_dim)
+    if threshold_ratio != 0:
+        mask = cumulative_channel_selection(contributions, threshold_ratio)
+    else:
+        n_kept = head_dim - int(key_channel_compression_ratio * head_dim)
+        mask = channel_ranks(torch.argsort(contributions, dim=-1, descending=True)) < n_kept
+    if stats is not None:
+        stats.update(layer_idx, mask.expand_as(keys))
+    return keys * mask
+
+
+def token_wise_cumsum_selection(queries, keys, threshold_ratio=0.99, stats=None, layer_idx=0):
+    """
+    针对每个 token 动态筛选重要维度: keep the channels carrying threshold_ratio of the energy of the token's attention
+    scores over the query window, where the energy of channel d is (|k[t, d]| * ||q[:, d]||) ** 2.
+    Prefill cost is a single sort over head_dim, pruned channels are set to 0.
+    """
+    contributions = dim_contribution_norms(queries, keys).pow_(2)
+    mask = cumulative_channel_selection(contributions, threshold_ratio)
+    if stats is not None:
+        stats.update(layer_idx, mask)
+    return keys * mask
+
+
+def dynamic_token_wise_dim_selection_norm(queries, keys, threshold_ratio=0.999, stats=None, layer_idx=0):
     """
     针对每个 token 动态筛选重要维度，保证每个 token 的乘积范数达到原始范数的 99%。
+    Channel contributions are computed on normalized queries and keys. Cross-channel terms are neglected, so the norm
+    ratio threshold_ratio corresponds to an energy ratio threshold_ratio ** 2 in cumulative_channel_selection.
 
     Args:
         queries: Tensor of shape (bsz, num_heads, query_len, head_dim)
         keys: Tensor of shape (bsz, num_heads, key_len, head_dim)
-        target_ratio: float, 保留原始范数的比例（默认 99%）
+        threshold_ratio: float, 保留原始范数的比例（默认 99.9%）
 
     Returns:
-        compressed_queries: Tensor of shape (bsz, num_heads, query_len, selected_head_dim)
-        compressed_keys: Tensor of shape (bsz, num_heads, key_len, selected_head_dim)
-        mask: Boolean Tensor of shape (bsz, num_heads, query_len, head_dim), 表示每个 token 的筛选掩码
+        pruned_keys: Tensor of shape (bsz, num_heads, key_len, head_dim), 未保留的 channel 设置为 0
     """
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    # Step 1: 计算原始范数
     queries_norm = torch.nn.functional.normalize(queries, dim=-1)
     keys_norm = torch.nn.functional.normalize(keys, dim=-1)
-    attention_scores = torch.matmul(queries_norm, keys_norm.transpose(-1, -2))  # (bsz, num_heads, query_len, key_len)
-    original_norm = torch.norm(attention_scores, dim=-2, p=2).unsqueeze(-1)  # (bsz, num_heads, key_len)
-    # norms=torch.norm(torch.einsum('bhqd,bhkd->bhqk',queries,keys))
-    # breakpoint()
-
-    # Step 2: 计算每个维度的贡献
-    dim_contributions = []
-    for d in range(queries.size(-1)):
-        keys_masked = torch.zeros_like(keys_norm)
-        keys_masked[..., d] = keys_norm[..., d]  # 仅保留第 i 个维度的特征
-
-        attention_scores_masked = torch.matmul(queries_norm, keys_masked.transpose(-1, -2))
-        masked_norm = torch.norm(attention_scores_masked, dim=-2, p=2)  # (bsz, num_heads, key_len)
-        dim_contributions.append(masked_norm)
-    dim_contributions = torch.stack(dim_contributions, dim=-1)  # (bsz, num_heads, key_len, head_dim)
-    sorted_indices = torch.argsort(dim_contributions, dim=-1, descending=True)  # 每个 token 按 channel 贡献排序 (bsz, num_heads, seq_len, head_dim)
-    
-    # Step 3: 动态选择 top-k channels
-    # cumulative_sum = torch.zeros_like(dim_contributions)  # 用于存储累积和
-    cumulative_ratio = torch.ones_like(dim_contributions)
-    mask = torch.zeros_like(dim_contributions, dtype=torch.bool)  # 用于标记保留的 channel
-    # prev_ratio = torch.zeros_like(original_norm)
-    breakpoint()
-    for i in range(head_dim):
-        index = sorted_indices[:, :, :, i]  # 当前最高贡献的 channel 索引
-        # breakpoint()
-        selected_indices = sorted_indices[:, :, :, :i + 1]   
-        keys_masked = torch.zeros_like(keys)
-        keys_masked = keys_masked.scatter_(-1, selected_indices, keys.gather(-1, selected_indices))
-        cur_score = torch.norm(torch.matmul(queries, keys_masked.transpose(-1, -2)), dim=-2, p=2).unsqueeze(-1)
-
-        # cur_score = torch.sum(dim_contributions.gather(-1, sorted_indices[:, :, :, :i+1]), dim=-1).unsqueeze(-1)
-        cur_ratio = cur_score / original_norm
-        cumulative_ratio.scatter_(-1, index.unsqueeze(-1), cur_ratio)
-        # cumulative_sum.scatter_add_(-1, index.unsqueeze(-1), cur_score)
-        # current_ratio = cumulative_sum / original_norm # 当前累积平方和与原始平方和的比例
-        # breakpoint()
-        # mask = mask | (prev_ratio < threshold_ratio)
-        mask = mask | (cumulative_ratio < threshold_ratio)  # 保留当前 channel
-        # prev_ratio = current_ratio
-        if torch.all((cur_score / original_norm) >= threshold_ratio):
-            print('get threshold! Skip!')
-            # mask = mask | (cumulative_ratio < threshold_ratio)
-            # breakpoint()
-            break
-    sorted_cumulative_ratio = torch.gather(cumulative_ratio, dim=-1, index=sorted_indices)  # (bsz, num_heads, key_len, head_dim)
-    is_above_threshold = sorted_cumulative_ratio > threshold_ratio  # (bsz, num_heads, key_len, head_dim)
-    # 找到第一个满足条件的索引
-    threshold_indices = is_above_threshold.to(torch.float32).argmax(dim=-1)  # (bsz, num_heads, key_len)
-    breakpoint()
-    mask = create_mask_by_threshold(sorted_indices, threshold_indices)
-    
-    num_selected_channels = torch.sum(mask).item()  # 统计所有位置中被选中的 channel 数量
-    print(f"Number of selected channels: {num_selected_channels}")
-    selected_channels_per_token = torch.sum(mask, dim=-1)  # (bsz, num_heads, seq_len)
-    print(f"Selected channels per token shape: {selected_channels_per_token}")
-    print(f"Example: Selected channels for [batch=0, head=0, token=0]: {selected_channels_per_token[0, 0, 0].item()}")
-    
-    # Step 4: 裁剪 keys
+    contributions = dim_contribution_norms(queries_norm, keys_norm).pow_(2)  # (bsz, num_heads, key_len, head_dim)
+    mask = cumulative_channel_selection(contributions, threshold_ratio ** 2)
+
+    if stats is not None:
+        stats.update(layer_idx, mask)  # 统计所有位置中被选中的 channel 数量
+
+    # 裁剪 keys
     pruned_keys = keys * mask # 将未保留的 channel 设置为 0
     return pruned_keys
 
-def dynamic_token_wise_dim_selection(queries, keys, threshold_ratio=0.999):
+def dynamic_token_wise_dim_selection(queries, keys, threshold_ratio=0.999, stats=None, layer_idx=0):
     """
     针对每个 token 动态筛选重要维度，保证每个 token 的乘积范数达到原始范数的 99%。
+    Same as dynamic_token_wise_dim_selection_norm, with contributions computed on the raw queries and keys.
 
     Args:
         queries: Tensor of shape (bsz, num_heads, query_len, head_dim)
         keys: Tensor of shape (bsz, num_heads, key_len, head_dim)
-        target_ratio: float, 保留原始范数的比例（默认 99%）
+        threshold_ratio: float, 保留原始范数的比例（默认 99.9%）
 
     Returns:
-        compressed_queries: Tensor of shape (bsz, num_heads, query_len, selected_head_dim)
-        compressed_keys: Tensor of shape (bsz, num_heads, key_len, selected_head_dim)
-        mask: Boolean Tensor of shape (bsz, num_heads, query_len, head_dim), 表示每个 token 的筛选掩码
+        pruned_keys: Tensor of shape (bsz, num_heads, key_len, head_dim), 未保留的 channel 设置为 0
     """
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    # Step 1: 计算原始范数
-    queries_norm = torch.nn.functional.normalize(queries, dim=-1)
-    keys_norm = torch.nn.functional.normalize(keys, dim=-1)
-    attention_scores = torch.matmul(queries, keys.transpose(-1, -2))  # (bsz, num_heads, query_len, key_len)
-    original_norm = torch.norm(attention_scores, dim=-2, p=2).unsqueeze(-1)  # (bsz, num_heads, key_len)
-    # norms=torch.norm(torch.einsum('bhqd,bhkd->bhqk',queries,keys))
-    # breakpoint()
-
-    # Step 2: 计算每个维度的贡献
-    dim_contributions = []
-    for d in range(queries.size(-1)):
-        keys_masked = torch.zeros_like(keys)
-        keys_masked[..., d] = keys[..., d]  # 仅保留第 i 个维度的特征
-
-        attention_scores_masked = torch.matmul(queries, keys_masked.transpose(-1, -2))
-        masked_norm = torch.norm(attention_scores_masked, dim=-2, p=2)  # (bsz, num_heads, key_len)
-        dim_contributions.append(masked_norm)
-    dim_contributions = torch.stack(dim_contributions, dim=-1)  # (bsz, num_heads, key_len, head_dim)
-    sorted_indices = torch.argsort(dim_contributions, dim=-1, descending=True)  # 每个 token 按 channel 贡献排序 (bsz, num_heads, seq_len, head_dim)
-    
-    # Step 3: 动态选择 top-k channels
-    # cumulative_sum = torch.zeros_like(dim_contributions)  # 用于存储累积和
-    cumulative_ratio = torch.ones_like(dim_contributions)
-    mask = torch.zeros_like(dim_contributions, dtype=torch.bool)  # 用于标记保留的 channel
-    # prev_ratio = torch.zeros_like(original_norm)
-    idx = 0
-    for i in range(head_dim):
-        index = sorted_indices[:, :, :, i]  # 当前最高贡献的 channel 索引
-        # breakpoint()
-        selected_indices = sorted_indices[:, :, :, :i + 1]   
-        keys_masked = torch.zeros_like(keys)
-        keys_masked = keys_masked.scatter_(-1, selected_indices, keys.gather(-1, selected_indices))
-        cur_score = torch.norm(torch.matmul(queries, keys_masked.transpose(-1, -2)), dim=-2, p=2).unsqueeze(-1)
-
-        # cur_score = torch.sum(dim_contributions.gather(-1, sorted_indices[:, :, :, :i+1]), dim=-1).unsqueeze(-1)
-        cur_ratio = cur_score / original_norm
-        cumulative_ratio.scatter_(-1, index.unsqueeze(-1), cur_ratio)
-        # cumulative_sum.scatter_add_(-1, index.unsqueeze(-1), cur_score)
-        # current_ratio = cumulative_sum / original_norm # 当前累积平方和与原始平方和的比例
-        # breakpoint()
-        # mask = mask | (prev_ratio < threshold_ratio)
-        mask = mask | (cumulative_ratio < threshold_ratio)  # 保留当前 channel
-        # prev_ratio = current_ratio
-        if torch.all((cur_score / original_norm) >= threshold_ratio):
-            print('get threshold! Skip!')
-            # mask = mask | (cumulative_ratio < threshold_ratio)
-            # breakpoint()
-            break
-    sorted_cumulative_ratio = torch.gather(cumulative_ratio, dim=-1, index=sorted_indices)  # (bsz, num_heads, key_len, head_dim)
-    is_above_threshold = sorted_cumulative_ratio > threshold_ratio  # (bsz, num_heads, key_len, head_dim)
-    # 找到第一个满足条件的索引
-    threshold_indices = is_above_threshold.to(torch.float32).argmax(dim=-1)  # (bsz, num_heads, key_len)
-    breakpoint()
-    mask = create_mask_by_threshold(sorted_indices, threshold_indices)
-    
-    num_selected_channels = torch.sum(mask).item()  # 统计所有位置中被选中的 channel 数量
-    print(f"Number of selected channels: {num_selected_channels}")
-    selected_channels_per_token = torch.sum(mask, dim=-1)  # (bsz, num_heads, seq_len)
-    print(f"Selected channels per token shape: {selected_channels_per_token}")
-    print(f"Example: Selected channels for [batch=0, head=0, token=0]: {selected_channels_per_token[0, 0, 0].item()}")
-    
-    # Step 4: 裁剪 keys
+    contributions = dim_contribution_norms(queries, keys).pow_(2)  # (bsz, num_heads, key_len, head_dim)
+    mask = cumulative_channel_selection(contributions, threshold_ratio ** 2)
+
+    if stats is not None:
+        stats.update(layer_idx, mask)  # 统计所有位置中被选中的 channel 数量
+
+    # 裁剪 keys
     pruned_keys = keys * mask # 将未保留的 channel 设置为 0
     return pruned_keys
 
@@ -1084,139 +958,23 @@ def create_mask_by_threshold(sorted_indices, threshold_indices):
     Returns:
         mask: Tensor, 布尔类型的 mask，形状为 (bsz, num_heads, key_len, head_dim)
     """
-    bsz, num_heads, key_len, head_dim = sorted_indices.shape
-
-    # 创建一个范围张量用于 mask 的比较，形状为 (1, 1, 1, head_dim)
-    range_tensor = torch.arange(head_dim, device=sorted_indices.device).view(1, 1, 1, head_dim)
-
-    # 将 threshold_indices 扩展为和 head_dim 可广播的形状
-    threshold_indices_expanded = threshold_indices.unsqueeze(-1)  # (bsz, num_heads, key_len, 1)
+    # 排名在阈值位置及之前的 channel 置为 True，直接在原始顺序上比较 (无需逆变换)
+    return channel_ranks(sorted_indices) <= threshold_indices.unsqueeze(-1)
 
-    # 根据阈值构造 mask，范围内的置为 True
-    mask = range_tensor <= threshold_indices_expanded  # (bsz, num_heads, key_len, head_dim)
 
-    # mask 顺序仍基于原始排序，因此需要对其进行逆变换
-    reverse_mask = torch.zeros_like(mask, dtype=torch.bool)  # 初始化全 False
-    reverse_mask.scatter_(-1, sorted_indices, mask)  # 按照 sorted_indices 逆变换 mask
-
-    return reverse_mask
-
-
-def prune_keys(keys, queries, threshold_ratio=0.99):
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    # 原始完整注意力分数
-    attention_scores = torch.matmul(queries, keys.transpose(-1, -2))  # (bsz, num_heads, window_size, q_len)
-    attention_scores_norm_original = torch.norm(attention_scores, dim=(-2, -1), p=2)  # (bsz, num_heads)
-
-    # 记录原始注意力范数用于误差计算
-    attention_norm_baseline = attention_scores_norm_original.mean()  # 一个标量，作为基准
-
-    # keys_expand 是压缩的 keys，形状为 (bsz, num_heads, q_len, head_dim)
-    # queries_expand 是压缩的 queries，形状为 (bsz, num_heads, window_size, head_dim)
-
-    # 单独计算每个 head_dim 的注意力分数
-    dim_attention_scores = []  # 存储每个 dim 的裁剪结果
-    dim_attention_contributions = []  # 存储每个 dim 对总范数的贡献
-    breakpoint()
-    dim_contributions = []
-    for d in range(module.head_dim):
-        # 提取单维度的 queries 和 keys
-        queries_single_dim = queries[..., d]  # (bsz, num_heads, query_len)
-        keys_single_dim = keys[..., d]  # (bsz, num_heads, key_len)
-
-        # 计算单维度的 attention_scores
-        attention_scores_single_dim = torch.matmul(queries_single_dim.unsqueeze(-1), keys_single_dim.unsqueeze(-2))
-        
-        # 计算单维度的范数
-        dim_norm = torch.norm(attention_scores_single_dim, dim=(-2, -1), p=2)  # (bsz, num_heads)
-        dim_contributions.append(dim_norm)
-
-    # 将每个维度的范数堆叠到一起
-    dim_contributions = torch.stack(dim_contributions, dim=-1)  # (bsz, num_heads, head_dim)
-
-    # 计算每个维度的平均贡献（用于排序）
-    dim_contribution_mean = dim_contributions.mean(dim=(0, 1))  # 平均贡献 (head_dim,)
-
-    sorted_indices = torch.argsort(dim_contribution_mean, descending=True)
-    # # 将所有通道的结果堆叠起来
-    # dim_attention_contributions = torch.stack(dim_attention_contributions, dim=-1)  # (bsz, num_heads, head_dim)
-
-    # # 计算通道贡献的总体排序
-    # dim_contribution_mean = dim_attention_contributions.mean(dim=(0, 1))  # 平均贡献 (head_dim,)
-    # sorted_indices = torch.argsort(dim_contribution_mean, descending=True)  # 从高到低排序
-
-    # # 初始化裁剪后的 keys 和累计误差
-    # mask = torch.zeros_like(keys, dtype=torch.bool)  # (bsz, num_heads, q_len, head_dim)
-    # current_attention_norm = 0.0
-
-    # # 逐步裁剪通道
-    # for i, dim_idx in enumerate(sorted_indices):
-    #     # 开启当前维度的 mask
-    #     mask[:, :, :, dim_idx] = True
-
-    #     # 计算裁剪后的 keys
-    #     keys_compressed = keys * mask.unsqueeze(-2)  # (bsz, num_heads, q_len, head_dim)
-
-    #     # 计算裁剪后的注意力分数
-    #     attention_scores_compressed = torch.matmul(queries, keys_compressed.transpose(-1, -2))
-    #     current_attention_norm = torch.norm(attention_scores_compressed, dim=(-2, -1), p=2).mean()
-
-    #     # 误差计算
-    #     error_percentage = (attention_norm_baseline - current_attention_norm) / attention_norm_baseline
-
-    #     # 判断是否满足误差阈值
-    #     if error_percentage < 0.01:  # 如果误差小于 1%
-    #         break
-
-    # return keys * mask.unsqueeze(-2)
-
-
-def prune_keys_to_norm(keys, queries_norm, threshold_ratio=0.99):
+def prune_keys_to_norm(keys, queries_norm, threshold_ratio=0.99, stats=None, layer_idx=0):
     """
-    对每个 token 的 keys 动态裁剪 channel，保持范数为原始范数的 98%。
+    对每个 token 的 keys 动态裁剪 channel，保留原始平方范数 (energy) 的 threshold_ratio。
     keys: shape (bsz, num_heads, seq_len, head_dim)
-    threshold_ratio: 保留范数比例，默认为 98%。
+    threshold_ratio: 保留范数比例，默认为 99%。
     返回: 裁剪后的 keys (bsz, num_heads, seq_len, head_dim)
     """
-    bsz, num_heads, seq_len, head_dim = keys.shape
-    # breakpoint()
-    # Step 1: 计算原始 Frobenius 范数
     keys_squared = torch.pow(keys, 2)  # 每个 channel 的平方值
-    # keys_norm = torch.matmul(queries_norm, keys_squared)
-    # key_scores = queries_norm * keys_squared
-    original_norm = keys_squared.sum(dim=-1, keepdim=True)  # 每个 token 的原始范数 (bsz, num_heads, seq_len, 1)
-    
-    # Step 2: 按 channel 的贡献排序
-    sorted_indices = torch.argsort(keys_squared, dim=-1, descending=True)  # 每个 token 按 channel 贡献排序 (bsz, num_heads, seq_len, head_dim)
-    
-    # Step 3: 动态选择 top-k channels
-    cumulative_sum = torch.zeros_like(keys_squared)  # 用于存储累积和
-    mask = torch.zeros_like(keys_squared, dtype=torch.bool)  # 用于标记保留的 channel
-    idx = 0
-    for i in range(head_dim):
-        index = sorted_indices[:, :, :, i]  # 当前最高贡献的 channel 索引
-        # breakpoint()
-        cur_score = torch.sum(keys_squared.gather(-1, sorted_indices[:, :, :, :i+1]), dim=-1).unsqueeze(-1)
-        cumulative_sum.scatter_add_(-1, index.unsqueeze(-1), cur_score) 
-        # cumulative_sum.scatter_add_(-1, index.unsqueeze(-1), keys_squared.gather(-1, index.unsqueeze(-1)))  # 更新累积和
-        current_ratio = cumulative_sum / original_norm # 当前累积平方和与原始平方和的比例
-        mask = mask | (current_ratio > threshold_ratio)  # 保留当前 channel
-        if torch.all(cur_score / original_norm > threshold_ratio):
-            print('get threshold! Skip!')
-            # breakpoint()
-            break
+    mask = cumulative_channel_selection(keys_squared, threshold_ratio)
 
-    
-    num_selected_channels = torch.sum(mask).item()  # 统计所有位置中被选中的 channel 数量
-    print(f"Number of selected channels: {num_selected_channels}")
-    selected_channels_per_token = torch.sum(mask, dim=-1)  # (bsz, num_heads, seq_len)
-    print(f"Selected channels per token shape: {selected_channels_per_token}")
-    print(f"Example: Selected channels for [batch=0, head=0, token=0]: {selected_channels_per_token[0, 0, 0].item()}")
-    # print(idx)
-            # breakpoint()
-        # if current_ratio >= threshold_ratio and idx == 0:
-        #     idx = i + 1
-        #     print(idx)
-    # Step 4: 裁剪 keys
-    pruned_keys = keys * mask.float()  # 将未保留的 channel 设置为 0
-    return pruned_keys
\ No newline at end of file
+    if stats is not None:
+        stats.update(layer_idx, mask)  # 统计所有位置中被选中的 channel 数量
+
+    # 裁剪 keys
+    pruned_keys = keys * mask  # 将未保留的 channel 设置为 0
+    return pruned_keys
@@ -0,0 +1,159 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+
+import json
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+class AdaThinKStats:
+    """
+    Accumulate AdaThinK channel selection statistics without host synchronization.
+    Kept channel counts (per layer and head), group histograms (per layer, head and group) and histograms of the
+    threshold positions (per layer, head and sorted channel position) are summed on the device of each layer, and
+    only moved to the host when summary(), to_json(), to_npz() or to_profile() is called.
+    If verbose is True, the legacy per-layer logs ("Number of selected channels: ...") are printed, which forces a
+    host sync per layer.
+    """
+
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.head_dim: Optional[int] = None
+        self.kept_channels: dict[int, torch.Tensor] = {}  # layer_idx -> (num_heads,) number of kept channels
+        self.tokens: dict[int, int] = {}  # layer_idx -> number of tokens seen per head
+        self.group_counts: dict[int, torch.Tensor] = {}  # layer_idx -> (num_heads, n_groups) number of tokens
+        self.threshold_counts: dict[int, torch.Tensor] = {}  # layer_idx -> (num_heads, head_dim) number of tokens
+
+    def update(
+        self,
+        layer_idx: int,
+        mask: torch.Tensor,
+        group_indicator: Optional[torch.Tensor] = None,
+        n_groups: int = 0,
+        threshold_indices: Optional[torch.Tensor] = None,
+    ):
+        """
+        Record the (bsz, num_heads, seq_len, head_dim) boolean mask of kept channels of a layer and, for grouped
+        selections, the (bsz, num_heads, seq_len) group of each token. For threshold selections, threshold_indices
+        is the (bsz, num_heads, seq_len) sorted position at which each token reaches the threshold.
+        """
+        bsz, num_heads, seq_len, head_dim = mask.shape
+        self.head_dim = head_dim
+
+        kept_channels = mask.sum(dim=(0, 2, 3))
+        if layer_idx in self.kept_channels:
+            kept_channels = kept_channels + self.kept_channels[layer_idx]
+        self.kept_channels[layer_idx] = kept_channels
+        self.tokens[layer_idx] = self.tokens.get(layer_idx, 0) + bsz * seq_len
+
+        if group_indicator is not None and n_groups > 0:
+            group_counts = torch.zeros(num_heads, n_groups, dtype=torch.long, device=mask.device)
+            group_indicator = group_indicator.long().transpose(0, 1).reshape(num_heads, -1)
+            group_counts.scatter_add_(1, group_indicator, torch.ones_like(group_indicator))
+            if layer_idx in self.group_counts and self.group_counts[layer_idx].shape == group_counts.shape:
+                group_counts = group_counts + self.group_counts[layer_idx]
+            self.group_counts[layer_idx] = group_counts
+
+        if threshold_indices is not None:
+            threshold_counts = torch.zeros(num_heads, head_dim, dtype=torch.long, device=mask.device)
+            threshold_indices = threshold_indices.long().transpose(0, 1).reshape(num_heads, -1)
+            threshold_counts.scatter_add_(1, threshold_indices, torch.ones_like(threshold_indices))
+            if layer_idx in self.threshold_counts:
+                threshold_counts = threshold_counts + self.threshold_counts[layer_idx]
+            self.threshold_counts[layer_idx] = threshold_counts
+
+        if self.verbose:
+            selected_channels_per_token = mask.sum(dim=-1)
+            print(f"Number of selected channels: {mask.sum().item()}")
+            print(f"Selected channels per token shape: {selected_channels_per_token}")
+            print(f"Example: Selected channels for [batch=0, head=0, token=0]: {selected_channels_per_token[0, 0, 0].item()}")
+
+    def summary(self) -> dict:
+        """
+        Per-layer and per-head kept channel ratios and group histograms, as plain python objects
+        """
+        layers = {}
+        total_kept, total_channels = 0, 0
+        for layer_idx in sorted(self.kept_channels):
+            kept_channels = self.kept_channels[layer_idx].cpu()
+            n_channels = self.tokens[layer_idx] * self.head_dim
+            layers[layer_idx] = {
+                "kept_ratio": kept_channels.sum().item() / (n_channels * len(kept_channels)),
+                "head_kept_ratios": (kept_channels.double() / n_channels).tolist(),
+                "tokens": self.tokens[layer_idx],
+            }
+            if layer_idx in self.group_counts:
+                layers[layer_idx]["group_histogram"] = self.group_counts[layer_idx].cpu().tolist()
+            total_kept += kept_channels.sum().item()
+            total_channels += n_channels * len(kept_channels)
+
+        return {
+            "head_dim": self.head_dim,
+            "kept_ratio": total_kept / total_channels if total_channels > 0 else None,
+            "layers": layers,
+        }
+
+    def to_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def to_npz(self, path: str):
+        """
+        Save the raw counts: kept_channels (num_layers, num_heads), tokens (num_layers,) and, if any,
+        group_counts (num_layers, num_heads, n_groups). Layers are sorted by layer_idx.
+        """
+        layer_indices = sorted(self.kept_channels)
+        arrays = {
+            "layer_indices": np.array(layer_indices),
+            "kept_channels": torch.stack([self.kept_channels[i].cpu() for i in layer_indices]).numpy(),
+            "tokens": np.array([self.tokens[i] for i in layer_indices]),
+            "head_dim": np.array(self.head_dim),
+        }
+        if len(self.group_counts) == len(layer_indices):
+            arrays["group_counts"] = torch.stack([self.group_counts[i].cpu() for i in layer_indices]).numpy()
+        if len(self.threshold_counts) == len(layer_indices):
+            arrays["threshold_counts"] = torch.stack([self.threshold_counts[i].cpu() for i in layer_indices]).numpy()
+        np.savez(path, **arrays)
+
+    def to_profile(self, path: str, n_groups: int = 4, **metadata):
+        """
+        Save a calibration profile (see calibrate.py and AdaThinKPress.profile) built from the threshold positions.
+        For each layer and head, tokens are split in n_groups groups of equal size by their threshold position:
+        - boundaries: group boundaries, as fractions of head_dim (same convention as GROUP_PRESETS)
+        - group_keep_ratios: expected fraction of channels needed by the tokens of each group
+        - keep_ratio: expected fraction of channels needed to reach the threshold
+        """
+        assert len(self.threshold_counts) > 0, "No threshold positions recorded, calibrate with threshold_ratio != 0"
+        head_dim = self.head_dim
+        needed_channels = torch.arange(1, head_dim + 1, dtype=torch.float64)
+        quantiles = torch.arange(1, n_groups, dtype=torch.float64) / n_groups
+
+        layers = {}
+        for layer_idx in sorted(self.threshold_counts):
+            counts = self.threshold_counts[layer_idx].cpu().double()  # (num_heads, head_dim)
+            cdf = counts.cumsum(dim=-1) / counts.sum(dim=-1, keepdim=True)
+            boundaries = torch.searchsorted(cdf, quantiles.expand(len(cdf), -1).contiguous())  # (num_heads, n_groups - 1)
+            positions = torch.arange(head_dim).expand(len(counts), -1).contiguous()
+            group_indicator = torch.searchsorted(boundaries, positions)  # (num_heads, head_dim), as bucketize
+
+            group_tokens = torch.zeros(len(counts), n_groups, dtype=torch.float64)
+            group_needed = torch.zeros(len(counts), n_groups, dtype=torch.float64)
+            group_tokens.scatter_add_(1, group_indicator, counts)
+            group_needed.scatter_add_(1, group_indicator, counts * needed_channels)
+            group_keep_ratios = group_needed / group_tokens.clamp(min=1) / head_dim
+
+            layers[layer_idx] = {
+                "keep_ratio": ((counts * needed_channels).sum(-1) / counts.sum(-1) / head_dim).tolist(),
+                "boundaries": (boundaries.double() / head_dim).tolist(),
+                "group_keep_ratios": group_keep_ratios.tolist(),
+            }
+
+        profile = {**metadata, "head_dim": head_dim, "n_groups": n_groups, "layers": layers}
+        with open(path, "w") as f:
+            json.dump(profile, f, indent=4)
@@ -18,9 +18,22 @@ from transformers import (
     Qwen2ForCausalLM,
 )
 
+from kvpress.compact_cache import CompactKeyCache
+
 logger = logging.getLogger(__name__)
 
 
+def get_window_queries(kwargs: dict, window_size: int):
+    """
+    Last window_size rotated query states (bsz, num_heads, window_size, head_dim) captured by the attention forward
+    (see attention_patch), or None if they were not captured for at least window_size tokens
+    """
+    window_queries = kwargs.get("window_queries")
+    if window_queries is None or window_queries.shape[2] < window_size:
+        return None
+    return window_queries[:, :, -window_size:]
+
+
 @dataclass
 class BasePress:
     """
@@ -69,6 +82,7 @@ class BasePress:
         The hook calls the compress method to compress the KV cache while ensuring:
             - compression is only applied only during the pre-filling phase
             - KV cache quantization is handled correctly
+            - compact key layouts returned by `compress` are stored in a CompactKeyCache
 
         Parameters
         ----------
@@ -95,27 +109,87 @@ class BasePress:
         if kwargs["cache_position"][-1] > q_len:
             return output
 
+        if getattr(module, "window_queries", None) is not None:
+            kwargs = {**kwargs, "window_queries": module.window_queries}
+        keys, values = self.read_cache(module, cache)
+        keys, values = self.compress(module, hidden_states, keys, values, output[1], kwargs)
+        self.write_cache(module, cache, keys, values)
+
+        return output
+
+    def read_cache(self, module: nn.Module, cache) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Dense keys and values of the layer, as given to `compress`
+        """
         if isinstance(cache, QuantizedCache):
             keys = cache._dequantize(cache._quantized_key_cache[module.layer_idx])
             values = cache._dequantize(cache._quantized_value_cache[module.layer_idx])
+        elif isinstance(cache, CompactKeyCache):
+            keys = cache.get_dense_keys(module.layer_idx)
+            values = cache.value_cache[module.layer_idx]
         else:
             keys = cache.key_cache[module.layer_idx]
             values = cache.value_cache[module.layer_idx]
+        return keys, values
 
-        keys, values = self.compress(module, hidden_states, keys, values, output[1], kwargs)
-
+    def write_cache(self, module: nn.Module, cache, keys, values: torch.Tensor):
+        """
+        Write the compressed keys (a dense tensor or a compact layout) and values of the layer to the cache
+        """
         if isinstance(cache, QuantizedCache):
             cache._quantized_key_cache[module.layer_idx] = cache._quantize(keys, axis=cache.axis_key)
             cache._quantized_value_cache[module.layer_idx] = cache._quantize(values, axis=cache.axis_value)
             cache.key_cache[module.layer_idx] = torch.zeros(0, dtype=keys.dtype, device=keys.device)
             cache.value_cache[module.layer_idx] = torch.zeros(0, dtype=keys.dtype, device=keys.device)
             cache._seen_tokens = keys.shape[2]
+        elif isinstance(cache, CompactKeyCache):
+            cache.store(module.layer_idx, keys, values)
+            module.compact_keys = cache.get_compact_keys(module.layer_idx)
+            module.key_channels = cache.get_key_channels(module.layer_idx)
+            module.key_basis = cache.get_key_basis(module.layer_idx)
         else:
             cache.key_cache[module.layer_idx] = keys
             cache.value_cache[module.layer_idx] = values
 
+    @property
+    def query_window_size(self) -> int:
+        """
+        Number of last queries the press reads at prefill, captured by the attention forward (see attention_patch)
+        """
+        if isinstance(getattr(self, "press", None), BasePress):
+            return self.press.query_window_size
+        return getattr(self, "window_size", 0)
+
+    @property
+    def compresses_decoding(self) -> bool:
+        """
+        Whether the press also compresses the keys and values appended during decoding (see decoding_hook)
+        """
+        return False
+
+    def decoding_hook(self, module: nn.Module, input: list[torch.Tensor], kwargs: dict, output: list):
+        """
+        Forward hook called after the forward pass of an attention layer while the answers are generated, if
+        compresses_decoding is True. Does nothing by default.
+        """
         return output
 
+    @contextmanager
+    def decoding(self, model: PreTrainedModel) -> Generator:
+        """
+        Context manager registering decoding_hook during the generation of the answers (no hook is registered if
+        compresses_decoding is False)
+        """
+        hooks = []
+        try:
+            if self.compresses_decoding:
+                for layer in model.model.layers:
+                    hooks.append(layer.self_attn.register_forward_hook(self.decoding_hook, with_kwargs=True))
+            yield
+        finally:
+            for forward_hook in hooks:
+                forward_hook.remove()
+
     @contextmanager
     def __call__(self, model: PreTrainedModel) -> Generator:
         """
@@ -135,8 +209,11 @@ class BasePress:
         try:
             for layer in model.model.layers:
                 layer.self_attn.rotary_emb = model.model.rotary_emb
+                layer.self_attn.query_window_size = self.query_window_size
                 hooks.append(layer.self_attn.register_forward_hook(self.forward_hook, with_kwargs=True))
             yield
         finally:
             for forward_hook in hooks:
                 forward_hook.remove()
+            for layer in model.model.layers:
+                layer.self_attn.query_window_size = 0
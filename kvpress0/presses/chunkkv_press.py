@@ -90,20 +90,26 @@ class ChunkKVPress(BasePress):
         n_chunks_kept = max(1, int((num_complete_chunks + (remaining_tokens > 0)) * (1 - self.press.compression_ratio)))
         top_chunks = chunk_scores.topk(n_chunks_kept, dim=-1)
 
-        # 4. Create indices for selected chunks
-        indices = []
-        for chunk_idx in top_chunks.indices[0]:
-            if chunk_idx < num_complete_chunks:
-                # For complete chunks
-                start_idx = chunk_idx * self.chunk_length
-                chunk_indices = torch.arange(start_idx, start_idx + self.chunk_length, device=keys.device)
-            else:
-                # For the remaining partial chunk
-                chunk_indices = torch.arange(num_complete_chunks * self.chunk_length, kv_len, device=keys.device)
-            indices.append(chunk_indices)
-
-        indices = torch.cat(indices).sort()[0]
-        indices = indices.view(1, 1, -1, 1).expand(keys.shape[0], keys.shape[1], -1, module.head_dim)
+        # 4. Expand the selected chunks to token indices with a single broadcasted operation per batch row.
+        # Sorted chunks give sorted indices, so the positions of the remaining partial chunk beyond kv_len are at
+        # the end of a row. Rows are cut to the longest one and, if the remaining chunk was selected by some rows
+        # only, the padding positions of the other rows are masked (see attention_patch.py)
+        bsz, num_key_value_heads = keys.shape[:2]
+        chunk_indices = top_chunks.indices.sort(dim=-1).values
+        indices = chunk_indices.unsqueeze(-1) * self.chunk_length + torch.arange(self.chunk_length, device=keys.device)
+        indices = indices.flatten(1)
+        if remaining_tokens > 0:
+            valid = indices < kv_len
+            n_tokens = int(valid.sum(dim=-1).max())
+            indices, padded = indices[:, :n_tokens].clamp(max=kv_len - 1), ~valid[:, :n_tokens]
+            if padded.any():
+                batch_indices, seq_indices = padded.nonzero(as_tuple=True)
+                head_indices = torch.arange(num_key_value_heads, device=keys.device).repeat(len(batch_indices))
+                batch_indices = batch_indices.repeat_interleave(num_key_value_heads)
+                seq_indices = seq_indices.repeat_interleave(num_key_value_heads)
+                module.masked_key_indices = (batch_indices, head_indices, seq_indices)
+
+        indices = indices.view(bsz, 1, -1, 1).expand(-1, num_key_value_heads, -1, module.head_dim)
 
         # 5. Use gather to collect selected keys and values
         keys = keys.gather(2, indices).contiguous()
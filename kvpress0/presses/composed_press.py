@@ -3,15 +3,25 @@ from dataclasses import dataclass
 from kvpress.presses.adakv_press import AdaKVPress
 from kvpress.presses.base_press import BasePress
 from kvpress.presses.observed_attention_press import ObservedAttentionPress
+from kvpress.presses.snapkv_press import SnapKVPress
 
 
 @dataclass
 class ComposedPress(BasePress):
     """
     Chain multiple presses together to create a composed press
+
+    The window queries of all presses are captured once by the attention forward, for the largest window of the
+    presses (see query_window_size and get_window_queries).
+
+    If fused is True, the presses are applied in a single pass per layer: the cache is read once, the `compress`
+    methods are chained on the intermediate keys and values, and the cache is written once. If the window queries
+    were not captured, they are computed once and shared through kwargs["window_queries"]. This requires presses
+    that do not override `forward_hook`.
     """
 
     presses: list[BasePress]
+    fused: bool = False
 
     def __post_init__(self):
         self.compression_ratio = None
@@ -20,9 +30,56 @@ class ComposedPress(BasePress):
         ), "ComposedPress cannot contains ObservedAttentionPress or AdaKVPress"
 
     def forward_hook(self, module, input, kwargs, output):
+        if self.fused:
+            return self.fused_forward_hook(module, input, kwargs, output)
+
         self.compression_ratio = 1.0
         for press in self.presses:
             # breakpoint()
             output = press.forward_hook(module, input, kwargs, output)
             self.compression_ratio *= press.compression_ratio  # type: ignore
         return output
+
+    def fused_forward_hook(self, module, input, kwargs, output):
+        assert all(
+            type(press).forward_hook is BasePress.forward_hook for press in self.presses
+        ), "fused ComposedPress requires presses using the default forward_hook"
+
+        hidden_states = kwargs["hidden_states"]
+        cache = kwargs["past_key_value"]
+        q_len = hidden_states.shape[1]
+
+        # Don't compress after pre-filling
+        if kwargs["cache_position"][-1] > q_len:
+            return output
+
+        window_size = self.query_window_size
+        window_queries = getattr(module, "window_queries", None)
+        if window_size > 0 and (window_queries is None or window_queries.shape[2] < window_size):
+            window_queries = SnapKVPress.compute_window_query_states(
+                module, hidden_states, window_size, kwargs["position_embeddings"]
+            )
+        if window_queries is not None:
+            kwargs = {**kwargs, "window_queries": window_queries}
+
+        keys, values = self.read_cache(module, cache)
+        self.compression_ratio = 1.0
+        for press in self.presses:
+            keys, values = press.compress(module, hidden_states, keys, values, output[1], kwargs)
+            self.compression_ratio *= press.compression_ratio  # type: ignore
+        self.write_cache(module, cache, keys, values)
+
+        return output
+
+    @property
+    def query_window_size(self) -> int:
+        return max(press.query_window_size for press in self.presses)
+
+    @property
+    def compresses_decoding(self) -> bool:
+        return any(press.compresses_decoding for press in self.presses)
+
+    def decoding_hook(self, module, input, kwargs, output):
+        for press in self.presses:
+            output = press.decoding_hook(module, input, kwargs, output)
+        return output
@@ -5,7 +5,6 @@ import logging
 from dataclasses import dataclass
 
 import torch
-from transformers.models.llama.modeling_llama import repeat_kv
 
 from kvpress.presses.base_press import BasePress
 from kvpress.presses.scorer_press import ScorerPress
@@ -17,13 +16,16 @@ logger = logging.getLogger(__name__)
 class CriticalKVPress(ScorerPress):
     """
     CriticalKV (https://arxiv.org/abs/2502.03805) rescales the scores of a ScorerPress by
-    the L1 norm of Wo @ values
+    the L1 norm of Wo @ values. The norm is computed by chunks of chunk_size tokens (see vwl1norm).
     """
 
-    def __init__(self, press: ScorerPress, epsilon: float = 1e-4, first_stage_ratio: float = 0.5):
+    def __init__(
+        self, press: ScorerPress, epsilon: float = 1e-4, first_stage_ratio: float = 0.5, chunk_size: int = 1024
+    ):
         self.press = press
         self.epsilon = epsilon
         self.first_stage_ratio = first_stage_ratio
+        self.chunk_size = chunk_size
 
         assert isinstance(self.press, ScorerPress), "CriticalAdaKVPress requires a ScorerPress as input"
         if isinstance(self.press, ExpectedAttentionPress) and self.press.use_vnorm:
@@ -38,24 +40,20 @@ class CriticalKVPress(ScorerPress):
         self.press.compression_ratio = value
 
     @staticmethod
-    def vwl1norm(values, module):
+    def vwl1norm(values, module, chunk_size: int = 1024):
+        """
+        L1 norm of Wo_h @ v for each head h, averaged over the heads of each key-value group.
+        Values are broadcast against the Wo blocks of their group instead of being repeated, and tokens are
+        processed by chunks so that the peak memory is bounded by (bsz, num_heads, chunk_size, hidden_size).
+        """
         bsz, num_key_value_heads, q_len, _ = values.shape
-        num_key_value_groups = module.config.num_attention_heads // num_key_value_heads
-        Wo = module.o_proj.weight.transpose(0, 1)
-        Wo = Wo.view(module.config.num_attention_heads, module.config.head_dim, module.config.hidden_size)
-        V = repeat_kv(values, num_key_value_groups)
-
-        # We use head-wise computation instead of direct matmul to reduce the memory usage of WoV.
-        # Future kernel fusion optimization could eliminate this intermediate variables to enhance performance.
-        head_WoV_norm_list = []
-        for head in range(V.size(1)):
-            head_WoV = V[: , head, : , ...].matmul(Wo[head, ...].unsqueeze(0))
-            head_WoV_norm = torch.norm(head_WoV, p=1, dim=-1)
-            head_WoV_norm_list.append(head_WoV_norm)
-
-        # b_size, num_heads, q_len , k_len
-        WoV_norm = torch.stack(head_WoV_norm_list, dim=1)
-        WoV_norm = WoV_norm.view(bsz, num_key_value_heads, module.num_key_value_groups, q_len).mean(dim=2)
+        Wo = get_wo_heads(module, num_key_value_heads)
+
+        WoV_norm = values.new_empty(bsz, num_key_value_heads, q_len)
+        for start in range(0, q_len, chunk_size):
+            V = values[:, :, None, start : start + chunk_size]  # (bsz, num_key_value_heads, 1, chunk_size, head_dim)
+            WoV = torch.matmul(V, Wo)  # (bsz, num_key_value_heads, num_key_value_groups, chunk_size, hidden_size)
+            WoV_norm[..., start : start + chunk_size] = torch.norm(WoV, p=1, dim=-1).mean(dim=2)
         return WoV_norm
 
     def score(self, module, hidden_states, keys, values, attentions, kwargs):
@@ -66,7 +64,7 @@ class CriticalKVPress(ScorerPress):
         top_k_index = torch.topk(scores, selection_budget, sorted=True, dim=-1).indices
 
         # Stage 2
-        projected_norm = self.vwl1norm(values, module)
+        projected_norm = self.vwl1norm(values, module, self.chunk_size)
         scores = (scores + self.epsilon) * projected_norm
 
         # Merge the two stages
@@ -86,6 +84,7 @@ class CriticalAdaKVPress(BasePress):
     alpha_safeguard: float = 0.20
     epsilon: float = 1e-4
     first_stage_ratio: float = 0.5
+    chunk_size: int = 1024
 
     def __post_init__(self):
         assert 0 <= self.alpha_safeguard <= 1, "alpha_safeguard should be in 0, 1]"
@@ -139,19 +138,13 @@ class CriticalAdaKVPress(BasePress):
         head_budgets.scatter_add_(0, top_indices_head_idx.flatten(), torch.ones_like(top_indices_head_idx.flatten()))
 
         # Stage 1
-        head_selection_budget_1st = (head_budgets * self.first_stage_ratio).to(torch.int64).tolist()
-        top_k_index = torch.topk(scores, max(head_selection_budget_1st), sorted=True, dim=-1).indices
-        for head_idx in range(num_key_value_heads):
-            phase1_budget = head_selection_budget_1st[head_idx]
-            scores[:, head_idx, :].scatter_(-1, top_k_index[:, head_idx, :phase1_budget], torch.finfo(scores.dtype).max)
+        head_selection_budget_1st = (head_budgets * self.first_stage_ratio).to(torch.int64)
+        scores.masked_fill_(head_budget_mask(scores, head_selection_budget_1st), torch.finfo(scores.dtype).max)
 
         # Stage 2
-        projected_norm = CriticalKVPress.vwl1norm(values, module)
+        projected_norm = CriticalKVPress.vwl1norm(values, module, self.chunk_size)
         scores = (scores + self.epsilon) * projected_norm
-        top_k_index = torch.topk(scores, max(head_budgets), sorted=True, dim=-1).indices
-        for head_idx in range(num_key_value_heads):
-            budget = head_budgets[head_idx]
-            scores[:, head_idx, :].scatter_(-1, top_k_index[:, head_idx, :budget], torch.finfo(scores.dtype).max)
+        scores.masked_fill_(head_budget_mask(scores, head_budgets), torch.finfo(scores.dtype).max)
 
         ##########################
         # End of CriticalKV code #
@@ -167,3 +160,32 @@ class CriticalAdaKVPress(BasePress):
         seq_indices = indices % q_len
         module.masked_key_indices = (batch_indices, head_indices, seq_indices)
         return keys, values
+
+
+def head_budget_mask(scores, head_budgets):
+    """
+    Mask of the head_budgets[h] highest scores of each head h, built on device by comparing the rank of each
+    score with the budget of its head (no host synchronization, unlike a per-head top-k of varying size).
+
+    Args:
+        scores: Tensor of shape (bsz, num_key_value_heads, q_len)
+        head_budgets: int64 Tensor of shape (num_key_value_heads,)
+    """
+    order = torch.argsort(scores, dim=-1, descending=True)
+    ranks = torch.arange(scores.shape[-1], device=scores.device)
+    in_budget = (ranks < head_budgets.view(1, -1, 1)).expand_as(order)
+    return torch.empty_like(in_budget).scatter_(-1, order, in_budget)
+
+
+def get_wo_heads(module, num_key_value_heads):
+    """
+    View of the output projection as (num_key_value_heads, num_key_value_groups, head_dim, hidden_size) blocks.
+    The view is cached on the attention module and reused across requests while o_proj keeps the same storage.
+    """
+    weight = module.o_proj.weight
+    Wo = getattr(module, "wo_heads", None)
+    if Wo is None or Wo.data_ptr() != weight.data_ptr() or Wo.dtype != weight.dtype:
+        num_key_value_groups = module.config.num_attention_heads // num_key_value_heads
+        Wo = weight.transpose(0, 1).view(num_key_value_heads, num_key_value_groups, -1, weight.shape[0])
+        module.wo_heads = Wo
+    return Wo
@@ -3,6 +3,7 @@
 
 
 import math
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import torch
@@ -24,6 +25,7 @@ class ExpectedAttentionPress(ScorerPress):
         E(A) = exp(K @ mean.T / sqrt(d) + 1/2 K @ cov @ K.T / d)
         5. Rescale the scores using (scores + epsilon) * ||V||_2
     The first n_sink tokens are removed from calculations (sink attention phenomenon).
+    The averaged rotation matrices R are kept in an LRU cache of max_cached_rotations entries.
     """
 
     compression_ratio: float = 0.0
@@ -33,6 +35,38 @@ class ExpectedAttentionPress(ScorerPress):
     use_vnorm: bool = True
     epsilon: float = 0.0
     max_capacity_prompt = None
+    max_cached_rotations = 64
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.rotation_cache = OrderedDict()
+
+    def get_average_rotation(self, module: nn.Module, q_len: int, dtype: torch.dtype, device: torch.device):
+        """
+        Compute the RoPE rotation matrix R on the next n_future_positions, averaged over positions. R only depends
+        on (q_len, n_future_positions, head_dim) for a given rotary embedding, so it is cached across layers and
+        requests.
+        """
+        d = module.head_dim
+        key = (q_len, self.n_future_positions, d, dtype, device, id(module.rotary_emb))
+        if key in self.rotation_cache:
+            self.rotation_cache.move_to_end(key)
+            return self.rotation_cache[key]
+
+        position_ids = torch.arange(q_len, q_len + self.n_future_positions).unsqueeze(0).to(device)
+        cos, sin = module.rotary_emb(torch.empty(0, dtype=dtype, device=device), position_ids)
+        cos, sin = cos[0], sin[0]
+
+        Id = torch.eye(d, device=cos.device, dtype=cos.dtype)
+        P = torch.zeros((d, d), device=cos.device, dtype=cos.dtype)
+        P[d // 2 :, : d // 2], P[: d // 2, d // 2 :] = torch.eye(d // 2), -torch.eye(d // 2)
+        R = cos.unsqueeze(1) * Id + sin.unsqueeze(1) * P
+        R = R.mean(dim=0).to(device)
+
+        self.rotation_cache[key] = R
+        if len(self.rotation_cache) > self.max_cached_rotations:
+            self.rotation_cache.popitem(last=False)
+        return R
 
     def get_query_statistics(self, module: nn.Module, hidden_states: torch.Tensor):
         """
@@ -57,27 +91,16 @@ class ExpectedAttentionPress(ScorerPress):
         mu = torch.matmul(mean_h, Wq.T).squeeze(1)
         mu = mu.view(bsz, n, d)
 
-        # Query covariance
+        # Query covariance, only the diagonal (per head) blocks of Wq @ cov @ Wq.T are computed
         cov = None
         if self.use_covariance:
             h = h - mean_h
             cov = torch.matmul(h.transpose(1, 2), h) / h.shape[1]
-            cov = torch.matmul(Wq, torch.matmul(cov, Wq.T))  # TODO: not optimal
-            cov = cov.view(bsz, n, d, n, d).diagonal(dim1=1, dim2=3)
-            cov = cov.permute(0, 3, 1, 2)
-
-        # RoPE rotation matrix on next n_future_positions
-        position_ids = torch.arange(q_len, q_len + self.n_future_positions).unsqueeze(0).to(mu.device)
-        cos, sin = module.rotary_emb(mu, position_ids)
-        cos, sin = cos[0], sin[0]
-
-        Id = torch.eye(d, device=cos.device, dtype=cos.dtype)
-        P = torch.zeros((d, d), device=cos.device, dtype=cos.dtype)
-        P[d // 2 :, : d // 2], P[: d // 2, d // 2 :] = torch.eye(d // 2), -torch.eye(d // 2)
-        R = cos.unsqueeze(1) * Id + sin.unsqueeze(1) * P
+            cov = torch.matmul(cov, Wq.T).view(bsz, -1, n, d).permute(0, 2, 1, 3)  # (bsz, n, hidden_size, d)
+            cov = torch.matmul(Wq.view(n, d, -1), cov)  # (bsz, n, d, d)
 
-        # Apply average rotation to the mean and covariance
-        R = R.mean(dim=0).to(mu.device)
+        # Apply the average RoPE rotation on next n_future_positions to the mean and covariance
+        R = self.get_average_rotation(module, q_len, mu.dtype, mu.device)
         mu = torch.matmul(mu, R.T)
         if self.use_covariance:
             cov = torch.matmul(R, torch.matmul(cov, R.T))
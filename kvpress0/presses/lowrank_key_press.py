@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+
+from dataclasses import dataclass
+
+import torch
+from torch import nn
+
+from kvpress.compact_cache import CompactKeyCache, ProjectedKeys
+from kvpress.presses.adathink_press import AdaThinKPress, cumulative_channel_selection
+from kvpress.presses.base_press import BasePress, get_window_queries
+
+
+@dataclass
+class LowRankKeyPress(BasePress):
+    """
+    Low-rank counterpart of AdaThinKPress: instead of selecting channels, the keys of each head are projected onto
+    a rank-r basis computed at prefill from the keys and the window queries (see compute_window_queries).
+    The basis is made of the eigenvectors u of the key covariance K^T K (eigenvalue l_u), and, as the channel
+    contributions of AdaThinK, directions are scored with the query-aware energy l_u * ||Q u|| ** 2 of the attention
+    logits. Each head keeps the smallest set of directions carrying energy_ratio of its total energy (same
+    cumulative threshold as AdaThinK), so the rank varies per head. The basis of a layer is stored with the largest
+    rank over its heads, heads of lower rank being padded with zero columns, so the memory of a layer is set by its
+    highest-rank head: compression_ratio reports the bytes actually saved (padded rank), while self.head_ranks holds
+    the (bsz, num_key_value_heads) rank each head needs, per layer, for the current request.
+
+    With a CompactKeyCache, keys are stored as ProjectedKeys: dense (bsz, num_key_value_heads, seq_len, rank)
+    coefficients, and the keys appended during decoding as well as the queries (see attention_patch) are projected
+    onto the same basis, so decoding dot products are over rank dimensions. Otherwise, keys are replaced by their
+    low-rank approximation (no memory gain) to measure the accuracy of the projection.
+    """
+
+    energy_ratio: float = 0.99
+    window_size: int = 32
+
+    compute_window_queries = AdaThinKPress.compute_window_queries
+
+    def __post_init__(self):
+        assert 0 < self.energy_ratio <= 1, "energy_ratio must be in (0, 1]"
+        self.compression_ratios = []
+        self.head_ranks = []
+
+    def compress(
+        self,
+        module: nn.Module,
+        hidden_states: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        attentions: torch.Tensor,
+        kwargs: dict,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        if module.layer_idx == 0:
+            self.compression_ratios = []
+            self.head_ranks = []
+
+        if self.energy_ratio == 1:
+            return keys, values
+
+        bsz, num_key_value_heads, q_len, head_dim = keys.shape
+        num_key_value_groups = module.config.num_attention_heads // num_key_value_heads
+
+        # Queries captured by the attention forward, recomputed if unavailable
+        queries = get_window_queries(kwargs, self.window_size)
+        if queries is None:
+            queries = self.compute_window_queries(module, kwargs["hidden_states"], kwargs["position_embeddings"])
+        queries = queries.reshape(bsz, num_key_value_heads, num_key_value_groups * self.window_size, head_dim)
+        basis, head_ranks = query_aware_basis(queries, keys, self.energy_ratio)
+        self.head_ranks.append(head_ranks.cpu())
+        projected_keys = ProjectedKeys.from_basis(keys, basis)
+
+        # Keep the dense keys if the projection does not save memory (rank close to head_dim)
+        dense_nbytes = keys.numel() * keys.element_size()
+        values_nbytes = values.numel() * values.element_size()
+        if projected_keys.nbytes >= dense_nbytes:
+            self.compression_ratios.append(0.0)
+            return keys, values
+
+        self.compression_ratios.append(1 - (projected_keys.nbytes + values_nbytes) / (dense_nbytes + values_nbytes))
+        if isinstance(kwargs["past_key_value"], CompactKeyCache):
+            return projected_keys, values
+        return projected_keys.to_dense(), values
+
+    @property
+    def compression_ratio(self):
+        if len(self.compression_ratios) > 0:
+            return sum(self.compression_ratios) / len(self.compression_ratios)
+        return 0.0
+
+    @compression_ratio.setter
+    def compression_ratio(self, value):
+        raise AttributeError(f"compression ratio cannot be set for {type(self).__name__}")
+
+
+def query_aware_basis(queries, keys, energy_ratio=0.99):
+    """
+    Compute the low-rank basis of the keys of each head.
+
+    Args:
+        queries: Tensor of shape (bsz, num_key_value_heads, n_queries, head_dim), window queries of each key-value head
+        keys: Tensor of shape (bsz, num_key_value_heads, key_len, head_dim)
+        energy_ratio: float, fraction of the query-aware energy to keep
+
+    Returns:
+        basis: Tensor of shape (bsz, num_key_value_heads, head_dim, rank) in the keys' dtype, with orthonormal
+        columns sorted by decreasing energy. rank is the largest rank over heads, heads of lower rank are padded
+        with zero columns.
+        head_ranks: Tensor of shape (bsz, num_key_value_heads), number of non-zero columns of each head
+    """
+    head_dim = keys.shape[-1]
+    keys_float = keys.float()
+    covariance = torch.matmul(keys_float.transpose(2, 3), keys_float)  # (bsz, num_key_value_heads, head_dim, head_dim)
+    del keys_float
+    eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+
+    # Energy of the logits along each eigenvector: l_u * mean_q (q . u) ** 2
+    query_energy = torch.matmul(queries.float(), eigenvectors).pow_(2).mean(dim=-2)
+    energy = (eigenvalues.clamp(min=0) * query_energy).unsqueeze(-2)  # (bsz, num_key_value_heads, 1, head_dim)
+    mask = cumulative_channel_selection(energy, energy_ratio)
+
+    head_ranks = mask.sum(dim=(-2, -1))
+    rank = int(head_ranks.max())
+    order = torch.argsort(energy, dim=-1, descending=True)[..., :rank]
+    kept = torch.gather(mask, -1, order)
+    basis = torch.gather(eigenvectors, -1, order.expand(-1, -1, head_dim, -1)) * kept
+    return basis.to(keys.dtype), head_ranks
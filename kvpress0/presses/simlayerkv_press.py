@@ -1,10 +1,11 @@
 import logging
 from dataclasses import dataclass
+from typing import Optional
 
 import torch
 from torch import nn
 
-from kvpress.presses.base_press import BasePress
+from kvpress.presses.base_press import BasePress, get_window_queries
 from kvpress.presses.snapkv_press import SnapKVPress
 
 logger = logging.getLogger(__name__)
@@ -34,6 +35,10 @@ class SimLayerKVPress(BasePress):
     n_recent: int = 1024
     n_initial: int = 4
 
+    @property
+    def query_window_size(self) -> int:
+        return self.n_last
+
     def __post_init__(self):
         assert 0.0 <= self.lazy_threshold <= 1.0, "lazy_threshold should be in [0, 1]"
         self.compression_ratios = []
@@ -44,16 +49,18 @@ class SimLayerKVPress(BasePress):
         hidden_states: torch.Tensor,
         keys: torch.Tensor,
         position_embeddings: torch.Tensor,
+        query_states: Optional[torch.Tensor] = None,
     ) -> bool:
         """
         Compute the attention weights of the last tokens over the initial and recent tokens.
         The layer is considered lazy if the sum of these attention weights is above the lazy_threshold.
+        query_states are the last n_last queries if they were captured by the attention forward.
         """
 
-        attn_weights = SnapKVPress.compute_window_attention(
-            module, hidden_states, keys, self.n_last, position_embeddings
+        attn_weights = SnapKVPress.compute_window_attention_mean(
+            module, hidden_states, keys, self.n_last, position_embeddings, query_states
         )
-        attn_weights = attn_weights.mean((0, 1, 2))  # mean over bsz, heads and window size
+        attn_weights = attn_weights.mean((0, 1))  # mean over bsz and heads (and window size)
         score = attn_weights[: self.n_initial].sum() + attn_weights[-self.n_recent :].sum()
         return score.item() > self.lazy_threshold
 
@@ -94,7 +101,7 @@ class SimLayerKVPress(BasePress):
             return keys, values
 
         # Compression
-        if self.is_lazy(module, hidden_states, keys, kwargs["position_embeddings"]):
+        if self.is_lazy(module, hidden_states, keys, kwargs["position_embeddings"], get_window_queries(kwargs, self.n_last)):
             # If layer is lazy, only keep the initial and recent KV pairs
             keys = torch.cat([keys[:, :, : self.n_initial], keys[:, :, -self.n_recent + self.n_last :]], dim=2)
             values = torch.cat([values[:, :, : self.n_initial], values[:, :, -self.n_recent + self.n_last :]], dim=2)
@@ -10,6 +10,7 @@ from torch import nn
 from torch.nn import functional as F
 from transformers.models.llama.modeling_llama import repeat_kv, rotate_half
 
+from kvpress.presses.base_press import get_window_queries
 from kvpress.presses.scorer_press import ScorerPress
 
 
@@ -25,17 +26,17 @@ class SnapKVPress(ScorerPress):
     window_size: int = 64
     kernel_size: int = 5
     max_capacity_prompt = None
+    block_size = 4096  # number of keys scored at a time, see compute_window_attention_mean
 
     @staticmethod
-    def compute_window_attention(module, hidden_states, keys, window_size, position_embeddings):
+    def compute_window_query_states(module, hidden_states, window_size, position_embeddings):
         """
-        Compute the last window_size queries and associated attention weights for the first q_len - window_size keys.
+        Compute the last window_size queries, with RoPE applied
         """
 
         bsz, q_len, _ = hidden_states.shape
         num_heads = module.config.num_attention_heads
         head_dim = module.head_dim
-        num_key_value_groups = num_heads // module.config.num_key_value_heads
 
         # Get last window_size queries
         if hasattr(module, "q_proj"):
@@ -53,6 +54,23 @@ class SnapKVPress(ScorerPress):
         cos, sin = cos[:, -window_size:], sin[:, -window_size:]
         query_states = (query_states * cos.unsqueeze(1)) + (rotate_half(query_states) * sin.unsqueeze(1))
 
+        return query_states
+
+    @staticmethod
+    def compute_window_attention(module, hidden_states, keys, window_size, position_embeddings, query_states=None):
+        """
+        Compute the last window_size queries and associated attention weights for the first q_len - window_size keys.
+        Materializes the full (bsz, num_heads, window_size, q_len) attention matrix: prefer
+        compute_window_attention_mean when only its mean over the window is needed.
+        """
+
+        q_len = hidden_states.shape[1]
+        head_dim = module.head_dim
+        num_key_value_groups = module.config.num_attention_heads // module.config.num_key_value_heads
+
+        if query_states is None:
+            query_states = SnapKVPress.compute_window_query_states(module, hidden_states, window_size, position_embeddings)
+
         # Compute attention for first q_len - window_size tokens
         key_states = repeat_kv(keys, num_key_value_groups)
         attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(head_dim)
@@ -64,6 +82,56 @@ class SnapKVPress(ScorerPress):
 
         return attn_weights
 
+    @staticmethod
+    def compute_window_attention_mean(
+        module, hidden_states, keys, window_size, position_embeddings, query_states=None, block_size=4096
+    ):
+        """
+        Compute the attention weights of the last window_size queries on the first key_len - window_size keys,
+        averaged over the window queries: (bsz, num_heads, key_len - window_size), in float32.
+        Same result as compute_window_attention(...).mean(dim=-2), but the (bsz, num_heads, window_size, key_len)
+        logits, the causal mask and the repeated keys are never materialized: keys are streamed by blocks of
+        block_size, a first pass computes the softmax normalizer of each query with an online softmax and a second
+        pass accumulates the normalized weights of each block. Peak memory is O(block_size). query_states can be
+        given to reuse the last window_size queries captured by the attention forward (see get_window_queries).
+        """
+
+        bsz, num_key_value_heads, key_len, head_dim = keys.shape
+        num_heads = module.config.num_attention_heads
+        num_key_value_groups = num_heads // num_key_value_heads
+        prefix_len = key_len - window_size
+
+        if query_states is None:
+            query_states = SnapKVPress.compute_window_query_states(module, hidden_states, window_size, position_embeddings)
+        # Group the queries of each key-value head instead of repeating the keys
+        query_states = query_states.reshape(bsz, num_key_value_heads, num_key_value_groups * window_size, head_dim)
+        query_states = query_states / math.sqrt(head_dim)
+
+        def block_logits(start, end):
+            return torch.matmul(query_states, keys[:, :, start:end].transpose(2, 3)).float()
+
+        # 1. Softmax normalizer, starting with the window keys (the only ones that need a causal mask)
+        logits = block_logits(prefix_len, key_len).view(bsz, num_key_value_heads, num_key_value_groups, window_size, window_size)
+        causal_mask = torch.ones(window_size, window_size, dtype=torch.bool, device=keys.device).triu(diagonal=1)
+        logits = logits.masked_fill(causal_mask, float("-inf")).flatten(2, 3)
+        max_logits = logits.amax(dim=-1, keepdim=True)
+        normalizer = torch.exp(logits - max_logits).sum(dim=-1, keepdim=True)
+        for start in range(0, prefix_len, block_size):
+            logits = block_logits(start, min(start + block_size, prefix_len))
+            block_max = torch.maximum(max_logits, logits.amax(dim=-1, keepdim=True))
+            normalizer = normalizer * torch.exp(max_logits - block_max) + torch.exp(logits - block_max).sum(dim=-1, keepdim=True)
+            max_logits = block_max
+
+        # 2. Window mean of the normalized attention weights of the prefix keys
+        attn_mean = keys.new_empty(bsz, num_heads, prefix_len, dtype=torch.float32)
+        for start in range(0, prefix_len, block_size):
+            end = min(start + block_size, prefix_len)
+            weights = torch.exp(block_logits(start, end) - max_logits) / normalizer
+            weights = weights.view(bsz, num_key_value_heads, num_key_value_groups, window_size, end - start)
+            attn_mean[:, :, start:end] = weights.mean(dim=3).view(bsz, num_heads, end - start)
+
+        return attn_mean
+
     def score(
         self,
         module: nn.Module,
@@ -80,13 +148,18 @@ class SnapKVPress(ScorerPress):
         assert q_len > self.window_size, "Query length should be greater than the window size"
 
         if attentions is not None:
-            attn_weights = attentions[..., -self.window_size :, : -self.window_size]
+            scores = attentions[..., -self.window_size :, : -self.window_size].mean(dim=-2)
         else:
-            attn_weights = self.compute_window_attention(
-                module, hidden_states, keys, self.window_size, kwargs["position_embeddings"]
+            scores = self.compute_window_attention_mean(
+                module,
+                hidden_states,
+                keys,
+                self.window_size,
+                kwargs["position_embeddings"],
+                get_window_queries(kwargs, self.window_size),
+                self.block_size,
             )
 
-        scores = attn_weights.mean(dim=-2)
         scores = F.avg_pool1d(scores, kernel_size=self.kernel_size, padding=self.kernel_size // 2, stride=1)
 
         # Average per grioup (https://github.com/FasterDecoding/SnapKV/issues/22)
@@ -8,7 +8,7 @@ import torch
 from torch import nn
 from transformers.models.llama.modeling_llama import rotate_half
 
-from kvpress.presses.base_press import BasePress
+from kvpress.presses.base_press import BasePress, get_window_queries
 
 
 @dataclass
@@ -76,7 +76,10 @@ class ThinKPress(BasePress):
         bsz, num_key_value_heads, q_len, head_dim = keys.shape
         num_key_value_groups = module.config.num_attention_heads // num_key_value_heads
 
-        queries = self.compute_window_queries(module, kwargs["hidden_states"], kwargs["position_embeddings"])
+        # Queries captured by the attention forward, recomputed if unavailable
+        queries = get_window_queries(kwargs, self.window_size)
+        if queries is None:
+            queries = self.compute_window_queries(module, kwargs["hidden_states"], kwargs["position_embeddings"])
         queries_norm = torch.pow(queries, 2).mean(dim=2)  # (bsz, num_heads, head_dim)
         queries_norm = queries_norm.view(bsz, num_key_value_heads, num_key_value_groups, module.head_dim).mean(2)
         keys_norm = torch.pow(keys, 2).mean(dim=2)
@@ -8,6 +8,7 @@ import torch
 import torch.nn.functional as F
 from torch import nn
 
+from kvpress.presses.base_press import get_window_queries
 from kvpress.presses.scorer_press import ScorerPress
 from kvpress.presses.snapkv_press import SnapKVPress
 
@@ -24,6 +25,8 @@ class TOVAPress(ScorerPress):
 
     compression_ratio: float = 0.0
     max_capacity_prompt = None
+    window_size = 1  # only the last query is used
+    block_size = 4096  # number of keys scored at a time, see SnapKVPress.compute_window_attention_mean
 
     def score(
         self,
@@ -36,14 +39,14 @@ class TOVAPress(ScorerPress):
     ) -> torch.Tensor:
 
         if attentions is not None:
-            attn_weights = attentions[..., -1:, :-1]
+            attn_weights = attentions[..., -1, :-1]
         else:
-            attn_weights = SnapKVPress.compute_window_attention(
-                module, hidden_states, keys, 1, kwargs["position_embeddings"]
+            attn_weights = SnapKVPress.compute_window_attention_mean(
+                module, hidden_states, keys, 1, kwargs["position_embeddings"], get_window_queries(kwargs, 1), self.block_size
             )
 
         # Average across heads and repeat num_key_value_head times
-        scores = attn_weights.mean(1)
+        scores = attn_weights.mean(1, keepdim=True)
         scores = scores.repeat(1, keys.shape[1], 1)
 
         # Add back the last token. Use max score to make sure the window is not pruned.
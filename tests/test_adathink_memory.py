@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from kvpress.compact_cache import RaggedKeys, unpack_mask
+from kvpress.presses.adathink_press import (
+    FILL_STRATEGIES,
+    GROUP_PRESETS,
+    AdaThinKPress,
+    FillContext,
+    channel_ranks,
+    dynamic_group,
+    exponential_attn_grouped,
+)
+
+
+def int64_ranks(sorted_indices):
+    """
+    Previous AdaThinK ranks: int64, built next to the int64 sorted_indices, which were kept until the fill
+    """
+    positions = torch.arange(sorted_indices.shape[-1], device=sorted_indices.device).expand_as(sorted_indices)
+    return torch.empty_like(sorted_indices).scatter_(-1, sorted_indices, positions)
+
+
+def grouped_fill_context(shape, device):
+    """
+    Inputs of exponential_attn_grouped for random keys, with the "group" preset
+    """
+    keys = torch.randn(shape, device=device)
+    q_norm = torch.rand(*shape[:2], 1, shape[-1], device=device) + 0.1
+    contributions = keys.pow(2) * q_norm
+    sorted_indices = torch.argsort(contributions, dim=-1, descending=True)
+    cumulative_scores = torch.cumsum(torch.gather(contributions, dim=-1, index=sorted_indices), dim=-1)
+    threshold_indices = torch.searchsorted(cumulative_scores, 0.99 * cumulative_scores[..., -1:], right=True)
+    threshold_indices = threshold_indices.squeeze(-1).clamp(max=shape[-1] - 1)
+    del cumulative_scores
+    mask, topk_ratios, group_indicator = dynamic_group(
+        threshold_indices, channel_ranks(sorted_indices), *GROUP_PRESETS["group"]
+    )
+    ctx = FillContext(keys, mask, q_norm, contributions, None, 0, group_indicator, topk_ratios)
+    return ctx, sorted_indices
+
+
+def grouped_fill_peak_memory(use_int64_ranks, shape=(1, 8, 16384, 128)):
+    """
+    Peak memory allocated by exponential_attn_grouped, including the ranks it reads (and the sorted_indices the
+    previous implementation kept alive next to them)
+    """
+    torch.manual_seed(0)
+    ctx, sorted_indices = grouped_fill_context(shape, "cuda")
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = torch.cuda.memory_allocated()
+
+    if use_int64_ranks:
+        ctx.ranks = int64_ranks(sorted_indices)
+    else:
+        ctx.ranks = channel_ranks(sorted_indices)
+        del sorted_indices
+    filled_keys = exponential_attn_grouped(ctx)
+    torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() - start
+
+    del ctx, filled_keys
+    torch.cuda.empty_cache()
+    return peak
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is required to measure the peak memory")
+def test_grouped_fill_peak_memory():
+    int64_peak = grouped_fill_peak_memory(use_int64_ranks=True)
+    rank_peak = grouped_fill_peak_memory(use_int64_ranks=False)
+    assert rank_peak < 0.75 * int64_peak
+
+
+def test_grouped_fill_ranks():
+    torch.manual_seed(0)
+    ctx, sorted_indices = grouped_fill_context((1, 2, 64, 128), "cpu")
+    ctx.ranks = int64_ranks(sorted_indices)
+    int64_filled_keys = exponential_attn_grouped(ctx)
+    ctx.ranks = channel_ranks(sorted_indices)
+    assert torch.equal(exponential_attn_grouped(ctx), int64_filled_keys)
+
+
+@pytest.mark.parametrize("head_dim, ranks_dtype", [(128, torch.uint8), (512, torch.int16)])
+def test_press_ranks_and_masks(monkeypatch, head_dim, ranks_dtype):
+    """
+    Dtypes and values of the ranks, masks and groups built by AdaThinKPress.compress
+    """
+    contexts = []
+
+    def capture(ctx):
+        contexts.append(ctx)
+        return exponential_attn_grouped(ctx)
+
+    monkeypatch.setitem(FILL_STRATEGIES, "exponential_attn_grouped", capture)
+
+    torch.manual_seed(0)
+    bsz, num_heads, num_key_value_heads, seq_len, window_size = 1, 4, 2, 48, 8
+    keys = torch.randn(bsz, num_key_value_heads, seq_len, head_dim)
+    queries = torch.randn(bsz, num_heads, window_size, head_dim)
+    module = SimpleNamespace(layer_idx=0, head_dim=head_dim, config=SimpleNamespace(num_attention_heads=num_heads))
+    kwargs = {"window_queries": queries, "past_key_value": None}
+    press = AdaThinKPress(window_size=window_size, threshold_ratio=0.99, fill="exponential_attn_grouped")
+    press.compress(module, None, keys, keys, None, kwargs)
+
+    ctx = contexts[0]
+    assert ctx.ranks.dtype == ranks_dtype
+    assert ctx.mask.dtype == torch.bool
+    assert ctx.group_indicator.dtype == torch.uint8
+    assert press.stats.group_counts[0].dtype == torch.long
+
+    # Ranks invert the descending sort of the contributions, and each token keeps the channels of rank < k_g
+    sorted_indices = torch.argsort(ctx.contributions, dim=-1, descending=True)
+    assert torch.equal(ctx.ranks.long(), int64_ranks(sorted_indices))
+    keep_channels = torch.tensor([int(r * head_dim) for r in ctx.topk_ratios])
+    assert torch.equal(ctx.mask, ctx.ranks.long() < keep_channels[ctx.group_indicator.long()].unsqueeze(-1))
+
+    # Persisted masks are bit-packed
+    ragged_keys = RaggedKeys.from_mask(keys, ctx.mask)
+    assert ragged_keys.packed_mask.dtype == torch.uint8
+    assert ragged_keys.packed_mask.shape[-1] == head_dim // 8
+    assert torch.equal(unpack_mask(ragged_keys.packed_mask), ctx.mask)
@@ -0,0 +1,199 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from kvpress.presses.adathink_press import (
+    GROUP_PRESETS,
+    AdaThinKPress,
+    channel_ranks,
+    create_mask_by_threshold,
+    dim_contribution_norms,
+    dynamic_group,
+    dynamic_score_selection,
+    generate_pca_fill,
+)
+
+bsz, num_heads, num_key_value_heads, seq_len, head_dim, window_size = 2, 4, 2, 45, 32, 8
+
+
+def compress(press, keys, queries):
+    module = SimpleNamespace(layer_idx=0, head_dim=head_dim, config=SimpleNamespace(num_attention_heads=num_heads))
+    kwargs = {"window_queries": queries, "past_key_value": None}
+    pruned_keys, _ = press.compress(module, None, keys, keys, None, kwargs)
+    return pruned_keys
+
+
+@pytest.mark.parametrize(
+    "press_kwargs",
+    [
+        dict(threshold_ratio=0.99),  # "group" preset
+        dict(threshold_ratio=0.995, fill="exponential_attn_grouped"),  # "group5" preset
+        dict(threshold_ratio=0.985),
+        dict(key_channel_compression_ratio=0.5, fill="exponential_attn"),
+        dict(key_channel_compression_ratio=0.5, fill="interpolated"),
+        dict(threshold_ratio=0.9, selection="cumsum"),
+    ],
+)
+def test_chunked_selection(press_kwargs):
+    torch.manual_seed(0)
+    keys = torch.randn(bsz, num_key_value_heads, seq_len, head_dim)
+    queries = torch.randn(bsz, num_heads, window_size, head_dim)
+
+    press = AdaThinKPress(window_size=window_size, **press_kwargs)
+    chunked_press = AdaThinKPress(window_size=window_size, chunk_size=8, **press_kwargs)
+    pruned_keys = compress(press, keys, queries)
+    chunked_pruned_keys = compress(chunked_press, keys, queries)
+
+    assert torch.equal(pruned_keys != 0, chunked_pruned_keys != 0)
+    assert torch.allclose(pruned_keys, chunked_pruned_keys, atol=1e-6)
+    assert press.stats.summary() == chunked_press.stats.summary()
+
+
+def sklearn_pca_fill(keys, mask, n_components=10):
+    """
+    Previous PCA fill: one sklearn PCA per (batch, head) on the kept channels, the reconstruction of the kept
+    channels is written at the pruned ones (both have head_dim / 2 channels per token)
+    """
+    from sklearn.decomposition import PCA
+
+    recovered_keys = keys.clone()
+    for b in range(keys.shape[0]):
+        for h in range(keys.shape[1]):
+            valid_data = keys[b, h][mask[b, h]].view(keys.shape[2], -1).numpy()
+            pca_model = PCA(n_components=min(valid_data.shape[-1], n_components))
+            token_high_dims = pca_model.inverse_transform(pca_model.fit_transform(valid_data))
+            recovered_keys[b, h][~mask[b, h]] = torch.tensor(token_high_dims).view(-1).to(keys.dtype)
+    return recovered_keys
+
+
+@pytest.mark.parametrize("n_components", [4, 10])
+def test_pca_fill(n_components):
+    pytest.importorskip("sklearn")
+    torch.manual_seed(0)
+    keys = torch.randn(bsz, num_key_value_heads, seq_len, head_dim, dtype=torch.float64)
+    mask = torch.rand(keys.shape).argsort(dim=-1) < head_dim // 2
+
+    recovered_keys = generate_pca_fill(keys, mask, n_components)
+    assert torch.equal(recovered_keys[mask], keys[mask])
+    assert torch.allclose(recovered_keys, sklearn_pca_fill(keys, mask, n_components), atol=1e-8)
+
+
+# Group boundaries and keep ratios hard-coded in the previous dynamic_group, dynamic_group0, ..., dynamic_group7
+PREVIOUS_GROUPS = {
+    "group": ([0.2, 0.4, 0.6, 0.8], [0.1, 0.3, 0.5, 0.7, 0.9]),
+    "group0": ([0.2, 0.4, 0.6, 0.8], [0.2, 0.4, 0.6, 0.8, 1.0]),
+    "group1": ([0.25, 0.5, 0.75], [0.25, 0.5, 0.75, 1.0]),
+    "group2": ([0.25, 0.3, 0.35, 0.4], [0.2, 0.3, 0.35, 0.4, 0.5]),
+    "group22": ([0.2, 0.3, 0.4, 0.5, 0.6, 0.8], [0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0]),
+    "group3": ([0.2, 0.3, 0.4, 0.5], [0.2, 0.3, 0.4, 0.5, 0.6]),
+    "group4": ([0.3, 0.4, 0.5], [0.3, 0.4, 0.5, 0.6]),
+    "group5": ([0.3, 0.4, 0.5, 0.6], [0.3, 0.4, 0.5, 0.6, 0.7]),
+    "group6": ([0.25, 0.3, 0.35, 0.4, 0.6], [0.2, 0.25, 0.3, 0.35, 0.4, 0.5]),
+    "group7": ([0.3, 0.4, 0.5, 0.7], [0.3, 0.35, 0.4, 0.45, 0.5]),
+}
+
+
+def previous_dynamic_group(is_above_threshold, head_dim, keys, sorted_indices, boundaries, topk_ratios):
+    """
+    Previous dynamic_group* implementation: one masked assignment and one full scattered mask per group
+    """
+    first_above_threshold_idx = torch.argmax(is_above_threshold.float(), dim=-1)
+    group_indicator = torch.zeros_like(first_above_threshold_idx)
+    bounds = [-1] + [int(b * head_dim) for b in boundaries] + [head_dim]
+    for group_id in range(len(topk_ratios)):
+        in_group = (first_above_threshold_idx > bounds[group_id]) & (first_above_threshold_idx <= bounds[group_id + 1])
+        group_indicator[in_group] = group_id
+
+    total_mask = torch.zeros_like(keys, dtype=torch.bool)
+    for group_id, ratio in enumerate(topk_ratios):
+        group_mask = group_indicator == group_id
+        top_indices = sorted_indices[..., : int(ratio * head_dim)]
+        group_topk_mask = torch.zeros_like(keys, dtype=torch.bool).scatter_(-1, top_indices, True)
+        total_mask |= group_mask.unsqueeze(-1).expand_as(total_mask) & group_topk_mask
+    return total_mask, group_indicator
+
+
+@pytest.mark.parametrize("name", list(PREVIOUS_GROUPS))
+def test_group_presets(name):
+    assert GROUP_PRESETS[name] == PREVIOUS_GROUPS[name]
+
+    torch.manual_seed(0)
+    head_dim = 128
+    # Contributions from flat to peaked, so that tokens reach the threshold at every position
+    scales = torch.linspace(0, 6, seq_len).view(1, 1, -1, 1)
+    contributions = torch.exp(torch.randn(bsz, num_key_value_heads, seq_len, head_dim) * scales)
+    keys = contributions.sqrt()
+    sorted_indices = torch.argsort(contributions, dim=-1, descending=True)
+    cumulative_scores = torch.cumsum(torch.gather(contributions, dim=-1, index=sorted_indices), dim=-1)
+
+    # Previous threshold position and grouping
+    is_above_threshold = cumulative_scores > (0.99 * cumulative_scores[..., -1]).unsqueeze(-1)
+    mask, group_indicator = previous_dynamic_group(
+        is_above_threshold, head_dim, keys, sorted_indices, *PREVIOUS_GROUPS[name]
+    )
+
+    # Current threshold position (as in dynamic_score_selection_norm) and table-driven grouping
+    threshold_indices = torch.searchsorted(cumulative_scores, 0.99 * cumulative_scores[..., -1:], right=True)
+    threshold_indices = threshold_indices.squeeze(-1).clamp(max=head_dim - 1)
+    new_mask, topk_ratios, new_group_indicator = dynamic_group(
+        threshold_indices, channel_ranks(sorted_indices), *GROUP_PRESETS[name]
+    )
+
+    assert len(group_indicator.unique()) > 1
+    assert topk_ratios == PREVIOUS_GROUPS[name][1]
+    assert torch.equal(new_group_indicator.long(), group_indicator)
+    assert torch.equal(new_mask, mask)
+
+
+def loop_contribution_norms(queries, keys):
+    """
+    Previous per-channel scoring: one masked copy of the keys and one full attention matmul per channel
+    """
+    dim_contributions = []
+    for d in range(keys.shape[-1]):
+        keys_masked = torch.zeros_like(keys)
+        keys_masked[..., d] = keys[..., d]
+        attention_scores_masked = torch.matmul(queries, keys_masked.transpose(-1, -2))
+        dim_contributions.append(torch.norm(attention_scores_masked, dim=-2, p=2))
+    return torch.stack(dim_contributions, dim=-1)
+
+
+def test_dim_contribution_norms():
+    torch.manual_seed(0)
+    keys = torch.randn(bsz, num_key_value_heads, seq_len, head_dim, dtype=torch.float64)
+    queries = torch.randn(bsz, num_key_value_heads, window_size, head_dim, dtype=torch.float64)
+    contributions = dim_contribution_norms(queries, keys)
+    reference = loop_contribution_norms(queries, keys)
+    assert torch.allclose(contributions, reference)
+    assert torch.equal(contributions.argsort(dim=-1), reference.argsort(dim=-1))
+
+
+@pytest.mark.parametrize("press_kwargs", [dict(threshold_ratio=0.9), dict(key_channel_compression_ratio=0.5)])
+def test_dynamic_score_selection(press_kwargs):
+    torch.manual_seed(0)
+    keys = torch.randn(bsz, num_key_value_heads, seq_len, head_dim, dtype=torch.float64)
+    queries = torch.randn(bsz, num_key_value_heads, window_size, head_dim, dtype=torch.float64)
+    threshold_ratio = press_kwargs.get("threshold_ratio", 0)
+    key_channel_compression_ratio = press_kwargs.get("key_channel_compression_ratio", 0)
+
+    # Previous dynamic_score_selection, with the per-channel loop
+    queries_norm = torch.nn.functional.normalize(queries, dim=-1)
+    keys_norm = torch.nn.functional.normalize(keys, dim=-1)
+    original_norm = torch.norm(torch.matmul(queries_norm, keys_norm.transpose(-1, -2)), dim=-2, p=2).unsqueeze(-1)
+    dim_contributions = loop_contribution_norms(queries_norm, keys_norm)
+    sorted_indices = torch.argsort(dim_contributions, dim=-1, descending=True)
+    if threshold_ratio != 0:
+        sorted_contributions = torch.gather(dim_contributions / original_norm, dim=-1, index=sorted_indices)
+        cumulative_scores = torch.cumsum(sorted_contributions, dim=-1)
+        is_above_threshold = cumulative_scores > (threshold_ratio * cumulative_scores[..., -1]).unsqueeze(-1)
+        mask = create_mask_by_threshold(sorted_indices, is_above_threshold.to(torch.float32).argmax(dim=-1))
+    else:
+        mask = torch.ones_like(keys, dtype=torch.bool)
+        mask.scatter_(-1, sorted_indices[..., -int(key_channel_compression_ratio * head_dim) :], False)
+
+    pruned_keys = dynamic_score_selection(queries, keys, threshold_ratio, key_channel_compression_ratio)
+    assert torch.equal(pruned_keys, keys * mask)
@@ -0,0 +1,53 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from dataclasses import dataclass, field
+
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM
+
+from kvpress.presses.base_press import BasePress, get_window_queries
+from kvpress.presses.snapkv_press import SnapKVPress
+
+
+@dataclass
+class WindowQueriesPress(BasePress):
+    """
+    Record, for each layer, the window queries captured by the attention forward and the recomputed ones
+    """
+
+    window_size: int = 8
+    captured: dict = field(default_factory=dict)
+    recomputed: dict = field(default_factory=dict)
+
+    def compress(self, module, hidden_states, keys, values, attentions, kwargs):
+        self.captured[module.layer_idx] = get_window_queries(kwargs, self.window_size)
+        self.recomputed[module.layer_idx] = SnapKVPress.compute_window_query_states(
+            module, hidden_states, self.window_size, kwargs["position_embeddings"]
+        )
+        return keys, values
+
+
+def test_captured_window_queries():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    config._attn_implementation = "sdpa"  # eager attention is not called through ALL_ATTENTION_FUNCTIONS
+    model = LlamaForCausalLM(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (1, 20))
+
+    press = WindowQueriesPress()
+    with torch.no_grad(), press(model):
+        model(input_ids, past_key_values=DynamicCache())
+
+    assert len(press.captured) == config.num_hidden_layers
+    for layer_idx, window_queries in press.captured.items():
+        assert window_queries is not None
+        assert window_queries.shape == (1, config.num_attention_heads, press.window_size, 16)
+        assert torch.allclose(window_queries, press.recomputed[layer_idx], atol=1e-5)
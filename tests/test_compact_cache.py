@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import pytest
+import torch
+
+from kvpress.attention_patch import compact_attention
+from kvpress.compact_cache import BucketedKeys, ConcatenatedKeys, RaggedKeys, TieredKeys
+
+bsz, num_heads, num_key_value_heads, head_dim = 2, 4, 2, 16
+compact_len, dense_len = 37, 5
+
+LAYOUTS = {
+    "ragged": RaggedKeys.from_mask,
+    "int8": lambda keys, mask: TieredKeys.from_mask(keys, mask, bits=8),
+    "int4": lambda keys, mask: TieredKeys.from_mask(keys, mask, bits=4),
+    "bucketed": BucketedKeys.from_mask,
+}
+
+
+def make_compact_keys(layout):
+    torch.manual_seed(0)
+    keys = torch.randn(bsz, num_key_value_heads, compact_len, head_dim)
+    # Between 1 and head_dim kept channels per token, as the AdaThinK groups
+    n_kept = torch.randint(1, head_dim + 1, (bsz, num_key_value_heads, compact_len, 1))
+    mask = torch.rand(keys.shape).argsort(dim=-1) < n_kept
+    return LAYOUTS[layout](keys, mask)
+
+
+def dense_attention(query, keys, value, attention_mask=None):
+    """
+    Reference: eager attention on the zero-filled (or dequantized) keys with a causal mask on the last q_len tokens
+    """
+    q_len, key_len = query.shape[2], keys.shape[2]
+    num_key_value_groups = query.shape[1] // keys.shape[1]
+    keys = keys.repeat_interleave(num_key_value_groups, dim=1)
+    value = value.repeat_interleave(num_key_value_groups, dim=1)
+    logits = torch.matmul(query, keys.transpose(2, 3)) * head_dim**-0.5
+    causal_mask = torch.ones(q_len, key_len, dtype=torch.bool).triu(diagonal=key_len - q_len + 1)
+    logits = logits.masked_fill(causal_mask, float("-inf"))
+    if attention_mask is not None:
+        logits = logits.masked_fill(~attention_mask, float("-inf"))
+    return torch.matmul(torch.softmax(logits, dim=-1), value).transpose(1, 2)
+
+
+@pytest.mark.parametrize("layout", list(LAYOUTS))
+def test_attention_logits(layout):
+    compact_keys = make_compact_keys(layout)
+    query = torch.randn(bsz, num_heads, 3, head_dim)
+    keys = compact_keys.to_dense()
+    grouped_query = query.reshape(bsz, num_key_value_heads, -1, head_dim)
+    reference = torch.matmul(grouped_query, keys.transpose(2, 3))
+    # Chunks smaller than the sequence, not dividing it, and larger than it
+    for chunk_size in [8, 4096]:
+        logits = compact_keys.attention_logits(query, chunk_size)
+        assert torch.allclose(logits, reference, atol=1e-5)
+
+
+@pytest.mark.parametrize("layout", list(LAYOUTS))
+@pytest.mark.parametrize("q_len", [1, 3])
+def test_compact_attention(layout, q_len):
+    compact_keys = make_compact_keys(layout)
+    query = torch.randn(bsz, num_heads, q_len, head_dim)
+    key = torch.randn(bsz, num_key_value_heads, dense_len, head_dim)
+    value = torch.randn(bsz, num_key_value_heads, compact_len + dense_len, head_dim)
+
+    attn_output, _ = compact_attention(None, query, key, value, compact_keys)
+    reference = dense_attention(query, torch.cat([compact_keys.to_dense(), key], dim=2), value)
+    assert torch.allclose(attn_output, reference, atol=1e-5)
+
+    # Prefilled and decoding parts stored one after the other
+    concatenated_keys = ConcatenatedKeys([compact_keys, make_compact_keys("ragged")])
+    value = torch.randn(bsz, num_key_value_heads, 2 * compact_len + dense_len, head_dim)
+    attn_output, _ = compact_attention(None, query, key, value, concatenated_keys)
+    reference = dense_attention(query, torch.cat([concatenated_keys.to_dense(), key], dim=2), value)
+    assert torch.allclose(attn_output, reference, atol=1e-5)
+
+
+@pytest.mark.parametrize("layout", ["ragged", "int4", "bucketed"])
+def test_compact_attention_padding_mask(layout):
+    compact_keys = make_compact_keys(layout)
+    q_len, key_len = 2, compact_len + dense_len
+    query = torch.randn(bsz, num_heads, q_len, head_dim)
+    key = torch.randn(bsz, num_key_value_heads, dense_len, head_dim)
+    value = torch.randn(bsz, num_key_value_heads, key_len, head_dim)
+
+    # Left padding of the first sequence, as a boolean and as an additive 4D mask
+    attention_mask = torch.ones(bsz, 1, q_len, key_len, dtype=torch.bool)
+    attention_mask[0, :, :, :4] = False
+    attention_mask &= ~torch.ones(q_len, key_len, dtype=torch.bool).triu(diagonal=key_len - q_len + 1)
+    additive_mask = torch.zeros(attention_mask.shape).masked_fill(~attention_mask, torch.finfo(torch.float32).min)
+
+    reference = dense_attention(query, torch.cat([compact_keys.to_dense(), key], dim=2), value, attention_mask)
+    for mask in [attention_mask, additive_mask]:
+        attn_output, _ = compact_attention(None, query, key, value, compact_keys, mask)
+        assert torch.allclose(attn_output, reference, atol=1e-5)
@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+from torch import nn
+from transformers import LlamaConfig
+from transformers.models.llama.modeling_llama import LlamaRotaryEmbedding
+
+from kvpress.presses.expected_attention_press import ExpectedAttentionPress
+
+
+def full_query_statistics(press, module, hidden_states):
+    """
+    Previous get_query_statistics: the diagonal blocks of the full (n * d, n * d) Wq @ cov @ Wq.T and a rotation
+    matrix rebuilt at every call
+    """
+    bsz, q_len, _ = hidden_states.shape
+    n, d = module.config.num_attention_heads, module.head_dim
+    h = hidden_states[:, press.n_sink :]
+    Wq = module.q_proj.weight
+
+    mean_h = torch.mean(h, dim=1, keepdim=True)
+    mu = torch.matmul(mean_h, Wq.T).squeeze(1).view(bsz, n, d)
+    h = h - mean_h
+    cov = torch.matmul(h.transpose(1, 2), h) / h.shape[1]
+    cov = torch.matmul(Wq, torch.matmul(cov, Wq.T))
+    cov = cov.view(bsz, n, d, n, d).diagonal(dim1=1, dim2=3).permute(0, 3, 1, 2)
+
+    position_ids = torch.arange(q_len, q_len + press.n_future_positions).unsqueeze(0)
+    cos, sin = module.rotary_emb(mu, position_ids)
+    cos, sin = cos[0], sin[0]
+    Id = torch.eye(d, dtype=cos.dtype)
+    P = torch.zeros((d, d), dtype=cos.dtype)
+    P[d // 2 :, : d // 2], P[: d // 2, d // 2 :] = torch.eye(d // 2), -torch.eye(d // 2)
+    R = (cos.unsqueeze(1) * Id + sin.unsqueeze(1) * P).mean(dim=0)
+    return torch.matmul(mu, R.T), torch.matmul(R, torch.matmul(cov, R.T))
+
+
+@pytest.mark.parametrize("q_len", [24, 40])
+def test_query_statistics(q_len):
+    torch.manual_seed(0)
+    config = LlamaConfig(hidden_size=64, num_attention_heads=4, num_key_value_heads=2)
+    module = SimpleNamespace(
+        config=config,
+        head_dim=16,
+        q_proj=nn.Linear(64, 64, bias=False),
+        rotary_emb=LlamaRotaryEmbedding(config=config),
+    )
+    hidden_states = torch.randn(2, q_len, 64)
+    press = ExpectedAttentionPress(n_future_positions=32)
+
+    mu, cov = full_query_statistics(press, module, hidden_states)
+    with torch.no_grad():
+        # The second call reads the averaged rotation from the cache
+        for _ in range(2):
+            press_mu, press_cov = press.get_query_statistics(module, hidden_states)
+            assert torch.allclose(press_mu, mu, atol=1e-5)
+            assert torch.allclose(press_cov, cov, atol=1e-5)
+    assert len(press.rotation_cache) == 1
@@ -0,0 +1,46 @@
+# SPDX-FileCopyrightText: Copyright (c) 1993-2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from kvpress.presses.snapkv_press import SnapKVPress
+
+
+def dense_window_attention_mean(query_states, keys, window_size):
+    """
+    Reference: full softmax over all the keys with a causal mask on the window, averaged over the window queries
+    """
+    num_key_value_groups = query_states.shape[1] // keys.shape[1]
+    key_len, head_dim = keys.shape[2], keys.shape[3]
+    keys = keys.repeat_interleave(num_key_value_groups, dim=1)
+    logits = torch.matmul(query_states, keys.transpose(2, 3)).double() / head_dim**0.5
+    causal_mask = torch.ones(window_size, key_len, dtype=torch.bool).triu(diagonal=key_len - window_size + 1)
+    logits = logits.masked_fill(causal_mask, float("-inf"))
+    return torch.softmax(logits, dim=-1)[..., :-window_size].mean(dim=-2)
+
+
+@pytest.mark.parametrize("block_size", [7, 4096])
+def test_compute_window_attention_mean(block_size):
+    bsz, num_heads, num_key_value_heads, key_len, head_dim, window_size = 2, 8, 2, 50, 16, 8
+    module = SimpleNamespace(
+        head_dim=head_dim,
+        config=SimpleNamespace(num_attention_heads=num_heads, num_key_value_heads=num_key_value_heads),
+    )
+    keys = torch.randn(bsz, num_key_value_heads, key_len, head_dim)
+    query_states = torch.randn(bsz, num_heads, window_size, head_dim)
+    hidden_states = torch.empty(bsz, key_len, 1)
+
+    scores = SnapKVPress.compute_window_attention_mean(
+        module, hidden_states, keys, window_size, None, query_states, block_size
+    )
+    reference = dense_window_attention_mean(query_states, keys, window_size)
+    assert scores.shape == (bsz, num_heads, key_len - window_size)
+    assert torch.allclose(scores.double(), reference, atol=1e-6)
+
+    attn_weights = SnapKVPress.compute_window_attention(
+        module, hidden_states, keys, window_size, None, query_states
+    )
+    assert torch.allclose(attn_weights.mean(dim=-2).double(), reference, atol=1e-6)